@@ -1,24 +1,151 @@
 # SpreadSheetClient
 
+import os
+import sys
 import socket
-import json
 import requests
 import time
 import random
+import threading
+import uuid
+import bisect
+import queue
+from concurrent.futures import Future, TimeoutError, InvalidStateError
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server"))    # the wire modules are the server's own
+from FrameReader import FrameReader
+from Codec import dumps, loads
+from Placement import canonical_key, key_position
+from ReadCache import ReadCache
+
+TIMEOUT     = 5         # wait at most 5 sec for a response
+WINDOW      = 64        # max requests in flight on one connection
+RING_REFRESH_INTERVAL = 1   # refresh a stale ring view at most once per second
+CONSISTENCY = ("one", "quorum", "all")      # copies of a key a request waits for: any one, a majority, every one
+PROTOCOLS   = ("binary", "json")    # frames a connection offers the server: binary once it agrees, or newline-delimited json only
+NAME_SERVER = ("catalog.cse.nd.edu", 9097)  # catalog the nodes register with, asked for them with GET /query.json
+
+class Connection:
+    """ Connection: one server connection carrying many in-flight requests, matched to responses by msg_id """
+    def __init__(self, host, port, window=WINDOW, on_push=None, protocol="binary"):
+        self.host = host
+        self.port = port
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.connect((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     # pipelined small frames: don't wait for acks
+        self.reader = FrameReader(self.sock)
+        self.pending = {}                                   # {msg_id: Future}
+        self.streams = {}                                   # {msg_id: callback(response)} of requests answered in parts
+        self.on_push = on_push                              # on_push(message) for messages the server sends unasked (cache invalidations)
+        self.window = threading.BoundedSemaphore(window)    # free in-flight slots
+        self.send_lock = threading.Lock()                   # one sendall at a time
+        self.closed = False
+        self.binary = False                                 # the server agreed to binary frames: send ours binary too
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        if protocol == "binary":
+            self._hello()
+
+    def _hello(self):
+        """ offer binary frames; requests go out as json until the answer says yes (the hello holds no window slot) """
+        future = self.pending["hello"] = Future()
+        future.add_done_callback(lambda _: setattr(self, "binary", not future.exception() and future.result().get("protocol") == "binary"))
+        with self.send_lock:
+            self.sock.sendall(dumps({"method": "hello", "protocols": list(PROTOCOLS), "msg_id": "hello"}))
+
+    def _read_loop(self):
+        """ background reader: resolve the future of every response, in whatever order they arrive """
+        try:
+            while True:
+                response = loads(self.reader.read_frame())
+                if "method" in response:    # pushed by the server, not an answer
+                    if self.on_push:
+                        self.on_push(response)
+                    continue
+                if response.get("more"):    # one part of a streamed response, the last one resolves the future
+                    callback = self.streams.get(response.get("msg_id"))
+                    if callback:
+                        callback(response)
+                    continue
+                self.streams.pop(response.get("msg_id"), None)
+                future = self.pending.pop(response.get("msg_id"), None)
+                if future:
+                    try:
+                        future.set_result(response)
+                    except InvalidStateError:   # timed out and cancelled meanwhile
+                        pass
+        except Exception as e:
+            self.close(e)
+
+    def submit(self, msg_id, request, on_part=None):
+        """ send request tagged with msg_id (returns a Future of the response, blocks while the window is full)
+            on_part(response) gets every part of a streamed response but the last """
+        if self.closed:
+            raise EOFError("Socket connection broken")
+        self.window.acquire()
+        future = Future()
+        self.pending[msg_id] = future
+        if on_part:
+            self.streams[msg_id] = on_part
+        future.add_done_callback(lambda _: (self.pending.pop(msg_id, None), self.streams.pop(msg_id, None), self.window.release()))
+        try:
+            with self.send_lock:
+                self.sock.sendall(dumps(request, self.binary))
+        except Exception as e:
+            future.set_exception(e)
+        return future
+
+    def close(self, error=None):
+        """ close the socket and fail every request still in flight """
+        self.closed = True
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+        for msg_id in list(self.pending):
+            future = self.pending.pop(msg_id, None)
+            if future and not future.done():
+                future.set_exception(error or EOFError("Socket connection broken"))
+
 
 class SpreadSheetClient:
-    def __init__(self, project_name):
+    """ SpreadSheetClient: a key is an int, a str or bytes, in canonical form (Placement.canonical_key): decimal text is its int
+        and bytes are their utf-8 text, so "7" and 7 are one key, and so are b"x" and "x"; answers carry keys in that form """
+    def __init__(self, project_name, window=WINDOW, direct=False, consistency="one", cache=0, protocol="binary", name_server=NAME_SERVER):
         self.host = None
         self.port = None
         self.project_name = project_name
-        self.client_socket = None
+        self.name_server = name_server      # (host, port) of the catalog the nodes register with
+        self.window = window
+        self.connection = None      # connection to the entry node
+        self.client_id = f"c{uuid.uuid4().hex[:12]}"   # msg_id prefix, unique across clients
+        self.msg_counter = 0
+        self.counter_lock = threading.Lock()
+        if consistency not in CONSISTENCY:
+            raise ValueError(f"consistency must be one of {CONSISTENCY}")
+        self.consistency = consistency      # default level of insert / lookup / remove
+        if protocol not in PROTOCOLS:
+            raise ValueError(f"protocol must be one of {PROTOCOLS}")
+        self.protocol = protocol            # frames offered on every connection
+
+        self.direct = direct        # send keyed requests straight to their owner using the ring cache
+        self.connections = {}       # pooled connections: {(host, port): Connection}
+        self.ring = []              # cached ring view, sorted by node_id: [[node_id, host, port]]
+        self.ring_ids = []          # node_ids of self.ring, for bisect
+        self.ring_stale = True
+        self.ring_refreshed = 0
+        self.replication = 1        # copies of every key in the ring (owner included)
+        self.cache = ReadCache(cache)   # consistency one lookup answers, valid while their lease runs (0: no cache)
+        self.cache_lock = threading.Lock()  # answers and invalidations arrive on the reader threads
+        self.key_bits = 16          # identifier space of the ring: 2**key_bits positions
+
         self._re_connect()  # set host and port
-        
+        if self.direct:
+            self.refresh_ring()
+
     def _re_connect(self):
-        if self.client_socket:
-            self.client_socket.close()
+        if self.connection:
+            self.connection.close()
         try:
-            response = requests.get("http://catalog.cse.nd.edu:9097/query.json")    # name server
+            response = requests.get(f"http://{self.name_server[0]}:{self.name_server[1]}/query.json")    # name server
             services = response.json()
 
             # select a random server
@@ -29,44 +156,272 @@ class SpreadSheetClient:
                 try:
                     self.host = service.get("name")
                     self.port = service.get("port")
-                    self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.client_socket.connect((self.host, self.port)) # connect to this server, and send join request
+                    self.connection = Connection(self.host, self.port, self.window, self._pushed, self.protocol)
+                    self.connections[(self.host, self.port)] = self.connection
                     print(f'connecting to: {self.host, self.port}')
                     break
                 except:
                     pass
-            
-
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.client_socket.connect((self.host, self.port))
         except:
             print('project not found')
 
-    def send_request(self, request):
+    def _next_msg_id(self):
+        with self.counter_lock:
+            self.msg_counter += 1
+            return f"{self.client_id}_{self.msg_counter}"
+
+    def _connection(self, host, port):
+        """ pooled connection to a node (opened on first use) """
+        connection = self.connections.get((host, port))
+        if connection is None or connection.closed:
+            connection = self.connections[(host, port)] = Connection(host, port, self.window, self._pushed, self.protocol)
+        return connection
+
+    def send_request_async(self, request, connection=None, on_part=None):
+        """ send request without waiting (returns a Future of the response) """
+        msg_id = self._next_msg_id()
+        request = dict(request, msg_id=msg_id)
         try:
-            request_data = f'{json.dumps(request)}\n'.encode('utf-8')
-            self.client_socket.sendall(request_data)
-            self.client_socket.settimeout(5)             # wait at most 5 sec
-
-            response_data = b''
-            while not response_data.endswith(b'\n'):
-                more = self.client_socket.recv(1)
-                if not more:
-                    raise EOFError("Socket connection broken")
-                response_data += more
-            return json.loads(response_data.decode('utf-8').strip())
+            return (connection or self.connection).submit(msg_id, request, on_part)
         except Exception as e:
+            future = Future()
+            future.set_exception(e)
+            return future
+
+    def refresh_ring(self):
+        """ rebuild the ring view from the ringView of every reachable node """
+        self.ring_refreshed = time.time()
+        known = {}                  # {node_id: [node_id, host, port]}
+        queried = set()
+        frontier = [(self.host, self.port)]
+        while frontier:
+            futures = []
+            for host, port in frontier:
+                queried.add((host, port))
+                try:
+                    futures.append(self.send_request_async({"method": "ringView"}, self._connection(host, port)))
+                except OSError:
+                    pass
+            frontier = []
+            for response in self.gather(futures):
+                if not response or "nodes" not in response:
+                    continue
+                self.replication = max(self.replication, response.get("replication", 1))
+                self.key_bits = response.get("key_bits", self.key_bits)
+                for node_id, host, port in response["nodes"]:
+                    known[int(node_id)] = [int(node_id), host, int(port)]
+                    if (host, int(port)) not in queried and (host, int(port)) not in frontier:
+                        frontier.append((host, int(port)))
+        self.ring = sorted(known.values())
+        self.ring_ids = [node_id for node_id, _, _ in self.ring]
+        self.ring_stale = not self.ring
+
+    def _owner(self, key):
+        """ owner of key according to the ring cache: first node_id >= the key's ring position, wrapping around (None if unknown) """
+        if self.ring_stale and time.time() - self.ring_refreshed >= RING_REFRESH_INTERVAL:
+            self.refresh_ring()
+        position = key_position(key, self.key_bits)
+        if not self.ring or position is None:
+            return None
+        return self.ring[bisect.bisect_left(self.ring_ids, position) % len(self.ring)]
+
+    def _holders(self, key):
+        """ nodes holding a copy of key according to the ring cache: its owner and the next replication - 1 """
+        i = bisect.bisect_left(self.ring_ids, key_position(key, self.key_bits))
+        return [self.ring[(i + j) % len(self.ring)] for j in range(min(self.replication, len(self.ring)))]
+
+    def _check_owner(self, future, node_id):
+        """ a different node answered => some node joined or left, refresh the ring view """
+        if future.cancelled() or future.exception():
+            self.ring_stale = True
+        elif future.result().get("owner", node_id) != node_id:
+            self.ring_stale = True
+
+    def send_keyed_async(self, request, key):
+        """ send a request about key, straight to its owner when the ring cache knows it """
+        if request["method"] != "lookup":   # our own write: a cached answer of the key is stale now
+            self._forget([request["key"]])
+        owner = self._owner(key) if self.direct else None
+        if owner is None:
+            return self.send_request_async(request)
+        node_id, host, port = owner
+        request = dict(request, direct=True)
+        if request["method"] == "lookup" and "consistency" not in request and "lease" not in request and self.replication > 1:
+            # consistency one: any copy may answer, so reads of a hot key spread over its owner and replicas
+            node_id, host, port = random.choice(self._holders(key))
+            if node_id != owner[0]:     # a replica lacking the key routes it on to the owner
+                request = dict(request, replica=True)
+                del request["direct"]
+        try:
+            connection = self._connection(host, port)
+        except OSError:     # owner unreachable => let the entry node route it
+            self.ring_stale = True
+            return self.send_request_async(request)
+        future = self.send_request_async(request, connection)
+        future.add_done_callback(lambda f: self._check_owner(f, node_id))
+        return future
+
+    def _pushed(self, message):
+        """ a server invalidated keys we hold leased answers of """
+        if message.get("method") == "invalidate":
+            self._forget(message.get("keys", []))
+
+    def _forget(self, keys):
+        if self.cache.capacity:
+            with self.cache_lock:
+                for key in keys:
+                    self.cache.invalidate(key)
+
+    def _cached_lookup(self, request, key):
+        """ lookup answered from the cache while its lease runs; a miss asks the owner for a lease on the answer and caches it """
+        if not self.cache.capacity or "consistency" in request:
+            return self.send_keyed_async(request, key)
+        with self.cache_lock:
+            hit = self.cache.get(request["key"])
+        if hit:
+            future = Future()
+            future.set_result(dict(hit[1]))
+            return future
+        request["lease"] = True
+        future = self.send_keyed_async(request, key)
+        future.add_done_callback(lambda f: self._cache_answer(request["key"], f))
+        return future
+
+    def _cache_answer(self, key, future):
+        if future.cancelled() or future.exception():
+            return
+        response = future.result()
+        if "lease" in response:
+            with self.cache_lock:
+                self.cache.put(key, {field: value for field, value in response.items() if field not in ("msg_id", "lease", "owner")}, response["lease"])
+
+    def wait(self, future, request=None, timeout=TIMEOUT):
+        """ wait for a Future returned by *_async (returns the response, None on error or timeout) """
+        try:
+            return future.result(timeout)
+        except Exception as e:
+            if isinstance(e, TimeoutError):
+                e = "timed out"
+                future.cancel()     # frees the window slot, a late response is dropped
             print(f"Request: {request}\n Error: {e}\n")
 
-    def insert(self, key, value):
-        request = {"method": "insert", "key": key, "value": value}
-        return self.send_request(request)
+    def gather(self, futures, timeout=TIMEOUT):
+        """ wait for many Futures (returns their responses in order, None for failed ones) """
+        deadline = time.time() + timeout
+        return [self.wait(future, timeout=max(0, deadline - time.time())) for future in futures]
+
+    def send_request(self, request):
+        return self.wait(self.send_request_async(request), request)
+
+    def _keyed(self, request, consistency):
+        """ request at a consistency level (None: the client's default), its key as sent """
+        request["key"] = self._key(request["key"])
+        consistency = consistency or self.consistency
+        if consistency not in CONSISTENCY:
+            raise ValueError(f"consistency must be one of {CONSISTENCY}")
+        if consistency != "one":
+            request["consistency"] = consistency
+        return request
+
+    def _key(self, key):
+        """ key as sent: canonical (ints, text, bytes as text), anything else as is for the server to reject """
+        canonical = canonical_key(key)
+        return key if canonical is None else canonical
+
+    def insert_async(self, key, value, consistency=None):
+        return self.send_keyed_async(self._keyed({"method": "insert", "key": key, "value": value}, consistency), key)
 
-    def lookup(self, key):
-        request = {"method": "lookup", "key": key}
-        return self.send_request(request)
+    def lookup_async(self, key, consistency=None):
+        return self._cached_lookup(self._keyed({"method": "lookup", "key": key}, consistency), key)
 
-    def remove(self, key):
-        request = {"method": "remove", "key": key}
-        return self.send_request(request)
+    def remove_async(self, key, consistency=None):
+        return self.send_keyed_async(self._keyed({"method": "remove", "key": key}, consistency), key)
 
+    def insert(self, key, value, consistency=None):
+        request = self._keyed({"method": "insert", "key": key, "value": value}, consistency)
+        return self.wait(self.send_keyed_async(request, key), request)
+
+    def lookup(self, key, consistency=None):
+        request = self._keyed({"method": "lookup", "key": key}, consistency)
+        return self.wait(self._cached_lookup(request, key), request)
+
+    def remove(self, key, consistency=None):
+        request = self._keyed({"method": "remove", "key": key}, consistency)
+        return self.wait(self.send_keyed_async(request, key), request)
+
+    def _batch(self, method, field, entries):
+        """ send a batch request, one per owner with the ring cache (returns {"status", "results": {key: result}}, None on error) """
+        if method != "multi_lookup":
+            self._forget([entry[0] if field == "items" else entry for entry in entries])
+        groups = {}     # {owner (or None for the entry node): entries}
+        for entry in entries:
+            owner = self._owner(entry[0] if field == "items" else entry) if self.direct else None
+            groups.setdefault(owner and (owner[1], owner[2]), []).append(entry)
+        futures = []
+        for addr, group in groups.items():
+            request = {"method": method, field: group}
+            try:
+                futures.append(self.send_request_async(request, addr and self._connection(*addr)))
+            except OSError:
+                self.ring_stale = True
+                futures.append(self.send_request_async(request))
+        responses = self.gather(futures)
+        if any(response is None or "results" not in response for response in responses):
+            return None
+        return {"status": "success", "results": {key: result for response in responses for key, result in response["results"]}}
+
+    def multi_insert(self, items):
+        """ insert many (key, value) pairs (or a dict) with one request """
+        items = items.items() if isinstance(items, dict) else items
+        return self._batch("multi_insert", "items", [[self._key(key), value] for key, value in items])
+
+    def multi_lookup(self, keys):
+        return self._batch("multi_lookup", "keys", [self._key(key) for key in keys])
+
+    def multi_remove(self, keys):
+        return self._batch("multi_remove", "keys", [self._key(key) for key in keys])
+
+    def range_lookup_iter(self, start, end, timeout=TIMEOUT):
+        """ yield the (key, value) pairs placed at ring positions start <= p < end in ring order, as each owning node streams them back
+            (raises TimeoutError when no part arrives for timeout sec, RuntimeError on a failure response) """
+        parts = queue.Queue()
+        request = {"method": "range_lookup", "key": start, "start": start, "end": end}
+        future = self.send_request_async(request, on_part=parts.put)
+        future.add_done_callback(parts.put)     # the last part (or the error) resolves the future
+        while True:
+            try:
+                part = parts.get(timeout=timeout)
+            except queue.Empty:
+                future.cancel()
+                raise TimeoutError(f"range_lookup [{start}, {end}) timed out")
+            if isinstance(part, Future):
+                part = part.result()
+                if part.get("status") != "success":
+                    raise RuntimeError(part.get("message", "range_lookup failed"))
+            for key, value in part.get("items", []):
+                yield key, value
+            if not part.get("more"):
+                return
+
+    def stats(self, prometheus=False):
+        """ counters of the entry node (returns {"status", "stats"}, or {"status", "text"} in Prometheus text format) """
+        return self.send_request({"method": "stats", "format": "prometheus"} if prometheus else {"method": "stats"})
+
+    def ring_stats(self):
+        """ counters of every node in the ring view (returns {node_id: stats}, nodes that did not answer left out) """
+        self.refresh_ring()
+        futures = []
+        for node_id, host, port in self.ring:
+            try:
+                futures.append((node_id, self.send_request_async({"method": "stats"}, self._connection(host, port))))
+            except OSError:
+                pass
+        responses = self.gather([future for _, future in futures])
+        return {node_id: response["stats"] for (node_id, _), response in zip(futures, responses) if response and "stats" in response}
+
+    def range_lookup(self, start, end):
+        """ every (key, value) placed at ring positions start <= p < end (returns {"status", "items": [[key, value]]}, None on error) """
+        try:
+            return {"status": "success", "items": [[key, value] for key, value in self.range_lookup_iter(start, end)]}
+        except Exception as e:
+            print(f"Request: range_lookup [{start}, {end})\n Error: {e}\n")
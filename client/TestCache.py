@@ -0,0 +1,54 @@
+# TestCache
+
+import sys
+import time
+import random
+import bisect
+import itertools
+from SpreadSheetClient import SpreadSheetClient
+
+KEYS        = 1000
+ITERATIONS  = 5000
+ZIPF_S      = 1.1       # skew: the i-th most popular key is read ~1 / i**s as often
+WRITE_RATIO = 0.05      # share of the operations that overwrite the key instead of reading it
+CACHE_SIZE  = 100       # client cache entries
+
+def zipf_sampler(n, s):
+    """ random key ranks 0..n-1, rank i drawn with probability ~1 / (i + 1)**s """
+    weights = list(itertools.accumulate(1 / (i + 1) ** s for i in range(n)))
+    return lambda: bisect.bisect(weights, random.random() * weights[-1])
+
+def run(client, keys, sample):
+    """ skewed mix of lookups and overwrites (returns average lookup latency, lookups answered with an outdated value) """
+    latest = {}
+    lookups = stale = 0
+    lookup_time = 0
+    for _ in range(ITERATIONS):
+        key = keys[sample()]
+        if random.random() < WRITE_RATIO:
+            latest[key] = latest.get(key, 0) + 1
+            client.insert(key, {"value": key, "write": latest[key]})
+            continue
+        start = time.time()
+        result = client.lookup(key)
+        lookup_time += time.time() - start
+        lookups += 1
+        stale += result["value"]["write"] != latest.get(key, 0)
+    return lookup_time / lookups, stale
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 TestCache.py <project_name>")
+        sys.exit(1)
+    project_name = sys.argv[1]
+    keys = [f"hot:{i}" for i in range(KEYS)]
+    sample = zipf_sampler(KEYS, ZIPF_S)
+
+    # same skewed workload without and with a client cache (routing nodes cache too when started with --cache)
+    for cache in (0, CACHE_SIZE):
+        client = SpreadSheetClient(project_name, cache=cache)
+        client.multi_insert({key: {"value": key, "write": 0} for key in keys})
+        latency, stale = run(client, keys, sample)
+        cached = client.cache.hits + client.cache.misses
+        hit_rate = client.cache.hits / cached if cached else 0
+        print(f"client cache {cache:4}\tlookup latency: {latency:.6f} sec\thit rate: {hit_rate:6.1%}\tstale reads: {stale}")
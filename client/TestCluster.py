@@ -0,0 +1,310 @@
+# TestCluster
+
+import os
+import sys
+import json
+import time
+import shlex
+import random
+import socket
+import argparse
+import tempfile
+import threading
+import subprocess
+import contextlib
+import multiprocessing
+from bisect import bisect_left
+from itertools import accumulate
+from concurrent.futures import wait, FIRST_COMPLETED
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from SpreadSheetClient import SpreadSheetClient, TIMEOUT
+
+SERVER      = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "server", "SpreadSheetServer.py")
+PROJECT     = "bench"
+NODES       = 4
+KEY_BITS    = 16
+JOIN_WAIT   = 10        # sec a started node (each of its virtual nodes) may take to register
+JOIN_GAP    = 1.5       # sec between a node registering and the next one starting (joins go one at a time)
+SETTLE      = 3         # sec between the last join and the load
+KEYS        = 10000
+READ_RATIO  = 0.9
+VALUE_SIZE  = 64
+CLIENTS     = 4         # client processes
+CONCURRENCY = 16        # requests in flight per client (closed loop)
+DURATION    = 10        # sec of load
+PRELOAD_BATCH = 1000    # keys inserted per gather before the load
+
+class NameServer:
+    """ NameServer: local stand-in for catalog.cse.nd.edu: udp registrations in, GET /query.json out, both on one port number """
+    def __init__(self, host="127.0.0.1"):
+        self.services = {}      # {(name, port): registration}
+        self.lock = threading.Lock()
+        services, lock = self.services, self.lock
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if not self.path.startswith("/query.json"):
+                    self.send_error(404)
+                    return
+                with lock:
+                    body = json.dumps(list(services.values())).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.http = ThreadingHTTPServer((host, 0), Handler)
+        self.address = self.http.server_address
+        self.udp = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.udp.bind(self.address)
+        threading.Thread(target=self.http.serve_forever, daemon=True).start()
+        threading.Thread(target=self._receive, daemon=True).start()
+
+    def _receive(self):
+        """ registrations: the catalog names a service after the host it heard from """
+        while True:
+            data, addr = self.udp.recvfrom(65536)
+            try:
+                service = json.loads(data)
+            except ValueError:
+                continue
+            service["name"] = addr[0]
+            service["lastheardfrom"] = time.time()
+            with self.lock:
+                self.services[(addr[0], service.get("port"))] = service
+
+    def registered(self, project):
+        with self.lock:
+            return [service for service in self.services.values() if service.get("project") == project]
+
+    def members(self, project):
+        """ names the ring members of project registered under: {project}_{ring id} """
+        with self.lock:
+            return {service.get("project") for service in self.services.values() if str(service.get("project")).startswith(f"{project}_")}
+
+    def close(self):
+        self.http.shutdown()
+        self.udp.close()
+
+
+vnodes_parser = argparse.ArgumentParser(add_help=False)     # the one server option start_cluster needs: how many members a server adds
+vnodes_parser.add_argument("--vnodes", type=int, default=1)
+
+def start_cluster(name_server, nodes, key_bits, server_args, directory):
+    """ start nodes servers at evenly spaced ids, one after another, in directory (their logs and files) (returns their processes);
+        a server is up once each of its virtual nodes registered: they do under ids hashed from node_id, any new member is its """
+    options, _ = vnodes_parser.parse_known_args(server_args)
+    processes = []
+    for i in range(nodes):
+        node_id = i * 2 ** key_bits // nodes
+        log = open(os.path.join(directory, f"{node_id}.log"), "w")
+        members = name_server.members(PROJECT)
+        process = subprocess.Popen([sys.executable, "-u", os.path.abspath(SERVER), PROJECT, str(node_id), "--key-bits", str(key_bits),
+                                    "--name-server", "%s:%s" % name_server.address, *server_args],
+                                   cwd=directory, stdout=log, stderr=subprocess.STDOUT)
+        processes.append(process)
+        deadline = time.time() + JOIN_WAIT * options.vnodes
+        while len(name_server.members(PROJECT) - members) < options.vnodes:
+            if process.poll() is not None or time.time() > deadline:
+                stop_cluster(processes)
+                raise RuntimeError(f"node {node_id} did not start, see {log.name}")
+            time.sleep(0.1)
+        time.sleep(JOIN_GAP)
+    time.sleep(SETTLE)
+    return processes
+
+def stop_cluster(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+class KeyChooser:
+    """ KeyChooser: keys 0..keys-1, uniform, or Zipf distributed with exponent skew (key 0 the hottest) """
+    def __init__(self, keys, skew, rng):
+        self.keys = keys
+        self.rng = rng
+        self.cdf = list(accumulate(1 / (rank + 1) ** skew for rank in range(keys))) if skew > 0 else None
+
+    def next(self):
+        if self.cdf is None:
+            return self.rng.randrange(self.keys)
+        return min(self.keys - 1, bisect_left(self.cdf, self.rng.random() * self.cdf[-1]))
+
+
+def connect(config, window):
+    with contextlib.redirect_stdout(sys.stderr):    # the client prints where it connects; stdout is the report
+        return SpreadSheetClient(config["project"], window=window, name_server=tuple(config["name_server"]))
+
+def preload(config):
+    """ insert every key once, so reads find them """
+    client = connect(config, 64)
+    value = {"data": "x" * config["value_size"]}
+    for start in range(0, config["keys"], PRELOAD_BATCH):
+        client.gather([client.insert_async(key, value) for key in range(start, min(start + PRELOAD_BATCH, config["keys"]))], timeout=60)
+
+def run_client(config, index, ready, results):
+    """ one client process: closed loop with config["concurrency"] requests in flight, or open loop at its share of config["rate"];
+        latencies of an open loop count from when each request was due, not from when it could be sent """
+    rng = random.Random(config["seed"] + index)
+    chooser = KeyChooser(config["keys"], config["zipf"], rng)
+    value = {"data": "x" * config["value_size"]}
+    rate = config["rate"] / config["clients"]
+    client = connect(config, config["concurrency"] if not rate else 64)
+    latencies = {"read": [], "write": []}
+    errors = {"read": 0, "write": 0}
+    finished = [0]
+
+    def issue(due):
+        key = chooser.next()
+        op = "read" if rng.random() < config["read_ratio"] else "write"
+        future = client.lookup_async(key) if op == "read" else client.insert_async(key, value)
+
+        def done(future):
+            now = time.perf_counter()
+            try:
+                ok = future.result()["status"] == "success"
+            except Exception:
+                ok = False
+            if ok:
+                latencies[op].append(now - due)
+            else:
+                errors[op] += 1
+            finished[0] = max(finished[0], now)
+        future.add_done_callback(done)
+        return future
+
+    ready.wait()
+    start = time.perf_counter()
+    end = start + config["duration"]
+    inflight = set()
+    if rate:
+        due = start
+        while due < end:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            inflight.add(issue(due))
+            due += rng.expovariate(rate)
+    else:
+        while time.perf_counter() < end:
+            while len(inflight) < config["concurrency"]:
+                inflight.add(issue(time.perf_counter()))
+            done, inflight = wait(inflight, return_when=FIRST_COMPLETED)
+    wait(inflight, timeout=TIMEOUT)
+    time.sleep(0.01)    # the last callbacks run on the reader thread
+    results.put({"latencies": latencies, "errors": errors, "elapsed": max(finished[0], end) - start})
+
+
+def percentiles(latencies):
+    """ {"p50", "p99", "p999", "mean", "max"} in ms """
+    if not latencies:
+        return None
+    latencies = sorted(latencies)
+    at = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000
+    return {"p50": at(0.5), "p99": at(0.99), "p999": at(0.999), "mean": sum(latencies) / len(latencies) * 1000, "max": latencies[-1] * 1000}
+
+def commit():
+    """ (short commit hash, uncommitted changes) of the tree the servers run from """
+    root = os.path.dirname(os.path.abspath(SERVER))
+    try:
+        head = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True).stdout.strip())
+        return head, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+def benchmark(config):
+    """ run the workload (returns the report) """
+    context = multiprocessing.get_context("spawn")     # the parent runs threads (the name server): don't fork it
+    ready = context.Barrier(config["clients"])
+    results = context.Queue()
+    processes = [context.Process(target=run_client, args=(config, i, ready, results)) for i in range(config["clients"])]
+    for process in processes:
+        process.start()
+    parts = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+
+    latencies = {op: [latency for part in parts for latency in part["latencies"][op]] for op in ("read", "write")}
+    ops = sum(len(values) for values in latencies.values())
+    elapsed = max(part["elapsed"] for part in parts)
+    head, dirty = commit()
+    return {"commit": head, "dirty": dirty, "time": time.strftime("%Y-%m-%dT%H:%M:%S"), "config": config,
+            "throughput": ops / elapsed, "ops": ops, "errors": sum(part["errors"][op] for part in parts for op in ("read", "write")),
+            "elapsed": elapsed,
+            "latency_ms": {"all": percentiles(latencies["read"] + latencies["write"]), "read": percentiles(latencies["read"]),
+                           "write": percentiles(latencies["write"])}}
+
+def compare(old, new):
+    """ text table of new against an earlier report (throughput: higher is better, latencies: lower) """
+    rows = [("throughput", old["throughput"], new["throughput"])]
+    for op in ("all", "read", "write"):
+        for name in ("p50", "p99", "p999"):
+            if old["latency_ms"].get(op) and new["latency_ms"].get(op):
+                rows.append((f"{op} {name} ms", old["latency_ms"][op][name], new["latency_ms"][op][name]))
+    lines = [f"{'':16}{old['commit'] or '?':>12}{new['commit'] or '?':>12}{'change':>10}"]
+    for name, before, after in rows:
+        lines.append(f"{name:16}{before:12.3f}{after:12.3f}{(after / before - 1) * 100 if before else 0:+9.1f}%")
+    changed = sorted(key for key in set(old["config"]) | set(new["config"]) if old["config"].get(key) != new["config"].get(key) and key != "name_server")
+    if changed:
+        lines.append(f"config differs: {', '.join(changed)}")
+    return "\n".join(lines)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="start a local ring with its own name server, drive a workload at it and report json")
+    parser.add_argument("--nodes", type=int, default=NODES, help=f"servers to start (default {NODES})")
+    parser.add_argument("--server-args", default="", help="extra options for every server, e.g. \"--workers 2 --durability group\"")
+    parser.add_argument("--key-bits", type=int, default=KEY_BITS, help=f"identifier space of the ring (default {KEY_BITS})")
+    parser.add_argument("--name-server", default=None, help="host:port of a running ring's name server: drive that ring instead of starting one")
+    parser.add_argument("--project", default=PROJECT, help=f"project of the running ring (with --name-server, default {PROJECT})")
+    parser.add_argument("--keys", type=int, default=KEYS, help=f"key space, preloaded before the load (default {KEYS})")
+    parser.add_argument("--read-ratio", type=float, default=READ_RATIO, help=f"share of lookups, the rest inserts (default {READ_RATIO})")
+    parser.add_argument("--zipf", type=float, default=0, help="Zipf exponent of the key popularity, e.g. 0.99 (default 0: uniform)")
+    parser.add_argument("--value-size", type=int, default=VALUE_SIZE, help=f"bytes of every value (default {VALUE_SIZE})")
+    parser.add_argument("--clients", type=int, default=CLIENTS, help=f"client processes (default {CLIENTS})")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help=f"requests in flight per client, closed loop (default {CONCURRENCY})")
+    parser.add_argument("--rate", type=float, default=0, help="open loop: total requests/sec, Poisson arrivals (default 0: closed loop)")
+    parser.add_argument("--duration", type=float, default=DURATION, help=f"sec of load (default {DURATION})")
+    parser.add_argument("--seed", type=int, default=0, help="random seed of the workload (default 0)")
+    parser.add_argument("--out", default=None, help="also write the report to this file")
+    parser.add_argument("--compare", default=None, help="report of an earlier run (e.g. another commit) to compare with, on stderr")
+    args = parser.parse_args()
+    if not 0 <= args.read_ratio <= 1:
+        parser.error("--read-ratio must be within [0, 1]")
+
+    config = {"nodes": args.nodes, "server_args": args.server_args, "key_bits": args.key_bits, "keys": args.keys, "read_ratio": args.read_ratio,
+              "zipf": args.zipf, "value_size": args.value_size, "clients": args.clients, "concurrency": args.concurrency, "rate": args.rate,
+              "duration": args.duration, "seed": args.seed, "project": args.project}
+    name_server, processes = None, []
+    if args.name_server:
+        host, _, port = args.name_server.rpartition(":")
+        config["name_server"] = [host, int(port)]
+        config["nodes"] = config["server_args"] = None
+    else:
+        name_server = NameServer()
+        directory = tempfile.mkdtemp(prefix="p2p-cluster-")
+        print(f"starting {args.nodes} nodes, logs in {directory}", file=sys.stderr)
+        processes = start_cluster(name_server, args.nodes, args.key_bits, shlex.split(args.server_args), directory)
+        config["name_server"] = list(name_server.address)
+        config["project"] = PROJECT
+    try:
+        preload(config)
+        report = benchmark(config)
+    finally:
+        stop_cluster(processes)
+        if name_server:
+            name_server.close()
+
+    print(json.dumps(report, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print(compare(json.load(f), report), file=sys.stderr)
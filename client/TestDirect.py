@@ -0,0 +1,39 @@
+# TestDirect
+
+import sys
+import time
+from SpreadSheetClient import SpreadSheetClient
+import random
+
+FINGER_NUM  = 16
+MAX_KEY     = 2 ** FINGER_NUM
+ITERATIONS  = 1000
+
+def measure(client, operation, *args):
+    start = time.time()
+    result = operation(*args)
+    end = time.time()
+    return result, end - start
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 TestDirect.py <project_name>")
+        sys.exit(1)
+    project_name = sys.argv[1]
+    testList = random.sample(range(MAX_KEY), ITERATIONS)
+
+    # same keys through the entry node (finger table routing) and straight to the owner (ring cache)
+    for direct in (False, True):
+        client = SpreadSheetClient(project_name, direct=direct)
+        total_insert_time = 0
+        for i in testList:
+            result, duration = measure(client, client.insert, i, {"value": i})
+            total_insert_time += duration
+        total_lookup_time = 0
+        for i in testList:
+            result, duration = measure(client, client.lookup, i)
+            total_lookup_time += duration
+
+        print("direct (ring cache)" if direct else "routed (entry node)")
+        print(f"insert\tthroughput: {ITERATIONS / total_insert_time:4.6f}\tops/sec\tlatency: {total_insert_time / ITERATIONS:.6f} sec")
+        print(f"lookup\tthroughput: {ITERATIONS / total_lookup_time:4.6f}\tops/sec\tlatency: {total_lookup_time / ITERATIONS:.6f} sec")
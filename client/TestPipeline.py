@@ -0,0 +1,36 @@
+# TestPipeline
+
+import sys
+import time
+from SpreadSheetClient import SpreadSheetClient
+import random
+
+FINGER_NUM  = 16
+MAX_KEY     = 2 ** FINGER_NUM
+ITERATIONS  = 1000
+WINDOWS     = [1, 4, 16, 64]
+
+def measure(client, operation, keys):
+    start = time.time()
+    results = client.gather([operation(*args) for args in keys], timeout=60)
+    end = time.time()
+    return results, end - start
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 TestPipeline.py <project_name>")
+        sys.exit(1)
+    project_name = sys.argv[1]
+
+    for window in WINDOWS:
+        client = SpreadSheetClient(project_name, window=window)
+        testList = random.sample(range(MAX_KEY), ITERATIONS)
+
+        _, insert_time = measure(client, client.insert_async, [(i, {"value": i}) for i in testList])
+        _, lookup_time = measure(client, client.lookup_async, [(i,) for i in testList])
+        _, remove_time = measure(client, client.remove_async, [(i,) for i in testList])
+
+        print(f"window {window}")
+        print(f"insert\tthroughput: {ITERATIONS / insert_time:4.6f}\tops/sec")
+        print(f"lookup\tthroughput: {ITERATIONS / lookup_time:4.6f}\tops/sec")
+        print(f"remove\tthroughput: {ITERATIONS / remove_time:4.6f}\tops/sec")
@@ -0,0 +1,34 @@
+# TestProtocol
+
+import sys
+import time
+import random
+from SpreadSheetClient import SpreadSheetClient
+
+FINGER_NUM  = 16
+MAX_KEY     = 2 ** FINGER_NUM
+ITERATIONS  = 2000
+VALUE_SIZES = [16, 4096]
+
+def measure(client, operation, args):
+    """ ops/sec of pipelined operation calls """
+    start = time.time()
+    client.gather([operation(*arg) for arg in args], timeout=60)
+    return len(args) / (time.time() - start)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 TestProtocol.py <project_name>")
+        sys.exit(1)
+    project_name = sys.argv[1]
+
+    # the client's frames to its entry node; nodes pick their own with --protocol (restart them with json to compare the ring too)
+    for value_size in VALUE_SIZES:
+        for protocol in ("json", "binary"):
+            client = SpreadSheetClient(project_name, protocol=protocol)
+            keys = random.sample(range(MAX_KEY), ITERATIONS)
+            value = {"data": "x" * value_size}
+            insert = measure(client, client.insert_async, [(key, value) for key in keys])
+            lookup = measure(client, client.lookup_async, [(key,) for key in keys])
+            client.gather([client.remove_async(key) for key in keys], timeout=60)
+            print(f"{protocol:6}\tvalue: {value_size:5d} B\tinsert: {insert:10.2f} ops/sec\tlookup: {lookup:10.2f} ops/sec")
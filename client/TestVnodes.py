@@ -0,0 +1,50 @@
+# TestVnodes
+
+import sys
+import tempfile
+import contextlib
+from SpreadSheetClient import SpreadSheetClient
+from TestCluster import NameServer, PROJECT, KEY_BITS, start_cluster, stop_cluster
+
+NODES   = 2         # server processes
+VNODES  = 2         # ring members each of them hosts
+KEYS    = 2000
+
+def check(client, keys):
+    """ failures of inserts, lookups, removes and a full range scan over keys 0..keys-1 (int and "user:<i>" keys) on the ring """
+    failures = []
+    names = [key for i in range(keys) for key in (i, f"user:{i}")]
+    answers = client.gather([client.insert_async(key, {"key": key}) for key in names], timeout=60)
+    failures += [f"insert {key}: {answer}" for key, answer in zip(names, answers) if not answer or answer["status"] != "success"]
+    answers = client.gather([client.lookup_async(key) for key in names], timeout=60)
+    failures += [f"lookup {key}: {answer}" for key, answer in zip(names, answers) if not answer or answer.get("value") != {"key": key}]
+    removed = names[::2]
+    answers = client.gather([client.remove_async(key) for key in removed], timeout=60)
+    failures += [f"remove {key}: {answer}" for key, answer in zip(removed, answers) if not answer or answer["status"] != "success"]
+    answers = client.gather([client.lookup_async(key) for key in removed], timeout=60)
+    failures += [f"lookup removed {key}: {answer}" for key, answer in zip(removed, answers) if not answer or answer["status"] != "failure"]
+    scan = client.range_lookup(0, 2 ** KEY_BITS)
+    found = sorted(str(key) for key, _ in scan["items"]) if scan else None
+    if found != sorted(str(key) for key in names[1::2]):
+        failures.append(f"range scan: {len(found) if found else found} keys, {len(names) // 2} expected")
+    return failures
+
+if __name__ == "__main__":
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+    name_server = NameServer()
+    directory = tempfile.mkdtemp(prefix="p2p-vnodes-")
+    print(f"starting {NODES} nodes with {VNODES} virtual nodes each, logs in {directory}")
+    processes = start_cluster(name_server, NODES, KEY_BITS, ["--vnodes", str(VNODES)], directory)
+    try:
+        print(f"ring members: {sorted(name_server.members(PROJECT))}")
+        with contextlib.redirect_stdout(sys.stderr):
+            client = SpreadSheetClient(PROJECT, name_server=name_server.address)
+        failures = check(client, keys)
+    finally:
+        stop_cluster(processes)
+        name_server.close()
+
+    for failure in failures[:10]:
+        print(failure)
+    print(f"{2 * keys} keys: {len(failures)} failures")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,44 @@
+# TestWorkers
+
+import sys
+import time
+import random
+import multiprocessing
+from SpreadSheetClient import SpreadSheetClient
+
+FINGER_NUM  = 16
+MAX_KEY     = 2 ** FINGER_NUM
+ITERATIONS  = 2000      # operations per client process
+CLIENTS     = 8         # client processes: one python client can't load more than a core's worth of node
+
+def run_client(project_name, start, results):
+    """ one client process: pipelined inserts then lookups of its own keys, from the same start time as the others """
+    client = SpreadSheetClient(project_name)
+    keys = random.sample(range(MAX_KEY), ITERATIONS)
+    start.wait()
+    begin = time.time()
+    client.gather([client.insert_async(key, {"value": key}) for key in keys], timeout=120)
+    middle = time.time()
+    client.gather([client.lookup_async(key) for key in keys], timeout=120)
+    results.put((begin, middle, time.time()))
+    client.gather([client.remove_async(key) for key in keys], timeout=120)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: python3 TestWorkers.py <project_name> [clients]")
+        sys.exit(1)
+    project_name = sys.argv[1]
+    clients = int(sys.argv[2]) if len(sys.argv) > 2 else CLIENTS
+
+    # aggregate throughput of the ring: run it against one node started with --workers 1, 2, 4, ... to see it scale
+    start = multiprocessing.Barrier(clients)
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_client, args=(project_name, start, results)) for _ in range(clients)]
+    for process in processes:
+        process.start()
+    times = [results.get() for _ in processes]
+    for process in processes:
+        process.join()
+    inserts = clients * ITERATIONS / (max(middle for _, middle, _ in times) - min(begin for begin, _, _ in times))
+    lookups = clients * ITERATIONS / (max(end for _, _, end in times) - min(middle for _, middle, _ in times))
+    print(f"clients: {clients}\tinsert: {inserts:10.2f} ops/sec\tlookup: {lookups:10.2f} ops/sec")
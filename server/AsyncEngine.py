@@ -0,0 +1,265 @@
+# AsyncEngine
+
+import socket
+import time
+import threading
+import asyncio
+from PeerPool import PeerPool
+from FrameReader import FrameReader, RECV_SIZE
+from SendQueue import SEND_LIMIT
+from Codec import loads
+import SpreadSheetServer as sss
+
+STREAM_LIMIT    = 2 ** 24   # bytes a stream reader buffers before it stops reading the socket
+
+class StreamConnection:
+    """ StreamConnection: an asyncio stream pair standing in for a socket, so handle_request can stay engine-agnostic """
+    def __init__(self, server, host=None, port=None, reader=None, writer=None):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.backlog = []           # frames sent while the connection is still opening
+        self.closing = False
+        self.closed = False
+        self.accepted = writer is not None
+        if writer is None:          # outgoing: connect in the background, never block the loop
+            self.addr = (host, port)
+            self.task = asyncio.ensure_future(self._open())
+        else:                       # accepted
+            self.addr = writer.get_extra_info("peername")
+            self._nodelay()
+            writer.transport.set_write_buffer_limits(high=SEND_LIMIT)   # the select loop's backpressure limit
+            self.task = asyncio.ensure_future(self._serve())
+        server.client_sockets[self] = self.addr
+
+    async def _open(self):
+        try:
+            self.reader, self.writer = await asyncio.open_connection(self.addr[0], self.addr[1], limit=STREAM_LIMIT)
+        except OSError as e:
+            self.server.log.warning("connecting to %s failed: %s", self.addr, e)
+            self._lost()
+            return
+        self._nodelay()
+        for data in self.backlog:
+            self.writer.write(data)
+        self.backlog = None
+        if self.closing:
+            self.writer.close()
+            self._lost()
+            return
+        await self._serve()
+
+    def _nodelay(self):
+        """ small frames (replies, invalidations) go out at once instead of waiting for the previous one's ack """
+        self.writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    async def _serve(self):
+        """ reader task: one per connection """
+        frames = FrameReader()      # json and binary frames alike, sliced out of what the stream hands us
+        try:
+            while True:
+                data = await self.reader.read(RECV_SIZE)
+                if not data:
+                    break
+                frames.feed(data)
+                self.server.metrics.bytes_in += len(data)
+                while (frame := frames.next_frame()) is not None and not self.closed:
+                    self.server.handle_frame(self, frame)
+                if self.accepted and self.writer.transport.get_write_buffer_size() >= SEND_LIMIT:
+                    await self.writer.drain()   # backpressure: no more requests read until the other end reads our answers
+        except (ConnectionError, ValueError) as e:
+            self.server.log.info("%s disconnected unexpectedly: %s", self.addr, e)
+        finally:
+            self._lost()
+
+    def _lost(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.writer:
+            self.writer.close()
+        self.server.connection_lost(self)
+
+    def sendall(self, data):
+        """ queue data on the transport (never blocks) """
+        if self.closed or self.closing:
+            raise BrokenPipeError("connection closed")
+        if self.writer is None:
+            self.backlog.append(data)
+        else:
+            self.writer.write(data)
+
+    def sendmsg(self, buffers):
+        """ queue buffers on the transport as one write (returns their size) """
+        if self.closed or self.closing:
+            raise BrokenPipeError("connection closed")
+        if self.writer is None:
+            self.backlog.append(b"".join(buffers))
+        else:
+            self.writer.writelines(buffers)
+        return sum(len(buffer) for buffer in buffers)
+
+    def close(self):
+        """ close once everything queued so far is flushed """
+        if self.writer is None:
+            self.closing = True
+        elif not self.closed:
+            self._lost()
+
+
+class AsyncSpreadSheetServer(sss.SpreadSheetServer):
+    """ AsyncSpreadSheetServer: same protocol as SpreadSheetServer, driven by asyncio streams """
+    commit_handle = None    # pending call_later of the next group commit
+    expiry_handle = None    # pending call_later of the next overdue forward, and its loop time
+    expiry_at = None
+
+    def _connect(self, host, port):
+        """ open an outgoing connection to a peer (returns immediately, frames are queued until connected) """
+        conn = StreamConnection(self, host, port)
+        self._hello(conn)
+        return conn
+
+    def _join(self, entry=None):
+        """ the name server query and the connects that find an entry node would block the loop: they run in the executor """
+        if entry is not None:
+            self._join_through(entry)
+            return
+        lookup = asyncio.get_running_loop().run_in_executor(None, self._find_entry)
+        lookup.add_done_callback(lambda lookup: self._join_through(lookup.result()))
+
+    def _send(self, conn, buffers):
+        """ the transport queues and coalesces the frames itself """
+        self.metrics.sent(conn.sendmsg(buffers))
+
+    def handle_frame(self, conn, data):
+        """ handle one frame received on conn """
+        self.pool.seen(conn)
+        start = time.perf_counter()
+        header = self.relay(conn, data)
+        if header is not None:      # only routed through us: passed on from its header
+            self.metrics.handled(header, time.perf_counter() - start)
+            self._schedule_expiry()
+            return
+        try:
+            request = loads(data, raw=True)
+        except ValueError:
+            self.log.warning("received a malformed frame from %s", self.client_sockets.get(conn))
+            return
+        if sss.traced(self.log):
+            self.log.log(sss.TRACE, "%s %s", self.client_sockets.get(conn), request)
+        start = time.perf_counter()
+        response = self.handle_request(request, conn)
+        self.metrics.handled(request, time.perf_counter() - start)
+        if response:
+            self.send_message(conn, response)
+        self._schedule_commit()
+        self._schedule_expiry()
+
+    def _schedule_commit(self):
+        """ group commit: one sync for every write handled until it is due """
+        timeout = self.spreadsheet.sync_timeout()
+        if timeout is None:
+            return
+        if timeout == 0:
+            self.commit()
+        elif self.commit_handle is None:
+            self.commit_handle = asyncio.get_running_loop().call_later(timeout, self._commit_due)
+
+    def _commit_due(self):
+        """ the group commit timer fired """
+        self.commit_handle = None
+        self.commit()
+        self._schedule_commit()
+
+    def _schedule_expiry(self):
+        """ wake up when the next forwarded request is overdue """
+        timeout = self.forward_timeout()
+        if timeout is None:
+            return
+        loop = asyncio.get_running_loop()
+        at = loop.time() + timeout
+        if self.expiry_handle is not None:
+            if self.expiry_at <= at:
+                return
+            self.expiry_handle.cancel()
+        self.expiry_handle, self.expiry_at = loop.call_at(at, self._expiry_due), at
+
+    def _expiry_due(self):
+        """ the forward deadline timer fired """
+        self.expiry_handle = None
+        self.expire_forwards()
+        self._schedule_expiry()
+
+    def connection_lost(self, conn):
+        """ a connection went away: same bookkeeping as the select loop's socket checks """
+        self.client_sockets.pop(conn, None)
+        self.binary.discard(conn)
+        self.pool.lost(conn)
+        if self.successor and self.successor.socket is conn:
+            self.log.warning("successor socket is invalid or closed")
+            self.successor.socket = None
+        if self.predecessor and self.predecessor.socket is conn:
+            self.log.warning("predecessor socket is invalid or closed")
+            self.predecessor.socket = None
+            self.handle_pred_failure()
+        for i, row in enumerate(self.finger_table):
+            if row[-1] is conn and row[1] != self.node_id:
+                self.log.warning("finger table socket (%s) is invalid or closed", row[1])
+                self.finger_table.reset(i)
+
+
+
+async def heartbeat_loop(servers, pool):
+    """ heartbeat idle peers, drop the ones that went silent """
+    while True:
+        await asyncio.sleep(pool.heartbeat_interval / 2)
+        for server in servers:
+            pool.watch(server.predecessor.socket if server.predecessor else None)
+        for conn in pool.tick(servers[0].send_heartbeat):
+            conn.server.log.warning("%s stopped answering heartbeats", conn.addr)
+            conn.close()
+        for server in servers:
+            server.tick()
+
+
+async def start_vnode(project_name, vnode_id, host, replication, spreadsheet, pool, entry, cache_size=sss.CACHE_SIZE, worker=None):
+    """ listen and join the ring as one virtual node, on the node's client port too for one of its workers (returns the server) """
+    server = None
+
+    async def accept(reader, writer):
+        conn = StreamConnection(server, reader=reader, writer=writer)
+        server.log.info("new connection from %s", conn.addr)
+
+    master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)     # same listening socket as start_server
+    master_socket.bind(('', 0))
+    server = AsyncSpreadSheetServer(project_name, vnode_id, host, master_socket.getsockname()[1], replication, spreadsheet, pool, entry, cache_size)
+    server.masters = [await asyncio.start_server(accept, sock=master_socket, limit=STREAM_LIMIT)]
+    if worker:
+        server.worker = worker
+        server.masters.append(await asyncio.start_server(accept, sock=worker.listener(), limit=STREAM_LIMIT))
+    server.log.info("listening on port %s", server.port)
+    # Background threads
+    threading.Thread(target=sss.register_name_server, args=(server.port, server.project_name), daemon=True).start()
+    return server
+
+
+async def start_async_server(project_name, node_id, replication=sss.REPLICATION, vnodes=sss.VNODES, cache_size=sss.CACHE_SIZE, metrics_port=None, worker=None, **sheet_options):
+    """ asyncio counterpart of start_server """
+    host = socket.getfqdn()
+    sheets = sss.vnode_sheets(node_id, vnodes, **sheet_options)
+    pool = PeerPool(lambda local, host, port: local._connect(host, port))   # shared by the virtual nodes
+    servers = []
+    heartbeats = asyncio.ensure_future(heartbeat_loop(servers, pool))
+    if metrics_port:
+        sss.serve_metrics(metrics_port, servers)
+
+    # virtual nodes join one at a time, through the first one
+    for vnode_id, spreadsheet in zip(sss.vnode_ids(node_id, vnodes), sheets):
+        while servers and not sss.vnode_settled(servers[-1]):
+            await asyncio.sleep(0.1)
+        if servers:
+            servers.append(await start_vnode(project_name, vnode_id, host, replication, spreadsheet, pool, (host, servers[0].port), cache_size))
+        else:
+            servers.append(await start_vnode(project_name, vnode_id, host, replication, spreadsheet, pool, worker.entry() if worker else None, cache_size, worker))
+
+    await asyncio.gather(*(master.serve_forever() for server in servers for master in server.masters))
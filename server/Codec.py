@@ -0,0 +1,203 @@
+# Codec
+
+import json
+import struct
+from json.encoder import c_make_encoder, encode_basestring_ascii
+
+# frames are newline-delimited json, or binary once both ends said "hello" with "binary" (either kind may follow the other on a stream):
+#   MAGIC, 4-byte length of the rest, HEADER, msg_id, key text, value, body (json object of every other entry)
+# the header has what routing looks at, so a node passing a frame on needs nothing after it; the value is its json text as storage
+# keeps it (SpreadSheet.py), which nodes store and send back as is (a RawValue) and only the client parses
+MAGIC       = 0xB5      # first byte of a binary frame; a json frame starts with "{"
+MAGIC_BYTE  = bytes([MAGIC])
+PREFIX      = struct.Struct("!BI")
+HEADER      = struct.Struct("!BBHBBHIqq")   # method, status, flags, hops, msg_id length, key text length, value length, int key, version
+FRAME_HEAD  = struct.Struct("!BIBBHBBHIqq") # both, packed at once
+
+# wire codes, never reorder (append only): 0 means none, or a name missing here that then travels in the body
+METHODS     = ("insert", "lookup", "remove", "insert_replication", "remove_replication", "replicaLookup",
+               "multi_insert", "multi_lookup", "multi_remove", "multi_insert_replication", "multi_remove_replication",
+               "invalidate", "range_lookup", "join", "takeover", "flag", "imYourUpdatedPred", "imYourPred",
+               "readyForDataTransfer", "transferBatch", "transferAck", "syncBuckets", "syncKeys", "syncRepair",
+               "getSuccessors", "successors", "yourNewSucc", "establishChord", "imPointingAtYou", "imNotPointingAtYou",
+               "chordEstablishmentCompleted", "newNode", "updatePFT", "updatePPT", "ringView", "stats",
+               "heartbeat", "heartbeatAck", "askForFT", "hello")
+STATUSES    = ("success", "failure")
+METHOD_CODES = {method: code for code, method in enumerate(METHODS, 1)}
+STATUS_CODES = {status: code for code, status in enumerate(STATUSES, 1)}
+
+FLAG_MSG_ID  = 1        # msg_id is set (else: none, or not a str and in the body)
+FLAG_INT_KEY = 2        # key is the header's int
+FLAG_STR_KEY = 4        # key is the key text
+FLAG_HOPS    = 8        # hops is the header's count
+FLAG_VERSION = 16       # version is the header's
+FLAG_VALUE   = 512      # value is the value field
+TRUE_FLAGS   = {"lease": 32, "more": 64, "direct": 128, "replica": 256}    # entries set to true, by a flag each
+INT_MIN, INT_MAX = -2 ** 63, 2 ** 63 - 1
+
+encode_json = json.JSONEncoder(separators=(",", ":")).encode
+decode_json = json.JSONDecoder().decode
+encode_value = json.JSONEncoder().encode    # default separators: the text SpreadSheet stores, whichever way a value came
+if c_make_encoder is not None:
+    # the C encoders JSONEncoder.encode builds on every call, built once (a cyclic value fails on recursion depth instead)
+    iterencode_json = c_make_encoder(None, json.JSONEncoder().default, encode_basestring_ascii, None, ":", ",", False, False, True)
+    iterencode_value = c_make_encoder(None, json.JSONEncoder().default, encode_basestring_ascii, None, ": ", ", ", False, False, True)
+    def encode_json(message):
+        return "".join(iterencode_json(message, 0))
+    def encode_value(value):
+        return "".join(iterencode_value(value, 0))
+
+class RawValue(bytes):
+    """ a value as its json text (utf-8), passed on unparsed """
+
+def encode(message):
+    """ binary frame of a message """
+    body = dict(message)        # what is left of it once the header took its share
+    method = METHOD_CODES.get(body.pop("method", None), 0)
+    if not method and "method" in message:
+        body["method"] = message["method"]
+    status = STATUS_CODES.get(body.pop("status", None), 0)
+    if not status and "status" in message:
+        body["status"] = message["status"]
+    flags = hops = int_key = version = 0
+    msg_id = key_text = b""
+
+    value = body.get("msg_id")
+    if type(value) is str:
+        msg_id = value.encode("utf-8", "surrogateescape")
+        if len(msg_id) < 256:       # the header counts bytes, not characters
+            flags |= FLAG_MSG_ID
+            del body["msg_id"]
+        else:                       # too long for the header: it travels in the body
+            msg_id = b""
+    value = body.get("key")
+    if type(value) is int and INT_MIN <= value <= INT_MAX:
+        int_key = value
+        flags |= FLAG_INT_KEY
+        del body["key"]
+    elif type(value) is str:
+        key_text = value.encode("utf-8", "surrogateescape")
+        if len(key_text) < 65536:
+            flags |= FLAG_STR_KEY
+            del body["key"]
+        else:
+            key_text = b""
+    value = body.get("hops")
+    if type(value) is int and 0 <= value < 256:
+        hops = value
+        flags |= FLAG_HOPS
+        del body["hops"]
+    value = body.get("version")
+    if type(value) is int and INT_MIN <= value <= INT_MAX:
+        version = value
+        flags |= FLAG_VERSION
+        del body["version"]
+    if TRUE_FLAGS.keys() & body.keys():
+        for name, flag in TRUE_FLAGS.items():
+            if body.get(name) is True:
+                flags |= flag
+                del body[name]
+    value = b""
+    if "value" in body:
+        value = body.pop("value")
+        if type(value) is not RawValue:
+            value = encode_value(value).encode("utf-8")
+        flags |= FLAG_VALUE
+
+    body = encode_json(body).encode("utf-8") if body else b""
+    return b"".join((FRAME_HEAD.pack(MAGIC, HEADER.size + len(msg_id) + len(key_text) + len(value) + len(body), method, status, flags,
+                                     hops, len(msg_id), len(key_text), len(value), int_key, version), msg_id, key_text, value, body))
+
+def decode(frame, raw=False):
+    """ message of a binary frame (raises ValueError if malformed); raw: its value left a RawValue, for a node that only stores it
+        or passes it on """
+    try:
+        method, status, flags, hops, id_length, key_length, value_length, int_key, version = HEADER.unpack_from(frame, PREFIX.size)
+    except struct.error as e:
+        raise ValueError(f"truncated frame: {e}") from None
+    pos = PREFIX.size + HEADER.size
+    value = pos + id_length + key_length
+    body = value + value_length
+    if body > len(frame) or method > len(METHODS) or status > len(STATUSES):
+        raise ValueError("malformed frame header")
+    message = decode_json(frame[body:].decode("utf-8")) if body < len(frame) else {}
+    if flags & FLAG_VALUE:
+        message["value"] = RawValue(frame[value:body]) if raw else decode_json(frame[value:body].decode("utf-8"))
+    if method:
+        message["method"] = METHODS[method - 1]
+    if status:
+        message["status"] = STATUSES[status - 1]
+    if flags & FLAG_MSG_ID:
+        message["msg_id"] = frame[pos:pos + id_length].decode("utf-8", "surrogateescape")
+    if flags & FLAG_INT_KEY:
+        message["key"] = int_key
+    elif flags & FLAG_STR_KEY:
+        message["key"] = frame[pos + id_length:value].decode("utf-8", "surrogateescape")
+    if flags & FLAG_HOPS:
+        message["hops"] = hops
+    if flags & FLAG_VERSION:
+        message["version"] = version
+    if flags >= TRUE_FLAGS["lease"]:
+        for name, flag in TRUE_FLAGS.items():
+            if flags & flag:
+                message[name] = True
+    return message
+
+def peek(frame):
+    """ routing header of a binary frame, its body left alone: {"method", "status", "msg_id", "key", "hops" and the flags' entries
+        that are set} (None: json, or malformed) """
+    if frame[:1] != MAGIC_BYTE or len(frame) < PREFIX.size + HEADER.size:
+        return None
+    method, status, flags, hops, id_length, key_length, value_length, int_key, version = HEADER.unpack_from(frame, PREFIX.size)
+    pos = PREFIX.size + HEADER.size
+    if pos + id_length + key_length + value_length > len(frame) or method > len(METHODS) or status > len(STATUSES):
+        return None
+    header = {}
+    if method:
+        header["method"] = METHODS[method - 1]
+    if status:
+        header["status"] = STATUSES[status - 1]
+    if flags & FLAG_MSG_ID:
+        header["msg_id"] = frame[pos:pos + id_length].decode("utf-8", "surrogateescape")
+    if flags & FLAG_INT_KEY:
+        header["key"] = int_key
+    elif flags & FLAG_STR_KEY:
+        header["key"] = frame[pos + id_length:pos + id_length + key_length].decode("utf-8", "surrogateescape")
+    if flags & FLAG_HOPS:
+        header["hops"] = hops
+    if flags >= TRUE_FLAGS["lease"]:
+        for name, flag in TRUE_FLAGS.items():
+            if flags & flag:
+                header[name] = True
+    return header
+
+def reframe(frame, msg_id=None, hops=None):
+    """ a binary frame with another msg_id and/or hops count, as buffers to send: a new head, and the key text, value and body of
+        frame passed on uncopied (a memoryview) """
+    method, status, flags, old_hops, id_length, key_length, value_length, int_key, version = HEADER.unpack_from(frame, PREFIX.size)
+    rest = memoryview(frame)[PREFIX.size + HEADER.size + id_length:]
+    if msg_id is None:
+        msg_id = bytes(frame[PREFIX.size + HEADER.size:PREFIX.size + HEADER.size + id_length])
+    else:
+        msg_id = msg_id.encode("utf-8", "surrogateescape")
+        flags |= FLAG_MSG_ID
+    if hops is None:
+        hops = old_hops
+    else:
+        flags |= FLAG_HOPS
+    return [FRAME_HEAD.pack(MAGIC, HEADER.size + len(msg_id) + len(rest), method, status, flags, hops, len(msg_id), key_length, value_length,
+                            int_key, version), msg_id, rest]
+
+def dumps(message, binary=False):
+    """ frame of a message, as sent on a connection: binary, or json and a newline """
+    if binary:
+        return encode(message)
+    if type(message.get("value")) is RawValue:
+        message = dict(message, value=decode_json(message["value"].decode("utf-8")))
+    return f'{json.dumps(message)}\n'.encode('utf-8')
+
+def loads(frame, raw=False):
+    """ message of a frame of either kind (raises ValueError if malformed; raw: see decode) """
+    if frame[:1] == MAGIC_BYTE:
+        return decode(frame, raw)
+    return json.loads(frame)
@@ -0,0 +1,76 @@
+# FingerTable
+
+from bisect import bisect_right
+
+class FingerTable:
+    """ FingerTable: finger rows [target_id, node_id, host, port, socket] with a sorted index of target ids """
+    def __init__(self, node_id, host, port, finger_num, max_key):
+        self.node_id = node_id
+        self.max_key = max_key
+        self.rows = [[(node_id + 2**i) % max_key, node_id, host, port, None] for i in range(finger_num)]
+        # target ids in ascending order (the rows' targets wrap past 0 at most once) and the row of each
+        self.order = sorted(range(finger_num), key=lambda i: self.rows[i][0])
+        self.starts = [self.rows[i][0] for i in self.order]
+        self.hops = None            # cached next-hop socket per sorted position, rebuilt after a row changes
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __iter__(self):
+        return iter(self.rows)
+
+    def __getitem__(self, i):
+        return self.rows[i]
+
+    def set(self, i, node_id, host, port, sock):
+        """ point row i at a node """
+        self.rows[i][1:] = node_id, host, port, sock
+        self.hops = None
+
+    def reset(self, i):
+        """ row i lost its connection """
+        self.rows[i][2:] = None, None, None
+        self.hops = None
+
+    def serialize(self):
+        """ rows without sockets (as sent in updatePFT / imYourUpdatedPred) """
+        return [row[:-1] for row in self.rows]
+
+    def row_of(self, target_id):
+        """ row whose interval [target_id of row, target_id of next row) holds target_id """
+        return self.order[bisect_right(self.starts, target_id) - 1]     # -1 => wraps to the largest target
+
+    def next_hop(self, target_id):
+        """ socket to route target_id to: the row's own, else the first row's (successor) """
+        if self.hops is None:
+            first = self.rows[0][-1]
+            self.hops = [self.rows[i][-1] or first for i in self.order]
+        return self.hops[bisect_right(self.starts, target_id) - 1]
+
+    def alternate_hop(self, target_id, avoid):
+        """ another socket to route target_id to when avoid (the usual next hop) does not answer:
+            the rows before target_id's, closest to it first, then the rest (None: no other connection) """
+        pos = bisect_right(self.starts, target_id) - 1
+        for k in range(len(self.order)):
+            sock = self.rows[self.order[pos - k]][-1]
+            if sock is not None and sock is not avoid:
+                return sock
+        return None
+
+    def affected_by(self, joining_node_id):
+        """ rows a joining node becomes the closer successor for: a contiguous run ending at row_of(joining) """
+        rows = []
+        i = self.row_of(joining_node_id)
+        while i >= 0 and self._closer(i, joining_node_id):
+            rows.append(i)
+            i -= 1
+        return rows
+
+    def _closer(self, i, node_id):
+        """ test if node_id is in [target_id, current node_id) of row i """
+        start, end = self.rows[i][0], self.rows[i][1]
+        if node_id == end:
+            return False
+        if start <= end:
+            return start <= node_id < end
+        return not (end <= node_id < start)
@@ -0,0 +1,73 @@
+# FrameReader
+
+from Codec import MAGIC, PREFIX
+
+RECV_SIZE   = 65536     # bytes asked from the kernel per recv
+COMPACT_AT  = 65536     # drop consumed bytes once this many have piled up
+
+class FrameReader:
+    """ FrameReader: buffered reader of the frames of one socket, newline-delimited json or length-prefixed binary (Codec.py) """
+    def __init__(self, sock=None, recv_size=RECV_SIZE):
+        self.sock = sock
+        self.buffer = bytearray()                   # received bytes, frames are sliced out of it
+        self.pos = 0                                # start of the first unconsumed frame
+        self.chunk = bytearray(recv_size)           # reusable recv target
+        self.view = memoryview(self.chunk)
+        self.recv_calls = 0                         # syscall counter (used by the benchmark)
+
+    def fill(self):
+        """ one bulk recv into the buffer (returns bytes read, raises EOFError on close) """
+        n = self.sock.recv_into(self.chunk)
+        self.recv_calls += 1
+        if not n:
+            raise EOFError("Socket connection broken")
+        if self.pos == len(self.buffer):            # everything consumed => reuse from the start
+            self.buffer.clear()
+            self.pos = 0
+        self.buffer += self.view[:n]
+        return n
+
+    def feed(self, data):
+        """ append bytes received some other way (an asyncio stream) """
+        if self.pos == len(self.buffer):
+            self.buffer.clear()
+            self.pos = 0
+        self.buffer += data
+
+    def _frame_end(self):
+        """ end of the first buffered frame (its newline for json), -1 if it is not complete yet """
+        if self.pos < len(self.buffer) and self.buffer[self.pos] == MAGIC:
+            if len(self.buffer) - self.pos < PREFIX.size:
+                return -1
+            end = self.pos + PREFIX.size + int.from_bytes(self.buffer[self.pos + 1:self.pos + PREFIX.size], "big")
+            return end if end <= len(self.buffer) else -1
+        return self.buffer.find(b'\n', self.pos)
+
+    def has_frame(self):
+        """ test if a complete frame is already buffered """
+        return self._frame_end() >= 0
+
+    def next_frame(self):
+        """ pop the next complete frame (a json one without its newline), None if only a partial frame is buffered """
+        end = self._frame_end()
+        if end < 0:
+            return None
+        binary = self.buffer[self.pos] == MAGIC
+        with memoryview(self.buffer) as view:      # one copy out of the buffer, not a slice of it and then a copy
+            frame = bytes(view[self.pos:end])
+        self.pos = end if binary else end + 1
+        if self.pos == len(self.buffer):
+            self.buffer.clear()
+            self.pos = 0
+        elif self.pos >= COMPACT_AT:
+            del self.buffer[:self.pos]
+            self.pos = 0
+        return frame
+
+    def read_frame(self):
+        """ block until a full frame is available (honours the socket timeout) """
+        frame = self.next_frame()
+        while frame is None:
+            self.fill()
+            frame = self.next_frame()
+        return frame
@@ -0,0 +1,126 @@
+# Log
+
+import sys
+import json
+import queue
+import time
+import atexit
+import logging
+import itertools
+from logging.handlers import QueueHandler, QueueListener
+
+TRACE       = 5         # every frame received and message sent
+LEVELS      = {"trace": TRACE, "debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+LOG_LEVEL   = "info"    # default: ring events and errors, nothing per message
+LOG_SAMPLE  = 1.0       # share of the hot path's trace and debug records kept
+LOG_FORMAT  = "text"
+TEXT_FORMAT = "%(asctime)s %(levelname)s %(name)s %(message)s"
+LOG_BATCH_WAIT = 0.01   # sec the listener lets records pile up after a flush: one wakeup per batch, not one per record
+
+logging.addLevelName(TRACE, "TRACE")
+
+sample_every = 1                # keep one hot path record in sample_every
+sample_counter = itertools.count()
+listener = None                 # the running QueueListener
+
+def get_logger(name):
+    """ logger of one part of the server, under the "p2p" root that configure sets up """
+    return logging.getLogger(f"p2p.{name}")
+
+def traced(logger, level=TRACE):
+    """ hot path guard: level is enabled for logger and this record is sampled, decided before anything is built or formatted """
+    return logger.isEnabledFor(level) and (sample_every == 1 or next(sample_counter) % sample_every == 0)
+
+class JsonFormatter(logging.Formatter):
+    """ JsonFormatter: one json object per record, for log shippers """
+    def format(self, record):
+        entry = {"time": record.created, "level": record.levelname, "logger": record.name, "message": record.getMessage()}
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry)
+
+class TextFormatter(logging.Formatter):
+    """ TextFormatter: TEXT_FORMAT lines, the date of a timestamp formatted once per second instead of per record """
+    second = None
+    stamp = None
+
+    def formatTime(self, record, datefmt=None):
+        second = int(record.created)
+        if second != self.second:
+            self.second, self.stamp = second, time.strftime("%Y-%m-%d %H:%M:%S", self.converter(second))
+        return "%s,%03d" % (self.stamp, record.msecs)
+
+class RecordQueue(QueueHandler):
+    """ RecordQueue: the only handler the server threads run, it enqueues and returns """
+    def handle(self, record):
+        """ no handler lock: the queue is thread-safe """
+        if self.filter(record):
+            self.enqueue(self.prepare(record))
+        return record
+
+    def prepare(self, record):
+        """ the message is formatted now (its args may change once we return), the record is not copied: nothing else handles it """
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.msg = record.getMessage()
+        record.args = record.exc_info = None
+        return record
+
+class StreamWriter(logging.StreamHandler):
+    """ StreamWriter: a stream handler that leaves flushing to the listener, once per burst of records instead of per record """
+    def flush(self):
+        pass
+
+    def drain(self):
+        with self.lock:
+            self.stream.flush()
+
+class RecordListener(QueueListener):
+    """ RecordListener: formats and writes queued records on its own thread, flushes whenever the queue runs empty """
+    def dequeue(self, block):
+        if block and self.queue.empty():
+            for handler in self.handlers:
+                handler.drain()
+            time.sleep(LOG_BATCH_WAIT)  # don't take the GIL from the server for every single record
+        return self.queue.get(block)
+
+    def stop(self):
+        if self._thread:
+            super().stop()
+        for handler in self.handlers:
+            handler.drain()
+
+def configure(level=LOG_LEVEL, sample=LOG_SAMPLE, fmt=LOG_FORMAT, stream=None, lean=False):
+    """ log at level and up to stream (default stdout): server threads only enqueue records, a listener thread writes them;
+        sample < 1 keeps that share of the hot path's trace and debug records; lean: records carry no caller, thread or process info,
+        about twice as fast to build, but for every logger of the process (the logging module's settings) (returns the listener) """
+    global listener, sample_every
+    shutdown()
+    if lean:
+        logging._srcfile = None
+        logging.logThreads = False
+        logging.logProcesses = False
+        logging.logMultiprocessing = False
+    writer = StreamWriter(stream or sys.stdout)
+    writer.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter(TEXT_FORMAT))
+    listener = RecordListener(queue.SimpleQueue(), writer)
+    root = logging.getLogger("p2p")
+    for old in list(root.handlers):
+        root.removeHandler(old)
+    root.addHandler(RecordQueue(listener.queue))
+    root.setLevel(LEVELS.get(level, level))
+    root.propagate = False
+    sample_every = max(1, round(1 / sample)) if sample > 0 else 1
+    listener.start()
+    return listener
+
+def shutdown():
+    """ write out every queued record and stop the listener """
+    global listener
+    if listener:
+        listener.stop()
+        listener = None
+
+atexit.register(shutdown)
@@ -0,0 +1,134 @@
+# Metrics
+
+import json
+import time
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+LATENCY_BOUNDS  = [1e-5 * 2 ** i for i in range(21)]    # sec: 10 us doubling up to ~10 sec
+HOP_BOUNDS      = [0, 1, 2, 3, 4, 5, 6, 8, 10, 12, 16, 24, 32]
+STAGES          = ("handle", "forward", "sync")         # a frame in the loop; a routed request until its answer comes back; a group commit
+
+class Histogram:
+    """ Histogram: observation counts per bucket (value <= bound, the last one unbounded), plus their sum """
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self):
+        """ {"count", "sum", "buckets": [[bound, observations <= bound]]}, cumulative like Prometheus ("+Inf" last) """
+        buckets, total = [], 0
+        for bound, count in zip(self.bounds + ["+Inf"], list(self.counts)):
+            total += count
+            buckets.append([bound, total])
+        return {"count": self.count, "sum": self.sum, "buckets": buckets}
+
+
+class Metrics:
+    """ Metrics: counters and histograms of one node, updated as frames are handled (no scans) """
+    def __init__(self):
+        self.started = time.time()
+        self.ops = {}           # {method: frames handled}, answers to our own requests under "response"
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.frames_out = 0
+        self.stages = {stage: Histogram(LATENCY_BOUNDS) for stage in STAGES}
+        self.hops = Histogram(HOP_BOUNDS)   # hops a keyed request took to reach its owner
+        self.forwards = {"retried": 0, "timed_out": 0, "late": 0}  # forwarded requests overdue and resent, given up on, answered after that
+
+    def handled(self, request, elapsed):
+        """ one frame went through handle_request in elapsed sec """
+        method = request.get("method", "response")
+        self.ops[method] = self.ops.get(method, 0) + 1
+        self.stages["handle"].observe(elapsed)
+
+    def sent(self, size):
+        self.bytes_out += size
+        self.frames_out += 1
+
+    def snapshot(self):
+        return {"uptime": time.time() - self.started, "ops": dict(self.ops),
+                "bytes": {"in": self.bytes_in, "out": self.bytes_out}, "frames_out": self.frames_out,
+                "stages": {stage: histogram.snapshot() for stage, histogram in self.stages.items()},
+                "hops": self.hops.snapshot(), "forwards": dict(self.forwards)}
+
+
+def prometheus(stats):
+    """ Prometheus text exposition of stats snapshots (one per node, see SpreadSheetServer.stats) """
+    families = {}   # {name: (type, help, [(labels, value)])}
+
+    def add(name, kind, text, labels, value):
+        families.setdefault(name, (kind, text, []))[2].append((labels, value))
+
+    for node in stats:
+        node_label = {"node": str(node["node_id"])}
+        add("p2p_uptime_seconds", "gauge", "sec since the node started", node_label, node["uptime"])
+        for method, count in node["ops"].items():
+            add("p2p_ops_total", "counter", "frames handled by method", dict(node_label, method=method), count)
+        for direction, count in node["bytes"].items():
+            add("p2p_bytes_total", "counter", "bytes received and sent", dict(node_label, direction=direction), count)
+        add("p2p_frames_sent_total", "counter", "frames sent", node_label, node["frames_out"])
+        for outcome, count in node["forwards"].items():
+            add("p2p_forwards_overdue_total", "counter", "forwarded requests past their deadline: retried, timed out, answered late", dict(node_label, outcome=outcome), count)
+        for table, depth in node["pending"].items():
+            add("p2p_pending", "gauge", "requests in flight by routing table", dict(node_label, table=table), depth)
+        for kind, count in node["keys"].items():
+            add("p2p_keys", "gauge", "keys stored by role", dict(node_label, kind=kind), count)
+        add("p2p_cache_keys", "gauge", "answers in the read cache", node_label, node["cache"]["keys"])
+        add("p2p_cache_hits_total", "counter", "lookups answered from the read cache", node_label, node["cache"]["hits"])
+        add("p2p_cache_misses_total", "counter", "cacheable lookups the read cache did not hold", node_label, node["cache"]["misses"])
+        histograms = [("p2p_stage_seconds", "latency by stage", dict(node_label, stage=stage), histogram) for stage, histogram in node["stages"].items()]
+        histograms.append(("p2p_hops", "hops a keyed request took to its owner", node_label, node["hops"]))
+        for name, text, labels, histogram in histograms:
+            for bound, count in histogram["buckets"]:
+                add(name, "histogram", text, dict(labels, le=str(bound)), count)
+            add(name, "histogram", text, dict(labels, suffix="_sum"), histogram["sum"])
+            add(name, "histogram", text, dict(labels, suffix="_count"), histogram["count"])
+
+    lines = []
+    for name, (kind, text, samples) in families.items():
+        lines.append(f"# HELP {name} {text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in samples:
+            suffix = labels.pop("suffix", "_bucket" if "le" in labels else "")
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"{name}{suffix}{{{label_text}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def serve_metrics(port, servers):
+    """ serve GET /metrics (Prometheus text) and GET /stats (json) of servers on port, from a background thread """
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            try:
+                stats = [server.stats(recount=False) for server in list(servers)]
+            except Exception as e:     # read from this thread while the loop changes them: try the next scrape
+                self.send_error(503, str(e))
+                return
+            if self.path.startswith("/metrics"):
+                body, kind = prometheus(stats).encode("utf-8"), "text/plain; version=0.0.4"
+            elif self.path.startswith("/stats"):
+                body, kind = json.dumps(stats).encode("utf-8"), "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", kind)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):   # scrapes are not worth a log line each
+            pass
+
+    httpd = HTTPServer(("", port), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
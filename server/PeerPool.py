@@ -0,0 +1,113 @@
+# PeerPool
+
+import time
+
+HEARTBEAT_INTERVAL  = 1     # heartbeat a peer that has been idle this long (sec)
+DEAD_AFTER          = 5     # a peer that answered heartbeats before and is silent this long is dead (sec)
+BACKOFF_BASE        = 0.1   # first reconnect delay after a failed connect (sec), doubled per failure
+BACKOFF_MAX         = 10
+
+class Peer:
+    """ Peer: pool entry of one (host, port), as seen from one local server """
+    def __init__(self, addr, local=None):
+        self.addr = addr
+        self.local = local          # server the connection belongs to (virtual nodes of a process share the pool)
+        self.sock = None
+        self.failures = 0           # consecutive failed connects
+        self.retry_at = 0           # no reconnect before this time
+        self.last_seen = time.time()
+        self.last_heartbeat = 0
+        self.acked = False          # peer heartbeats us / answers ours => it may be declared dead by silence
+
+
+class PeerPool:
+    """ PeerPool: one shared outgoing connection per peer and local server, reconnected lazily with backoff, checked by heartbeats """
+    def __init__(self, connect, heartbeat_interval=HEARTBEAT_INTERVAL, dead_after=DEAD_AFTER):
+        self.connect = connect      # connect(local, host, port) -> socket
+        self.heartbeat_interval = heartbeat_interval
+        self.dead_after = dead_after
+        self.peers = {}             # {(host, port, local): Peer}
+        self.by_sock = {}           # {sock: Peer}, also holds watched incoming sockets
+        self.next_tick = 0
+
+    def _alive(self, sock):
+        return sock is not None and not getattr(sock, "closed", False) and (not hasattr(sock, "fileno") or sock.fileno() != -1)
+
+    def get(self, host, port, local=None):
+        """ shared connection of local to (host, port), opened on first use (raises OSError while backing off) """
+        addr = (host, int(port))
+        peer = self.peers.get(addr + (local,))
+        if peer is None:
+            peer = self.peers[addr + (local,)] = Peer(addr, local)
+        if self._alive(peer.sock):
+            return peer.sock
+        now = time.time()
+        if now < peer.retry_at:
+            raise ConnectionRefusedError(f"{host}:{port} unreachable, retrying in {peer.retry_at - now:.1f} sec")
+        self.by_sock.pop(peer.sock, None)
+        try:
+            peer.sock = self.connect(local, host, int(port))
+        except OSError:
+            peer.sock = None
+            peer.failures += 1
+            peer.retry_at = now + min(BACKOFF_MAX, BACKOFF_BASE * 2 ** peer.failures)
+            raise
+        peer.failures = 0
+        peer.last_seen = now
+        peer.acked = False
+        self.by_sock[peer.sock] = peer
+        return peer.sock
+
+    def adopt(self, host, port, sock, local=None):
+        """ reuse an incoming connection of local from (host, port) as the pooled one, unless a live one exists """
+        addr = (host, int(port))
+        peer = self.peers.get(addr + (local,))
+        if peer is None:
+            peer = self.peers[addr + (local,)] = Peer(addr, local)
+        if self._alive(peer.sock):
+            return
+        self.by_sock.pop(peer.sock, None)
+        peer.sock = sock
+        peer.last_seen = time.time()
+        self.by_sock[sock] = peer
+
+    def watch(self, sock):
+        """ track liveness of a connection the pool did not open (e.g. the predecessor's) """
+        if sock is not None and sock not in self.by_sock:
+            self.by_sock[sock] = Peer(None)
+            self.by_sock[sock].sock = sock
+
+    def sockets(self, local=None):
+        """ every live pooled or watched connection (local: only the pooled ones of that server) """
+        return [sock for sock, peer in self.by_sock.items() if self._alive(sock) and (local is None or peer.local is local)]
+
+    def seen(self, sock, heartbeat=False):
+        """ something arrived on sock (heartbeat: it was a heartbeat or its ack) """
+        peer = self.by_sock.get(sock)
+        if peer:
+            peer.last_seen = time.time()
+            peer.acked = peer.acked or heartbeat
+
+    def lost(self, sock):
+        """ sock closed: the next get() reconnects """
+        peer = self.by_sock.pop(sock, None)
+        if peer and peer.sock is sock:
+            peer.sock = None
+
+    def tick(self, send_heartbeat):
+        """ heartbeat idle pooled peers (send_heartbeat(sock)), return connections that went silent """
+        now = time.time()
+        dead = []
+        if now < self.next_tick:
+            return dead
+        self.next_tick = now + self.heartbeat_interval / 2
+        for sock, peer in list(self.by_sock.items()):
+            if not self._alive(sock):
+                self.lost(sock)
+                continue
+            if peer.acked and now - peer.last_seen > self.dead_after:
+                dead.append(sock)
+            elif peer.addr and now - max(peer.last_seen, peer.last_heartbeat) >= self.heartbeat_interval:
+                peer.last_heartbeat = now
+                send_heartbeat(sock)
+        return dead
@@ -0,0 +1,33 @@
+# Placement
+
+from binascii import crc_hqx
+from zlib import crc32
+
+HASH_BITS   = 56            # bits of a key's hash (the rest of a 64-bit stored key is left to SheetView namespaces)
+HASH_MIX    = 0x9E3779B97F4A7C15    # odd 64-bit multiplier (2**64 / golden ratio): spreads the crcs' bits over all 64, one to one
+
+def canonical_key(key):
+    """ key as it is stored and sent: an int, or a str (bytes as utf-8, undecodable bytes kept as lone surrogates);
+        decimal text is its int and bytes are their text, so 7 and "7" are one key, and so are b"x" and "x"; None: not a key """
+    if type(key) is int:
+        return key
+    if type(key) is bytes:
+        key = key.decode("utf-8", "surrogateescape")
+    if type(key) is not str:
+        return None
+    if key.isascii() and (key.isdigit() or key[:1] == "-" and key[1:].isdigit()) and str(int(key)) == key:
+        return int(key)
+    return key
+
+def key_hash(key):
+    """ HASH_BITS hash of a canonical key, not cryptographic but the same on every node: the crc32 and the crc16 (another polynomial,
+        so independent bits) of its text, mixed by a multiply; keys whose hashes collide anyway are chained by the storage """
+    data = b"%d" % key if type(key) is int else key.encode("utf-8", "surrogateescape")
+    return ((crc32(data) << 16 | crc_hqx(data, 0)) * HASH_MIX & 0xFFFFFFFFFFFFFFFF) >> (64 - HASH_BITS)
+
+def key_position(key, key_bits):
+    """ ring position of any key in a 2**key_bits identifier space (None: not a key) """
+    key = canonical_key(key)
+    if key is None:
+        return None
+    return key_hash(key) >> (HASH_BITS - key_bits)
@@ -0,0 +1,74 @@
+# ReadCache
+
+import time
+from collections import OrderedDict
+
+CACHE_LEASE     = 2     # sec a lookup answer may be served from a cache, unless its owner invalidates it sooner
+
+class ReadCache:
+    """ ReadCache: bounded LRU of lookup answers, each valid until its lease expires or its key is invalidated """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()    # {key: (lease expiry, answer)}, least recently used first
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """ (lease expiry, answer) of key, None if not cached or its lease ran out """
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] <= time.time():
+            del self.entries[key]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, answer, lease):
+        """ cache answer for lease sec, evicting the least recently used entry when full """
+        if self.capacity <= 0:
+            return
+        self.entries[key] = (time.time() + lease, answer)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self.entries.pop(key, None)
+
+
+class LeaseTable:
+    """ LeaseTable: who was handed a lookup answer under lease, so a write of the key can invalidate their copies """
+    def __init__(self, lease=CACHE_LEASE):
+        self.lease = lease
+        self.holders = {}       # {key: {sock: lease expiry}}
+        self.next_prune = 0
+
+    def grant(self, key, sock, lease=None):
+        """ sock may serve key's answer for lease sec (default: a full lease; returns the lease) """
+        lease = self.lease if lease is None else lease
+        self.holders.setdefault(key, {})[sock] = time.time() + lease
+        return lease
+
+    def revoke(self, key):
+        """ the key changed: forget its leases (returns the holders whose lease is still running) """
+        now = time.time()
+        return [sock for sock, expiry in self.holders.pop(key, {}).items() if expiry > now]
+
+    def prune(self):
+        """ forget expired leases, at most once per lease period """
+        now = time.time()
+        if now < self.next_prune:
+            return
+        self.next_prune = now + self.lease
+        for key in list(self.holders):
+            live = {sock: expiry for sock, expiry in self.holders[key].items() if expiry > now}
+            if live:
+                self.holders[key] = live
+            else:
+                del self.holders[key]
@@ -0,0 +1,64 @@
+# SendQueue
+
+import socket
+from collections import deque
+from itertools import islice
+
+SEND_LIMIT  = 4 << 20   # queued bytes past which we stop reading requests from the connection (backpressure)
+IOV_MAX     = 1024      # buffers per sendmsg (the kernel's writev limit)
+
+class SendQueue:
+    """ SendQueue: outgoing frames of one socket, written by the loop with one sendmsg while the socket takes them (never blocks) """
+    def __init__(self, sock, limit=SEND_LIMIT):
+        self.sock = sock
+        self.buffers = deque()                      # frames (bytes, or the buffers of a relayed one) not written yet, the first one maybe in part
+        self.size = 0                               # bytes in them
+        self.limit = limit
+        self.send_calls = 0                         # syscall counter (used by the benchmark)
+
+    def push(self, buffers):
+        """ queue the buffers of one frame """
+        for buffer in buffers:
+            if len(buffer):                         # an empty part (a relayed frame without msg_id) would never be written off
+                self.buffers.append(buffer)
+                self.size += len(buffer)
+
+    def flush(self):
+        """ write as much as the socket takes without blocking (returns bytes written, raises OSError on a dead socket) """
+        written = 0
+        buffers = self.buffers
+        while self.size:
+            whole = len(buffers) <= IOV_MAX         # everything queued fits in one call
+            try:
+                if len(buffers) == 1:               # nothing to gather: the cheaper call
+                    sent = self.sock.send(buffers[0], socket.MSG_DONTWAIT)
+                else:
+                    sent = self.sock.sendmsg(buffers if whole else list(islice(buffers, IOV_MAX)), [], socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):    # the socket buffer is full: select tells us when it drained
+                break
+            self.send_calls += 1
+            written += sent
+            if whole and sent == self.size:
+                buffers.clear()
+                self.size = 0
+                break
+            self.size -= sent
+            while sent:
+                head = buffers[0]
+                if len(head) <= sent:
+                    buffers.popleft()
+                    sent -= len(head)
+                else:                               # the rest of this frame goes first next time
+                    buffers[0] = memoryview(head)[sent:]
+                    sent = 0
+            if whole:                               # the socket took less than everything: it is full
+                break
+        return written
+
+    def pending(self):
+        """ test if anything is left to write """
+        return self.size > 0
+
+    def full(self):
+        """ test if the other end is too slow to read what we send: stop reading its requests until it catches up """
+        return self.size >= self.limit
@@ -1,151 +1,460 @@
 # SpreadSheet
 
-import os, json
+import os, json, time, pickle, threading, itertools, zlib
+from array import array
+from collections import deque
+from Storage import STORAGE, STORAGE_DEFAULT, KEY_LIMIT
+from Placement import HASH_BITS, canonical_key, key_hash
+from Codec import RawValue, decode_json, encode_value as encode_json
+from Log import get_logger
+
+# values are stored as their json text, the same text binary frames carry them as (Codec.encode_value): a node stores a value off
+# a frame once it parsed (insert), and sends it back out of its record as is
+# stored keys are hashes of the keys (Placement.py), stored values records: the json pair [key, value], so the key travels with its value,
+# then the version of its last write (VERSION_SIZE bytes, little-endian), so versions cost no structure of their own;
+# keys whose hashes collide are chained: their stored key holds a tuple of their records
+
+log = get_logger("sheet")
+
+# ---------------------------------durability-------------------------------
+# none:   memory only (no log, no checkpoint)
+# async:  log appended, flushed to the OS every sync_interval / sync_ops, never fsynced
+# group:  log appended, fsynced once every sync_interval / sync_ops; replies wait for it
+# always: log appended, flushed and fsynced on every write
+DURABILITY      = "none"
+SYNC_INTERVAL   = 0.005     # longest a write waits for its fsync (sec)
+SYNC_OPS        = 256       # fsync as soon as this many writes are pending
+LOG_MAX_SIZE    = 100000    # compact the log into the checkpoint after this many entries
+CKPT_FORMAT     = "binary"  # binary: chunks of pickled dicts; json: one json object
+CKPT_CHUNK      = 10000     # keys per checkpoint chunk
+CKPT_MAGIC      = b"SSCKPT1\n"
+SYNC_BUCKET_BITS = 10       # 2**10 hash buckets over the key space, compared by anti-entropy
+
+# ---------------------------------versions---------------------------------
+# every write carries a version stamp: milliseconds of the owner's clock above the owner's node id (fits 64 bits);
+# a replica keeps the write with the highest stamp, so all copies settle on the same value whatever the order
+VERSION_NODE_BITS = 16
+VERSION_NODE_MASK = (1 << VERSION_NODE_BITS) - 1
+TOMBSTONE_TTL   = 60        # a removed key keeps its version this long, so a late older write cannot bring it back (sec)
+VERSION_SIZE    = 8         # bytes of the version at the end of a record
+
+def record_version(record):
+    return int.from_bytes(record[-VERSION_SIZE:], "little")
+
+# records a stored key holds: its key's, or those of the keys chained under it
+def records(held):
+    return (held,) if type(held) is bytes else held
+
+# hash of one entry: the crc32 of its pair (which holds the key, so the stored key adds nothing), xor-ed into its bucket's hash
+# (same on every node, unlike hash(); the version is left out: copies of the same value are in sync whatever their stamps)
+def entry_hash(record):
+    return zlib.crc32(memoryview(record)[:-VERSION_SIZE])
 
 class SpreadSheet:
-    def __init__(self, node_id, log_max_size=100):
-        self.data = {}
+    def __init__(self, node_id, log_max_size=LOG_MAX_SIZE, durability=DURABILITY, sync_interval=SYNC_INTERVAL, sync_ops=SYNC_OPS, ckpt_format=CKPT_FORMAT, storage=STORAGE_DEFAULT, namespaces=1):
+        if namespaces > 1 << (64 - HASH_BITS):
+            raise ValueError(f"at most {1 << (64 - HASH_BITS)} namespaces fit 64-bit stored keys")
+        self.storage = storage
+        self.data = STORAGE[storage]()   # {stored key: record bytes, or a tuple of them for keys whose hashes collide}
         self.node_id = node_id
-        # self.ckpt_path = f"ckpt/{str(node_id)}/sheet.ckpt"
-        # self.log_path = f"log/{str(node_id)}/sheet.log"
-        # self.log_max_size = log_max_size
-        # self.log_size = 0
-        # # Ensure directories exist
-        # os.makedirs(os.path.dirname(self.ckpt_path), exist_ok=True)
-        # os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
-
-        # # Empty the log and checkpoint files
-        # open(self.ckpt_path, "w").close()  # Truncate or create ckpt file
-        # open(self.log_path, "w").close()  # Truncate or create log file
-        
+        self.key_bits = HASH_BITS
+        self.bucket_shift = HASH_BITS - SYNC_BUCKET_BITS   # bucket of stored key: key >> bucket_shift
+        self.buckets = array('Q', bytes(8 * namespaces << SYNC_BUCKET_BITS))   # xor of entry_hash of every entry per bucket
+        self.versions = {}          # {(stored key, key): version of its removal} until the tombstone expires (live keys keep theirs in the record)
+        self.tombstones = deque()   # (expiry time, (stored key, key), version) of removals, oldest first
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.sync_ops = sync_ops
+        self.log = None
+        self.unsynced = 0           # writes appended since the last sync
+        self.first_unsynced = 0     # when the oldest of them was appended
+        self.sync_count = 0         # syncs so far (each one flush + fsync)
+        self.ckpt_format = ckpt_format
+        self.checkpoint = None      # background checkpoint thread
+        if durability == "none":
+            return
+
+        self.ckpt_path = f"ckpt/{str(node_id)}/sheet.ckpt"
+        self.log_path = f"log/{str(node_id)}/sheet.log"
+        self.log_max_size = log_max_size
+        self.log_size = 0
+        # Ensure directories exist
+        os.makedirs(os.path.dirname(self.ckpt_path), exist_ok=True)
+        os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+
         self._recover()
-        # self.log = open(self.log_path, "a")
-        
+        self.log = open(self.log_path, "a", buffering=1 << 20)
+        for key, held in self.data.items():
+            for record in records(held):
+                self.buckets[self._bucket(key)] ^= entry_hash(record)
 
-    # recover from crash: load checkpoint and then replay log
+
+    # recover from crash: load checkpoint and then replay log segments, oldest first
     def _recover(self):
-        self.data = {}
-        # # load from checkpoint
-        # try:
-        #     with open(self.ckpt_path, "r") as ckpt:
-        #         self.data = json.load(ckpt)
-        # except Exception as e:
-        #     self.data = {}
-        
-        # # replay log
-        # try:
-        #     with open(self.log_path, "r") as log:
-        #         for line in log:
-        #             self.log_size += 1
-        #             log_dic = json.loads(line)
-        #             method = log_dic["method"]
-        #             key = log_dic["key"]
-        #             value = log_dic["value"]
-        #             if method == "insert":
-        #                 self.data[f'{key}'] = value
-        #             elif method == "remove" and f'{key}' in self.data:
-        #                 del self.data[f'{key}']
-        # except Exception as e:
-        #     pass
-        
-        print("recover complete")
-        print(self.data)
+        self.data = STORAGE[self.storage]()
+        # load from checkpoint
+        try:
+            self.data = self._load_checkpoint()
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            log.error("error reading checkpoint: %s", e)
+            self.data = STORAGE[self.storage]()
+            self.versions = {}
+
+        # segments a checkpoint did not finish covering, then the live log
+        for path in self._segments() + [self.log_path]:
+            self._replay(path)
+
+        log.info("recover complete: %d keys, %d log entries replayed", len(self.data), self.log_size)
+
+    # replay one log file one line at a time, cut a torn last entry (crash mid-append)
+    def _replay(self, path):
+        good = 0
+        try:
+            with open(path, "rb") as entries:     # not "log": that is the module's logger, used below
+                for line in entries:
+                    try:
+                        log_dic = json.loads(line)
+                    except ValueError:
+                        break
+                    if not line.endswith(b"\n"):
+                        break
+                    good += len(line)
+                    self.log_size += 1
+                    method = log_dic["method"]
+                    key = log_dic["key"]
+                    version = log_dic.get("version", 0)
+                    # an insert's value is its [key, value] pair, a remove's its key (none in older logs: whatever the stored key holds)
+                    name = log_dic["value"][0] if method == "insert" else log_dic["value"]
+                    held, old = self._get(key, name)
+                    if method == "insert":
+                        self._put(key, held, old, encode_json(log_dic["value"]).encode("utf-8") + version.to_bytes(VERSION_SIZE, "little"))
+                    elif method == "remove":
+                        if old is not None:
+                            self._delete(key, held, old)
+                        elif name is None:
+                            self.data.delete(key)
+                        if version:
+                            self.versions[key, name] = version
+                            self.tombstones.append((time.time() + TOMBSTONE_TTL, (key, name), version))
+                        else:
+                            self.versions.pop((key, name), None)
+            if good != os.path.getsize(path):
+                log.warning("dropping torn log tail of %s after %d entries", path, self.log_size)
+                os.truncate(path, good)
+        except FileNotFoundError:
+            pass
+
+    # rotated log segments (sheet.log.<n>) in rotation order
+    def _segments(self):
+        prefix = os.path.basename(self.log_path) + "."
+        seqs = sorted(int(name[len(prefix):]) for name in os.listdir(os.path.dirname(self.log_path))
+                      if name.startswith(prefix) and name[len(prefix):].isdigit())
+        return [f"{self.log_path}.{seq}" for seq in seqs]
+
+    # binary checkpoint: CKPT_MAGIC, then chunks of [4-byte length][pickled (keys, records) lists]; json checkpoints are one object of pairs
+    # (a list of pairs for a chain; without versions: loaded as version 0)
+    def _load_checkpoint(self):
+        data = STORAGE[self.storage]()
+        with open(self.ckpt_path, "rb") as ckpt:
+            if ckpt.read(len(CKPT_MAGIC)) != CKPT_MAGIC:
+                ckpt.seek(0)
+                unversioned = bytes(VERSION_SIZE)
+                for key, value in json.load(ckpt).items():
+                    held = tuple(encode_json(pair).encode("utf-8") + unversioned for pair in (value if type(value[0]) is list else [value]))
+                    data.put(int(key), held[0] if len(held) == 1 else held)
+                return data
+            while True:
+                header = ckpt.read(4)
+                if not header:
+                    return data
+                chunk = pickle.loads(ckpt.read(int.from_bytes(header, "big")))
+                data.update(zip(*chunk))
 
+    # start a checkpoint: snapshot the data, rotate the log, write the snapshot in the background
     def _compact_log(self):
-        # Ensure the checkpoint directory exists
-        os.makedirs(os.path.dirname(self.ckpt_path), exist_ok=True)
-        
-        # Save RAM data into ckpt_new file
+        if self.checkpoint and self.checkpoint.is_alive():
+            return
+        # records (and chains of them) are immutable, so a copy of the key/record structure is a consistent snapshot
+        snapshot = self.data.copy()
+        # every write so far is in the snapshot => the current log becomes a segment the checkpoint covers
+        self.log.close()
+        segments = self._segments()
+        seq = int(segments[-1].rsplit(".", 1)[1]) + 1 if segments else 1
+        os.rename(self.log_path, f"{self.log_path}.{seq}")
+        segments.append(f"{self.log_path}.{seq}")
+        self.log = open(self.log_path, "a", buffering=1 << 20)
+        self.log_size = 0
+        self.checkpoint = threading.Thread(target=self._write_checkpoint, args=(snapshot, segments), daemon=True)
+        self.checkpoint.start()
+
+    # background: write snapshot chunk by chunk, swap it in, then drop the segments it covers
+    def _write_checkpoint(self, snapshot, segments):
+        start = time.time()
         try:
-            with open(self.ckpt_path + '_new', "w") as newckpt:
-                json.dump(self.data, newckpt)
+            items = iter(snapshot.ordered_items())     # in key order: a sorted backend reloads it by appending
+            with open(self.ckpt_path + '_new', "wb") as newckpt:
+                if self.ckpt_format == "json":
+                    newckpt.write(b"{")
+                    sep = b""
+                    while chunk := list(itertools.islice(items, CKPT_CHUNK)):
+                        newckpt.write(sep + b", ".join(b'"%d": %s' % (key, held[:-VERSION_SIZE] if type(held) is bytes else
+                                                                     b"[" + b", ".join(record[:-VERSION_SIZE] for record in held) + b"]")
+                                                       for key, held in chunk))
+                        sep = b", "
+                    newckpt.write(b"}")
+                else:
+                    newckpt.write(CKPT_MAGIC)
+                    while chunk := list(itertools.islice(items, CKPT_CHUNK)):
+                        data = pickle.dumps(([key for key, _ in chunk], [value for _, value in chunk]), pickle.HIGHEST_PROTOCOL)
+                        newckpt.write(len(data).to_bytes(4, "big") + data)
                 newckpt.flush()
                 os.fsync(newckpt.fileno())
+            # Replace the old ckpt: by renaming ckpt_new into ckpt
+            os.replace(self.ckpt_path + '_new', self.ckpt_path)
+            for path in segments:
+                os.remove(path)
         except Exception as e:
-            print(f"Error writing checkpoint: {e}")
+            # the segments stay, the next checkpoint covers them again
+            log.error("error writing checkpoint: %s", e)
             return
-        
-        # Replace the old ckpt: by renaming ckpt_new into ckpt
-        try:
-            os.rename(self.ckpt_path + '_new', self.ckpt_path)
-        except Exception as e:
-            print(f"Error renaming checkpoint: {e}")
+        log.info("checkpoint of %d keys written in %.2f sec", len(snapshot), time.time() - start)
+
+    # append to log file (buffered, value already serialized), sync now only in "always" mode
+    def _write_log(self, method, key, value="null", version=0):
+        if self.log is None:
             return
-        
-        # Clear the log: by closing log, open it in write mode, and re-open it for appending
-        self.log.close()
-        with open(self.log_path, 'w') as f:
-            pass
-        self.log = open(self.log_path, "a")
-        self.log_size = 0
-    
-    # append to log file, check if it requires compacting
-    def _write_log(self, method, key, value=None):
-        self.log.write(json.dumps({"method": method, "key": key, "value": value}) + "\n")
-        self.log.flush()
-        os.fsync(self.log.fileno())
+        self.log.write(f'{{"method": "{method}", "key": {key}, "value": {value}, "version": {version}}}\n')
         self.log_size += 1
+        if self.unsynced == 0:
+            self.first_unsynced = time.time()
+        self.unsynced += 1
+        if self.durability == "always":
+            self.sync()
+
+    # group commit: replies to writes must wait for the next sync
+    def deferred(self):
+        return self.durability == "group" and self.unsynced > 0
+
+    # seconds until pending writes are due for a sync (None: nothing pending, 0: sync now)
+    def sync_timeout(self):
+        if self.unsynced == 0:
+            return None
+        if self.unsynced >= self.sync_ops:
+            return 0
+        return max(0, self.first_unsynced + self.sync_interval - time.time())
+
+    # make every appended write durable (one flush + fsync for the whole batch), check if it requires compacting
+    def sync(self):
+        if self.log is None or self.unsynced == 0:
+            return
+        self.log.flush()
+        if self.durability != "async":
+            os.fsync(self.log.fileno())
+        self.unsynced = 0
+        self.sync_count += 1
         if self.log_size >= self.log_max_size:
             self._compact_log()
 
-    # check input: everything in lst are int
-    def _are_positive_int(self, lst):
-        for val in lst:
-            if type(val) != int or val < 0:
-                return False
-        return True
+    # check input: (stored key, canonical key), stored above base (a SheetView namespace); (None, None) if invalid
+    def _locate(self, key, base=0):
+        key = canonical_key(key)
+        if key is None:
+            return None, None
+        return base + key_hash(key), key
+
+    # start of the stored [key, value] pair of key: a record not starting with it is another key's of the same hash
+    def _prefix(self, key):
+        if type(key) is int:
+            return "[%d, " % key
+        return "[" + encode_json(key) + ", "
+
+    # key's record among what a stored key holds (prefix: key's, as bytes), None if it holds none
+    def _find(self, held, prefix):
+        if type(held) is bytes:
+            return held if held.startswith(prefix) else None
+        for record in held:
+            if record.startswith(prefix):
+                return record
+        return None
+
+    # (what stored key holds, key's record among it), None for either if missing
+    def _get(self, stored, key):
+        held = self.data.get(stored)
+        if held is None or key is None:
+            return held, None
+        return held, self._find(held, self._prefix(key).encode("utf-8"))
+
+    # store key's record under stored key in place of old (key's record, None: a new key), held: what stored key holds
+    def _put(self, stored, held, old, record):
+        if held is old:     # the stored key is this key's alone
+            self.data.put(stored, record)
+        elif old is None:   # a key whose hash collides with the stored ones: chained after them
+            self.data.put(stored, records(held) + (record,))
+        else:
+            self.data.put(stored, tuple(record if other is old else other for other in held))
+
+    # drop key's record old from what stored key holds
+    def _delete(self, stored, held, old):
+        if held is old:
+            self.data.delete(stored)
+        else:
+            rest = tuple(other for other in held if other is not old)
+            self.data.put(stored, rest[0] if len(rest) == 1 else rest)
+
+    # [key, value] of a record
+    def _pair(self, record):
+        return decode_json(record[:-VERSION_SIZE].decode("utf-8"))
 
+    # stored keys (a chain of keys whose hashes collide counts once)
+    def __len__(self):
+        return len(self.data)
 
-    def insert(self, key, value):
+    # every (key, value) pair, values decoded
+    def items(self):
+        for _, held in self.data.items():
+            for record in records(held):
+                yield tuple(self._pair(record))
+
+    # (key, value) pairs with lo <= stored key < hi in stored key order, values decoded: O(log n + k) on the sorted key index
+    def range(self, lo, hi):
+        for _, held in self.data.range(lo, hi):
+            for record in records(held):
+                yield tuple(self._pair(record))
+
+    # (stored key, key, value, version) with lo <= stored key < hi in stored key order, values decoded: copies that keep their write order
+    # (the keys chained under a stored key come one after another)
+    def versioned_range(self, lo, hi):
+        for stored, held in self.data.range(lo, hi):
+            for record in records(held):
+                key, value = self._pair(record)
+                yield stored, key, value, record_version(record)
+
+    # pairs on the stored key arc [lo, hi), wrapping past the largest key when lo > hi
+    def arc(self, lo, hi):
+        if lo <= hi:
+            return self.range(lo, hi)
+        return itertools.chain(self.range(lo, KEY_LIMIT), self.range(0, hi))
+
+    # number of keys on the stored key arc [lo, hi)
+    def arc_count(self, lo, hi):
+        if lo <= hi:
+            return self.data.count(lo, hi)
+        return self.data.count(lo, KEY_LIMIT) + self.data.count(0, hi)
+
+    # version for a new write of a key here: our clock, but always past the key's last version
+    def _stamp(self, last):
+        stamp = time.time_ns() // 1000000 << VERSION_NODE_BITS | self.node_id & VERSION_NODE_MASK
+        if stamp <= last:
+            stamp = ((last >> VERSION_NODE_BITS) + 1) << VERSION_NODE_BITS | self.node_id & VERSION_NODE_MASK
+        return stamp
+
+    # version of key's last write, stored under stored key as record (None: removed or unknown, its tombstone's if any)
+    def _version(self, stored, key, record):
+        return self.versions.get((stored, key), 0) if record is None else record_version(record)
+
+    # version of key's last write, 0 if unknown
+    def version(self, key, base=0):
+        stored, key = self._locate(key, base)
+        return 0 if stored is None else self._version(stored, key, self._get(stored, key)[1])
+
+    # forget tombstones past their TOMBSTONE_TTL (unless a later removal replaced them)
+    def _expire_tombstones(self):
+        now = time.time()
+        while self.tombstones and self.tombstones[0][0] <= now:
+            _, key, version = self.tombstones.popleft()
+            if self.versions.get(key) == version:
+                del self.versions[key]
+
+    # version None: a new write, stamped here; otherwise a copy of one, kept only if no newer write is known (unless force);
+    # value: a RawValue (its json text off a binary frame) is stored as is, once it parsed here
+    def insert(self, key, value, version=None, force=False, base=0):
         # check input
-        try:
-            key = int(key)
-        except:
-            return {"status": "failure", "message": "Invalid key value"}
-        if not self._are_positive_int([key]):
+        stored, key = self._locate(key, base)
+        if stored is None:
             return {"status": "failure", "message": "Invalid key value"}
-        # insert
-        self.data[f'{key}'] = value
-        # # append to log
-        # self._write_log("insert", key, value)
-        # return
-        return {"status": "success"}
-
-    def lookup(self, key):
+        if type(value) is RawValue:
+            try:
+                value = value.decode("utf-8")
+                decode_json(value)
+            except ValueError:
+                value = None
+            if value is None or "\n" in value:     # json may have newlines between its tokens, the log has one entry a line
+                return {"status": "failure", "message": "Invalid value"}
+        else:
+            value = encode_json(value)
+        prefix = self._prefix(key)
+        held = self.data.get(stored)
+        old = None if held is None else self._find(held, prefix.encode("utf-8"))
+        last = record_version(old) if old is not None else self.versions.get((stored, key), 0) if self.versions else 0
+        if version is None:
+            version = self._stamp(last)
+        elif version < last and not force:     # a newer write won already
+            return {"status": "success", "version": last}
+        # insert, [key, value] kept serialized with its version
+        raw = f"{prefix}{value}]"
+        pair = raw.encode("utf-8")
+        bucket = stored >> self.bucket_shift    # an entry's stored key is always inside the buckets (see _bucket)
+        if old is not None:
+            self.buckets[bucket] ^= entry_hash(old)
+        self.buckets[bucket] ^= zlib.crc32(pair)
+        self._put(stored, held, old, pair + version.to_bytes(VERSION_SIZE, "little"))
+        # append to log
+        if self.log is not None:
+            self._write_log("insert", stored, raw, version)
+        return {"status": "success", "version": version}
+
+    # raw: the value as a RawValue, for a node sending it on in a binary frame
+    def lookup(self, key, base=0, raw=False):
         # check input
-        try:
-            key = int(key)
-        except:
-            return {"status": "failure", "message": "Invalid key value"}
-        if not self._are_positive_int([key]):
+        stored, key = self._locate(key, base)
+        if stored is None:
             return {"status": "failure", "message": "Invalid key value"}
         # lookup
-        if f'{key}' in self.data:
+        prefix = self._prefix(key).encode("utf-8")
+        held = self.data.get(stored)
+        record = None if held is None else self._find(held, prefix)
+        if record is not None:
+            value = record[len(prefix):-1 - VERSION_SIZE]
             return {
                 "status": "success", 
-                "value": self.data[f'{key}']
+                "value": RawValue(value) if raw else decode_json(value.decode("utf-8")),
+                "version": record_version(record)
             }
-        # not found
-        return {
+        # not found (a removed key still tells the version of its removal)
+        message = {
             "status": "failure", 
             "message": "Key not found"
         }
+        if (stored, key) in self.versions:
+            message["version"] = self.versions[stored, key]
+        return message
 
-    def remove(self, key):
+    # version None: a new removal, stamped here; otherwise a copy of one, which leaves a tombstone even for a key we lack
+    def remove(self, key, version=None, base=0):
         # check input
-        try:
-            key = int(key)
-        except:
-            return {"status": "failure", "message": "Invalid key value"}
-        if not self._are_positive_int([key]):
+        stored, key = self._locate(key, base)
+        if stored is None:
             return {"status": "failure", "message": "Invalid key value"}
 
-        # remove
-        if f'{key}' in self.data:
-            del self.data[f'{key}']
+        # remove (never another key of the same hash)
+        held, old = self._get(stored, key)
+        last = self._version(stored, key, old)
+        if version is None and old is not None:
+            version = self._stamp(last)
+        if version is not None and version >= last:
+            if old is not None:
+                self._delete(stored, held, old)
+                self.buckets[stored >> self.bucket_shift] ^= entry_hash(old)
+            self.versions[stored, key] = version
+            self.tombstones.append((time.time() + TOMBSTONE_TTL, (stored, key), version))
+            self._expire_tombstones()
             # append to log
-            # self._write_log("remove", key)
-            return {"status": "success"}
+            if self.log is not None:
+                self._write_log("remove", stored, encode_json(key), version)
+            if old is not None:
+                return {"status": "success", "version": version}
 
         # not found
         return {
@@ -153,3 +462,150 @@ class SpreadSheet:
             "message": "Key not found"
         }
 
+    # drop our copy of key without a tombstone: handed off to another node, or unknown to its owner
+    def discard(self, key, base=0):
+        stored, key = self._locate(key, base)
+        if stored is None:
+            return
+        held, old = self._get(stored, key)
+        self.versions.pop((stored, key), None)
+        if old is not None:
+            self._delete(stored, held, old)
+            self.buckets[self._bucket(stored)] ^= entry_hash(old)
+            self._write_log("remove", stored, encode_json(key))
+
+    # ---------------------------anti-entropy---------------------------
+    # segments: non-wrapping stored key ranges [lo, hi); buckets: stored key >> bucket_shift
+
+    def _bucket(self, key):
+        return min(key >> self.bucket_shift, len(self.buckets) - 1)
+
+    # (bucket, lo, hi) for every bucket overlapping the segments, cut to them
+    def _bucket_ranges(self, segments):
+        for lo, hi in segments:
+            if lo >= hi:
+                continue
+            for bucket in range(self._bucket(lo), self._bucket(hi - 1) + 1):
+                start = max(lo, bucket << self.bucket_shift)
+                end = min(hi, (bucket + 1) << self.bucket_shift)
+                if bucket == len(self.buckets) - 1:
+                    end = hi
+                yield bucket, start, end
+
+    # hash of the entries of a bucket within [lo, hi): kept up to date for whole buckets, scanned for cut ones
+    def _bucket_hash(self, bucket, lo, hi):
+        if lo == bucket << self.bucket_shift and (hi == (bucket + 1) << self.bucket_shift or bucket == len(self.buckets) - 1 and hi >= KEY_LIMIT):
+            return self.buckets[bucket]
+        digest = 0
+        for _, held in self.data.range(lo, hi):
+            for record in records(held):
+                digest ^= entry_hash(record)
+        return digest
+
+    # [[bucket, hash]] of the non-empty buckets within the segments
+    def bucket_hashes(self, segments):
+        hashes = []
+        for bucket, lo, hi in self._bucket_ranges(segments):
+            digest = self._bucket_hash(bucket, lo, hi)
+            if digest:
+                hashes.append([bucket, digest])
+        return hashes
+
+    # buckets within the segments whose hash differs from theirs ([[bucket, hash]], missing ones are empty)
+    def differing_buckets(self, segments, theirs):
+        theirs = dict(theirs)
+        return [bucket for bucket, lo, hi in self._bucket_ranges(segments) if self._bucket_hash(bucket, lo, hi) != theirs.get(bucket, 0)]
+
+    # [[bucket, [[key, hash]]]] of the given buckets within the segments
+    def key_hashes(self, segments, buckets):
+        buckets = set(buckets)
+        return [[bucket, [[self._pair(record)[0], entry_hash(record)] for _, held in self.data.range(lo, hi) for record in records(held)]]
+                for bucket, lo, hi in self._bucket_ranges(segments) if bucket in buckets]
+
+    # what a replica holding theirs ([[bucket, [[key, hash]]]], keys stored above base) lacks:
+    # (items [key, value, version] to store, keys to remove, stored ranges it has nothing of)
+    def diff(self, segments, theirs, base=0):
+        items, removed, empty = [], [], []
+        theirs = {bucket: {key: (self._locate(key, base)[0], digest) for key, digest in pairs} for bucket, pairs in theirs}
+        for bucket, lo, hi in self._bucket_ranges(segments):
+            if bucket not in theirs:
+                continue
+            their_keys = theirs[bucket]
+            if not their_keys:     # nothing there: ship the whole range in bulk
+                empty.append((lo, hi))
+                continue
+            for _, held in self.data.range(lo, hi):
+                for record in records(held):
+                    pair = self._pair(record)
+                    if their_keys.pop(pair[0], (None, None))[1] != entry_hash(record):
+                        items.append(pair + [record_version(record)])
+            removed.extend(key for key, (stored, _) in their_keys.items() if lo <= stored < hi)
+        return items, removed, empty
+
+class SheetView:
+    """ SheetView: the keys of one virtual node, in its own namespace of a SpreadSheet shared by the virtual nodes of a process """
+    def __init__(self, sheet, namespace):
+        self.sheet = sheet
+        self.limit = 1 << sheet.key_bits                        # stored keys of a view: [0, limit)
+        self.base = namespace << sheet.key_bits                 # stored as base + key hash
+        self.bucket_base = namespace << SYNC_BUCKET_BITS        # buckets likewise
+
+    def __len__(self):
+        return self.sheet.data.count(self.base, self.base + self.limit)
+
+    # segments [(lo, hi)] of the view as stored segments
+    def _segments(self, segments):
+        return [(self.base + lo, self.base + min(hi, self.limit)) for lo, hi in segments]
+
+    def insert(self, key, value, version=None, force=False):
+        return self.sheet.insert(key, value, version, force, self.base)
+
+    def lookup(self, key, raw=False):
+        return self.sheet.lookup(key, self.base, raw)
+
+    def remove(self, key, version=None):
+        return self.sheet.remove(key, version, self.base)
+
+    def discard(self, key):
+        self.sheet.discard(key, self.base)
+
+    def version(self, key):
+        return self.sheet.version(key, self.base)
+
+    def range(self, lo, hi):
+        return self.sheet.range(self.base + lo, self.base + min(hi, self.limit))
+
+    def versioned_range(self, lo, hi):
+        for stored, key, value, version in self.sheet.versioned_range(self.base + lo, self.base + min(hi, self.limit)):
+            yield stored - self.base, key, value, version
+
+    def arc_count(self, lo, hi):
+        if lo <= hi:
+            return self.sheet.data.count(self.base + lo, self.base + min(hi, self.limit))
+        return self.sheet.data.count(self.base + lo, self.base + self.limit) + self.sheet.data.count(self.base, self.base + hi)
+
+    def bucket_hashes(self, segments):
+        return [[bucket - self.bucket_base, digest] for bucket, digest in self.sheet.bucket_hashes(self._segments(segments))]
+
+    def differing_buckets(self, segments, theirs):
+        theirs = [[bucket + self.bucket_base, digest] for bucket, digest in theirs]
+        return [bucket - self.bucket_base for bucket in self.sheet.differing_buckets(self._segments(segments), theirs)]
+
+    def key_hashes(self, segments, buckets):
+        buckets = [bucket + self.bucket_base for bucket in buckets]
+        return [[bucket - self.bucket_base, pairs] for bucket, pairs in self.sheet.key_hashes(self._segments(segments), buckets)]
+
+    def diff(self, segments, theirs):
+        theirs = [[bucket + self.bucket_base, pairs] for bucket, pairs in theirs]
+        items, removed, empty = self.sheet.diff(self._segments(segments), theirs, self.base)
+        return items, removed, [(lo - self.base, hi - self.base) for lo, hi in empty]
+
+    # durability is the shared sheet's
+    def deferred(self):
+        return self.sheet.deferred()
+
+    def sync_timeout(self):
+        return self.sheet.sync_timeout()
+
+    def sync(self):
+        self.sheet.sync()
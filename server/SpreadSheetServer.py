@@ -5,20 +5,54 @@ import json
 import sys
 import time
 import threading
+import logging
 import os
-from SpreadSheet import SpreadSheet
+from SpreadSheet import SpreadSheet, SheetView, DURABILITY, SYNC_INTERVAL, SYNC_OPS, CKPT_FORMAT
+from Storage import STORAGE, STORAGE_DEFAULT
+from Placement import HASH_BITS, canonical_key, key_position
+from ReadCache import ReadCache, LeaseTable
+from FrameReader import FrameReader
+from SendQueue import SendQueue
+from Codec import dumps, loads, peek, reframe
+from PeerPool import PeerPool
+from FingerTable import FingerTable
+from Transfer import Transfer, TRANSFER_BATCH, TRANSFER_WINDOW, TRANSFER_RETRIES
+from Log import TRACE, LEVELS, LOG_LEVEL, LOG_SAMPLE, LOG_FORMAT, get_logger, traced, configure
+from Metrics import Metrics, prometheus, serve_metrics
 import select
 import requests
+import argparse
+import asyncio
+import itertools
+import heapq
 
 # ---------------------------------globals---------------------------------
-FINGER_NUM  = 16
+FINGER_NUM  = 16          # bits of the identifier space (--key-bits, at most HASH_BITS)
 MAX_KEY     = 2 ** FINGER_NUM
+PLACED_METHODS = ("insert", "lookup", "remove")     # requests routed to where their key hashes; ring messages carry ring positions
+RANGE_CHUNK = 1000      # range_lookup items per streamed response
+ANTI_ENTROPY_INTERVAL = 5   # sec between syncs of our arc with the successor's replicas
+REPLICATION = 2         # copies of every key: its owner's and one on each of the next REPLICATION - 1 nodes
+VNODES      = 1         # ring members per process, sharing its storage and peer connections
+VNODE_JOIN_GAP = 1      # sec between a virtual node settling in the ring and the next one joining
+WORKERS     = 1         # processes per ring node (--workers), each a ring member of its own on a share of the node's arc
+INFO_INTERVAL = 5       # sec between the info records a node logs
+CHORD_TIMEOUT  = 5      # sec to wait for the establishChord answers before finishing the finger table with what came
+CACHE_SIZE  = 0         # lookup answers a node caches for the lookups it routes (0: no cache)
+PROTOCOL    = "binary"  # frames a node offers in its hellos and accepts in the ones it gets (json: stays on newline-delimited json)
+FORWARD_TIMEOUT = 2     # sec the entry node waits for the answer to a request it forwarded (per attempt, below the client's 5 sec)
+FORWARD_DECAY   = 0.5   # every hop further along waits this much less, so the node next to a failure notices it first
+FORWARD_MIN     = 0.05  # sec, shortest wait of any hop
+FORWARD_RETRIES = 1     # resends along another finger by the entry node before an overdue request is answered with a timeout
+NAME_SERVER = ("catalog.cse.nd.edu", 9097)  # nodes register with it over udp and find each other with GET /query.json (--name-server)
+
+log = get_logger("server")     # one child per node: p2p.server.<node_id>
 
 # ------------------------background thread functions----------------------
 
 def register_name_server(port, project_name):
     """ register to name server once a minute """
-    name_server_address = ("catalog.cse.nd.edu", 9097)
+    name_server_address = NAME_SERVER
     while True:
         message = {
             "type": "spreadsheet",
@@ -34,34 +68,6 @@ def register_name_server(port, project_name):
         # register once a minute
         time.sleep(60)
 
-def print_info(server): 
-    """ print connection infos every 5 sec """
-    while True:
-        print(f"\nnode_id: {server.node_id}")
-        size = len(server.spreadsheet.data)
-        resp = len([key for key in server.spreadsheet.data.keys() if server._isResponsible(key)])
-        print(f"data size: {size}\t resp: {resp}\t repl: {size-resp}")
-        # print(f"resp: {[key for key in server.spreadsheet.data.keys() if server._isResponsible(key)]}")
-        # print(f"repl: {[key for key in server.spreadsheet.data.keys() if not server._isResponsible(key)]}")
-
-        if server.predecessor: print(f"predecessor: {server.predecessor.host}:{server.predecessor.port}, {server.predecessor.node_id}")
-        if server.successor: print(f"successor: {server.successor.host}:{server.successor.port}, {server.successor.node_id}")
-        
-        print(f'\n\tfinger_table ({server.node_id}): ')
-        for target_id, node_id, host, port, socket in server.finger_table:
-            print(f'{target_id}\t{node_id}\t: {host}:{port}, {"con" if socket else "not"}')
-        # print(f'\n\tpointed_table ({server.node_id}): ')
-        # for node_id, row in server.pointed_table.items():
-        #     print(f'{node_id}\t{row[:-1]}')
-        # print(f'\n\tpred_finger_table ({server.predecessor.node_id if server.predecessor else None}): ')
-        # for target_id, node_id, host, port in server.pred_finger_table:
-        #     print(f'{target_id}\t{node_id}\t: {host}:{port}')
-        # print(f'\n\tpred_pointed_table ({server.predecessor.node_id if server.predecessor else None}): ')
-        # for node_id, row in server.pred_pointed_table.items():
-        #     print(f'{node_id}\t: {row}')
-        print("\n")
-        time.sleep(5)
-
 # ---------------------------------Classes---------------------------------
 class Node:
     """ Node: used by SpreadSheetServer's predecessor and successor"""
@@ -78,105 +84,199 @@ class Node:
 
 class SpreadSheetServer:
     """ SpreadSheetServer: the server class """
-    def __init__(self, project_name, node_id, host, port):
+    def __init__(self, project_name, node_id, host, port, replication=REPLICATION, spreadsheet=None, pool=None, entry=None, cache_size=CACHE_SIZE, queues=None, **sheet_options):
         self.node_id = int(node_id) % MAX_KEY
         self.project_name = f'{project_name}_{node_id}' 
+        self.log = log.getChild(str(self.node_id))
 
         self.host = host    # master host and port
         self.port = port
         
         self.client_sockets = {}    # all other sockets connected
-        self.spreadsheet = SpreadSheet(node_id=self.node_id)    # where spreadsheet data and operations stored
+        self.readers = {}           # buffered frame reader of every socket: {sock: FrameReader}
+        self.queues = {} if queues is None else queues  # outgoing frames of every socket, written by the loop: {sock: SendQueue},
+                                                        #   shared by the virtual nodes (heartbeats go out through the first one)
+        self.binary = set()         # sockets whose other end said hello with binary frames: we send them binary frames too
+        self.hello_dic = {}         # hellos we sent on new connections: {msg_id: sock}
+        if pool is None:
+            pool = PeerPool(lambda local, host, port: local._connect(host, port))
+        self.pool = pool            # one shared outgoing connection per peer (host, port)
+        if spreadsheet is None:
+            spreadsheet = SpreadSheet(node_id=self.node_id, **sheet_options)
+        self.spreadsheet = spreadsheet  # where spreadsheet data and operations stored
+        self.held = []              # replies waiting for the group commit of the writes before them: [(sock, message)]
+        self.cache = ReadCache(cache_size)  # answers of lookups routed through us, served again while their lease runs
+        self.leases = LeaseTable()  # who we handed lookup answers to under lease, told when the key changes
+        self.metrics = Metrics()    # counters and histograms, read by stats requests
+        self.worker = None          # our Worker when the node runs as worker processes (Workers.py): shortcuts to the others' arcs
 
         self.successor = None
         self.predecessor = None 
+        self.replication = replication
+        self.next_successors = []   # nodes after our successor, clockwise, for copies beyond the first: [[node_id, host, port]]
+        self.next_poll = 0          # next time we ask our successor for them
 
-        self.finger_table = [[(self.node_id + 2**i) % MAX_KEY, self.node_id, self.host, self.port, None] for i in range(FINGER_NUM)]      # [[target_id, node_id, node_host, node_port, socket]]
+        self.finger_table = FingerTable(self.node_id, self.host, self.port, FINGER_NUM, MAX_KEY)      # [[target_id, node_id, node_host, node_port, socket]]
         self.pointed_table = {}         # {node_id: [count, node_host, node_port, socket]}
 
         self.pred_finger_table = []     # [[target_id, node_id, node_host, node_port]]
         self.pred_pointed_table = {}    # {node_id: [count, node_host, node_port]}
         
-        self.message_dic = {}       # stores incoming messages: {msg_id: (source_sock, target_sock)}
+        self.message_dic = {}       # stores incoming messages: {msg_id: route}, route = {"source", "next", "source_id" (if renamed), "leased" ((key, source wants a lease) of a leased lookup),
+                                    #   "request" (or the buffers of a relayed frame), "hops", "target", "tries", "forwarded" (perf_counter), "deadline"}
+        self.deadlines = []         # heap of (deadline, msg_id) of the routes, sub-batches, range scans and quorum ops below;
+                                    #   stale once what msg_id awaits is answered or has a later deadline
+        self.batch_dic = {}         # sub-batches in flight: {msg_id: batch}, batch = {"source", "msg_id", "results", "waiting", "keys" ({msg_id: keys}), "deadline"}
+        self.range_dic = {}         # range scans continued at the successor: {msg_id: (source_sock, source msg_id, deadline, hops)}
+        self.quorum_dic = {}        # replica answers awaited: {msg_id: (op, replica_sock)}, op = {"source", "message", "waiting", "deadline"[, "key", "answers"]}
+        self.transfers = {}         # outgoing bulk transfers: {transfer_id: Transfer}
+        self.next_sync = time.time() + ANTI_ENTROPY_INTERVAL     # next anti-entropy round
+        self.next_info = 0          # next info record (tick_info)
+        self.key_counts = 0, 0      # (responsible, replica) keys as stats last counted them
         self.msg_counter = 0        # self unique msg_id counter
-
-        self._join()    # call join() to join the chord
+        self.join_id = None         # msg_id of our join request, until it is answered
+        self.chord_dic = {}         # establishChord answers awaited: {msg_id: finger table row}
+        self.chord_affected = set() # sockets to tell once the finger table is established
+        self.chord_deadline = None  # finish the finger table by then, even with answers missing
+        self.joined_at = None       # when we settled in the ring (virtual nodes join one after another)
 
         self.flag = 0   # flag = 0: predecessor is stable; flag = 1: predecessor is unstable
         self.last_pred_id = self.node_id
+
+        self._join(entry)    # call join() to join the chord
     
 
-    def _join(self):
-        """ New node tries to join existing chord system """
+    def _join(self, entry=None):
+        """ New node tries to join existing chord system, through entry (host, port) or a random server; the answer comes back to the loop """
+        self._join_through(entry if entry is not None else self._find_entry())
+
+    def _find_entry(self):
+        """ a live server of our project the name server lists (None: none); blocks on the query and on a connect per server tried """
         try:
-            # connect to a random server, and send join request
-            response = requests.get("http://catalog.cse.nd.edu:9097/query.json")    # connect to name server
-            services = response.json()
+            response = requests.get(f"http://{NAME_SERVER[0]}:{NAME_SERVER[1]}/query.json")    # connect to name server
+            services = [service for service in response.json() if service.get("type") == "spreadsheet" and service.get("project").split('_')[0] == self.project_name.split('_')[0]]
+        except Exception as e:
+            self.log.info("no servers from the name server (%s)", e)
+            return None
 
-            # select a random server
-            # retry connecting to service (loop through all possible names)
-            for service in [service for service in services if service.get("type") == "spreadsheet" and service.get("project").split('_')[0] == self.project_name.split('_')[0]]:
-                try:
-                    random_host = service.get("name")
-                    random_port = service.get("port")
-                    join_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    join_socket.connect((random_host, random_port)) # connect to this server, and send join request
-                    break
-                except:
-                    pass
-            response_data = self.send_request(join_socket, {"method": "join", "key": self.node_id})  # get successor addr from response
+        # select a random server
+        # retry connecting to service (loop through all possible names)
+        for service in services:
+            try:
+                random_host = service.get("name")
+                random_port = service.get("port")
+                join_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                join_socket.connect((random_host, random_port)) # check it is alive
+                join_socket.close()
+                return (random_host, random_port)
+            except:
+                pass
+        return None
+
+    def _join_through(self, entry):
+        """ send our join request to entry (None: there is none, we are the first server) """
+        if entry is not None:
+            try:
+                self.join_id = self._new_msg_id()
+                self.send_message(self._peer(*entry), {"method": "join", "key": self.node_id, "msg_id": self.join_id})  # get successor addr from response
+                return
+            except Exception as e:
+                self.log.info("entry node %s:%s unreachable (%s)", *entry, e)
+        self.log.info("no entry node: first server")
+        self.joined_at = time.time()
+
+    def _joined(self, response_data):
+        """ our join request was answered: connect to our successor """
+        self.join_id = None
+        try:
             if response_data["status"] == "failure":
-                print("invalid node_id")
+                self.log.error("join refused: invalid node_id")
                 return
-            join_socket.close()
 
             # connect to successor
-            self.successor = Node(response_data["host"], response_data["port"], response_data["node_id"])   # set successor and connect
+            self.successor = Node(response_data["host"], response_data["port"], response_data["node_id"], self._peer(response_data["host"], response_data["port"]))   # set successor and connect
             # update finger table to include successor
             self.update_finger_table(self.successor.node_id, self.successor.host, self.successor.port, False)
-            print(f'successor connected: {self.successor.host, self.successor.port, self.successor.node_id}')
+            self.log.info("successor connected: %s:%s, %s", self.successor.host, self.successor.port, self.successor.node_id)
             
             self.send_message(self.successor.socket, {"method": "imYourPred", "host": self.host, "port": self.port, "node_id": self.node_id}) # inform successor of its pred
 
         except Exception as e:
-            print(e)
-            print('first server')
+            self.log.error("error joining: %s", e)
+
+
+    def _connect(self, host, port):
+        """ open an outgoing connection to a peer (returns the socket) """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)     # small frames back to back: don't wait for acks
+        self._hello(sock)
+        return sock
 
+    def _hello(self, sock):
+        """ offer binary frames on a connection we opened; until the answer says yes it carries json """
+        if PROTOCOL == "binary":
+            msg_id = self._new_msg_id()
+            self.hello_dic[msg_id] = sock
+            self.send_message(sock, {"method": "hello", "protocols": ["binary", "json"], "msg_id": msg_id})
+
+    def _peer(self, host, port):
+        """ shared connection to a peer from the pool """
+        return self.pool.get(host, port, self)
+
+    def drop_socket(self, sock):
+        """ close a dead connection and forget everything attached to it """
+        try:
+            sock.close()
+        except OSError:
+            pass
+        self.client_sockets.pop(sock, None)
+        self.binary.discard(sock)
+        self._drop_reader(sock)
+        self.queues.pop(sock, None)
+        self.pool.lost(sock)
 
     def _establish_chord(self):
-        """ establish finger table """
-        print("establishing finger table")
-        affected_sockets = set()
+        """ establish finger table: ask for the owner of every row's target, the answers come back to the loop """
+        self.log.info("establishing finger table")
+        self.chord_affected = set()
+        self.chord_deadline = time.time() + CHORD_TIMEOUT
         for i in range(FINGER_NUM):
-            response_data = self.send_request(self.successor.socket, {"method": "establishChord", "key": self.finger_table[i][0]})
-            if "node_id" not in response_data:  # route back to itself => it is responsible
-                continue
-            try:
-                node_id = int(response_data["node_id"])
-                host = response_data["host"]
-                port = int(response_data["port"])
-                if self.finger_table[i-1][1] == node_id:    # check if match the same node
-                    self.finger_table[i][1:] = self.finger_table[i-1][1:]
-                    self.send_message(self.finger_table[i][-1], {"method": "imPointingAtYou", "host": self.host, "port": self.port, "node_id": self.node_id})
-                else:
-                    exist = False
-                    for sock, addr in self.client_sockets.items():  # check if already in socket list
-                        if addr[0] == host and addr[1] == port:
-                            self.finger_table[i][1:] = node_id, host, port, sock
-                            affected_sockets.add(sock)
-                            self.send_message(sock, {"method": "imPointingAtYou", "host": self.host, "port": self.port, "node_id": self.node_id})
-                            exist = True
-                            break
-                    if not exist:
-                        finger_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        finger_socket.connect((host, port))
-                        affected_sockets.add(finger_socket)
-                        self.finger_table[i][1:] = node_id, host, port, finger_socket
-                        self.send_message(finger_socket, {"method": "imPointingAtYou", "host": self.host, "port": self.port, "node_id": self.node_id})
-            except Exception as e:
-                print(f"Error establishing chord: {e}")
+            msg_id = self._new_msg_id()
+            self.chord_dic[msg_id] = i
+            self.send_message(self.successor.socket, {"method": "establishChord", "key": self.finger_table[i][0], "msg_id": msg_id})
+
+    def _chord_answer(self, msg_id, response_data):
+        """ an establishChord answer: fill its row, finish once every row is in """
+        self._chord_row(self.chord_dic.pop(msg_id), response_data, self.chord_affected)
+        if not self.chord_dic:
+            self._chord_done(self.chord_affected)
+
+    def _chord_row(self, i, response_data, affected_sockets):
+        """ fill finger table row i from the establishChord response """
+        if not response_data or "node_id" not in response_data:  # route back to itself => it is responsible
+            return
+        try:
+            node_id = int(response_data["node_id"])
+            host = response_data["host"]
+            port = int(response_data["port"])
+            if self.finger_table[i-1][1] == node_id:    # check if match the same node
+                self.finger_table.set(i, *self.finger_table[i-1][1:])
+                self.send_message(self.finger_table[i][-1], {"method": "imPointingAtYou", "host": self.host, "port": self.port, "node_id": self.node_id})
+            else:
+                finger_socket = self._peer(host, port)  # rows pointing at the same node share one connection
+                affected_sockets.add(finger_socket)
+                self.finger_table.set(i, node_id, host, port, finger_socket)
+                self.send_message(finger_socket, {"method": "imPointingAtYou", "host": self.host, "port": self.port, "node_id": self.node_id})
+        except Exception as e:
+            self.log.error("error establishing chord: %s", e)
+
+    def _chord_done(self, affected_sockets):
+        """ finger table established: inform affected nodes and start data transfer """
+        self.chord_deadline = None
+        self.joined_at = time.time()
         # inform successor to updatePFT
-        self.send_message(self.successor.socket, {"method": "updatePFT", "PFT": [row[:-1] for row in self.finger_table]})
+        self.send_message(self.successor.socket, {"method": "updatePFT", "PFT": self.finger_table.serialize()})
         for sock in affected_sockets | {self.successor.socket}:
             self.send_message(sock, {"method": "chordEstablishmentCompleted"})
         self.send_message(self.successor.socket, {"method": "readyForDataTransfer"})
@@ -191,90 +291,206 @@ class SpreadSheetServer:
                     del self.pointed_table[self.predecessor.node_id]
                 continue
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect((host, port))
-                self.send_message(sock, {"method": "imNotPointingAtYou", "node_id": self.predecessor.node_id})
-                sock.close()
+                self.send_message(self._peer(host, port), {"method": "imNotPointingAtYou", "node_id": self.predecessor.node_id})
             except:
                 pass
         # inform all nodes pointing at my predecessor that I'm taking over
         for node_id, row in self.pred_pointed_table.items():
             _, host, port = row
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            sock.connect((host, port))
+            try:
+                sock = self._peer(host, port)
+            except OSError:     # failed too (e.g. a virtual node of the same process)
+                continue
             self.flag += 1
             self.send_message(sock, {"method": "takeover", "old_id": self.predecessor.node_id, "new_id": self.node_id, "host": self.host, "port": self.port})
-            sock.close()
         
 
-    def send_request(self, socket, request):
-        """ send request (returns response) """
-        try:
-            print(f'sending request: {request}')
-            request_data = f'{json.dumps(request)}\n'.encode('utf-8')
-        
-            socket.sendall(request_data)
-            socket.settimeout(5)             # wait at most 5 sec
-
-            response_data = b''
-            while not response_data.endswith(b'\n'):
-                more = socket.recv(1)
-                if not more:
-                    raise EOFError("Socket connection broken")
-                response_data += more
-            print(f'received response: {response_data}')
-            return json.loads(response_data.decode('utf-8').strip())
-        except Exception as e:
-            print(f"Request: {request}\n Error: {e}\n")
-    
+    def _reader(self, sock):
+        """ get (or create) the buffered frame reader of a socket """
+        reader = self.readers.get(sock)
+        if reader is None:
+            reader = self.readers[sock] = FrameReader(sock)
+        return reader
+
+    def _drop_reader(self, sock):
+        """ forget the frame reader of a closed socket """
+        self.readers.pop(sock, None)
+
+    def _reply(self, sock, message):
+        """ answer a client, held back while writes before it are not durable yet (group commit) """
+        if self.spreadsheet.deferred():
+            self.held.append((sock, message))
+        else:
+            self.send_message(sock, message)
+
+    def commit(self):
+        """ sync the spreadsheet once its pending writes are due, then release held replies (returns sec until next due) """
+        timeout = self.spreadsheet.sync_timeout()
+        if timeout:         # not due yet
+            return timeout
+        if timeout == 0:    # None: nothing pending (virtual nodes share the spreadsheet: another one may have synced our writes)
+            start = time.perf_counter()
+            self.spreadsheet.sync()
+            self.metrics.stages["sync"].observe(time.perf_counter() - start)
+        held, self.held = self.held, []
+        for sock, message in held:
+            self.send_message(sock, message)
+        return None
+
+    def send_heartbeat(self, sock):
+        self.send_message(sock, {"method": "heartbeat"})
 
     def send_message(self, socket, message):
         """ send message (returns nothing) """
         try:
-            print(f'sending message: {message}')
-            message_data = f'{json.dumps(message)}\n'.encode('utf-8')
-            socket.sendall(message_data)
-            
+            if traced(self.log):    # hot path: don't even format the message unless traced
+                self.log.log(TRACE, "send %s", message)
+            message_data = dumps(message, socket in self.binary)
+            self._send(socket, [message_data])
+
+        except Exception as e:
+            self.log.warning("sending %s failed: %s", message, e)
+
+    def send_frame(self, socket, buffers):
+        """ send a binary frame given as buffers (Codec.reframe), never joined; decoded for a socket that takes json only """
+        try:
+            if socket not in self.binary:
+                self.send_message(socket, loads(b"".join(buffers)))
+                return
+            self._send(socket, buffers)
+
         except Exception as e:
-            print(f"message: {message}\n Error: {e}\n")
+            self.log.warning("sending a frame failed: %s", e)
+
+    def _send(self, socket, buffers):
+        """ queue the buffers of one frame on the socket: the loop writes every frame queued in a pass with one sendmsg per socket """
+        queue = self.queues.get(socket)
+        if queue is None:
+            if socket.fileno() == -1:
+                raise BrokenPipeError("socket closed")
+            queue = self.queues[socket] = SendQueue(socket)
+        queue.push(buffers)
+        self.metrics.sent(sum(len(buffer) for buffer in buffers))
 
     def handle_request(self, request, sock):
         """ handle incoming messages / requests (returns nothing) """
         try:
             if "status" in request:     # response
-                self.send_message(self.message_dic[request.get("msg_id")][0], request)
-                del self.message_dic[request.get("msg_id")]
+                if request.get("msg_id") == self.join_id:       # where we join the ring
+                    self._joined(request)
+                    return
+                if request.get("msg_id") in self.hello_dic:     # a peer's answer to our hello
+                    if request.get("protocol") == "binary":
+                        self.binary.add(self.hello_dic.pop(request.get("msg_id")))
+                    else:
+                        self.hello_dic.pop(request.get("msg_id"))
+                    return
+                if request.get("msg_id") in self.chord_dic:     # owner of one of our finger table rows
+                    self._chord_answer(request.get("msg_id"), request)
+                    return
+                if request.get("msg_id") in self.batch_dic:     # answer to one of our sub-batches
+                    batch = self.batch_dic.pop(request.get("msg_id"))
+                    del batch["keys"][request.get("msg_id")]
+                    self._merge_batch(batch, request.get("results", []))
+                    return
+                if request.get("msg_id") in self.range_dic:     # a later owner's part of a range scan we answered
+                    self._forward_range(request)
+                    return
+                if request.get("msg_id") in self.quorum_dic:    # a replica's answer to a quorum read or write
+                    self._quorum_answer(request.get("msg_id"), request)
+                    return
+                route = self.message_dic.get(request.get("msg_id"))
+                if route is None:       # answered after we gave up on it (timed out, or retried and answered twice)
+                    self.metrics.forwards["late"] += 1
+                    return
+                if request.get("message") == "Request timed out" and self._retry(request.get("msg_id"), route):
+                    return              # a hop further along gave up: the entry node tries another way first
+                if route["leased"] and "lease" in request:   # a lookup answer under lease: cache it, pass the lease on
+                    request = self._lease_answer(route["source"], route["leased"], request)
+                self.send_message(route["source"], dict(request, msg_id=route["source_id"]) if route["source_id"] else request)
+                if request.get("more"):     # streamed responses keep their route until the last part
+                    self._set_deadline(request.get("msg_id"), route)
+                else:
+                    self.metrics.stages["forward"].observe(time.perf_counter() - route["forwarded"])
+                    del self.message_dic[request.get("msg_id")]
 
             else:                       # request
                 method = request.get("method")
 
                 # If the node is responsible, perform the request
-                if "key" not in request or self._isResponsible(request.get("key")):  # perform the request, return result
+                target = self._target(request)
+                if target is None or self._isResponsible(target):  # perform the request, return result
+                    if method in PLACED_METHODS:
+                        self.metrics.hops.observe(request.get("hops", 0))
                     # spreadsheet operations
                     if method == "insert":
                         key = request.get("key")
-                        message = self.spreadsheet.insert(key, request["value"])
+                        replicas = self._quorum_replicas(request)
+                        message = self.spreadsheet.insert(key, request["value"]) if replicas else self._unavailable()
                         if request.get("msg_id"):
                             message["msg_id"] = request.get("msg_id")
-                        self.send_message(sock, message)
-                        self.send_message(self.successor.socket, {"method": "insert_replication", "repli_key": key, "value": request["value"]})
-                    elif method == "insert_replication":
-                        self.spreadsheet.insert(request["repli_key"], request["value"])
+                        if request.get("direct"):   # client routed by its ring cache: tell it who answered
+                            message["owner"] = self.node_id
+                        if message["status"] == "success":
+                            self._invalidate([key])
+                            self._replicate(sock, message, request, replicas, {"method": "insert_replication", "repli_key": key, "value": request["value"], "version": message["version"]})
+                        else:
+                            self._reply(sock, message)
+                    elif method == "insert_replication":    # kept unless a newer write of the key is known
+                        self.spreadsheet.insert(request["repli_key"], request["value"], request.get("version", 0))
+                        self._ack(sock, request)
                     elif method == "lookup":
                         key = request.get("key")
-                        message = self.spreadsheet.lookup(key)
+                        message = self.spreadsheet.lookup(key, raw=True)
                         if request.get("msg_id"):
                             message["msg_id"] = request.get("msg_id")
-                        self.send_message(sock, message)
+                        if request.get("direct"):
+                            message["owner"] = self.node_id
+                        if request.get("lease") and self._cacheable(request) and message["status"] == "success":
+                            message["lease"] = self.leases.grant(canonical_key(key), sock)
+                        self._read_quorum(sock, message, request)
+                    elif method == "replicaLookup":
+                        message = self.spreadsheet.lookup(request["repli_key"], raw=True)
+                        message["msg_id"] = request.get("msg_id")
+                        self._reply(sock, message)
                     elif method == "remove":
                         key = request.get("key")
-                        message = self.spreadsheet.remove(key)
+                        replicas = self._quorum_replicas(request)
+                        message = self.spreadsheet.remove(key) if replicas else self._unavailable()
                         if request.get("msg_id"):
                             message["msg_id"] = request.get("msg_id")
-                        self.send_message(sock, message)
-                        self.send_message(self.successor.socket, {"method": "remove_replication", "repli_key": key})
-                    elif method == "remove_replication":
-                        self.spreadsheet.remove(request["repli_key"])
+                        if request.get("direct"):
+                            message["owner"] = self.node_id
+                        if message["status"] == "success":
+                            self._invalidate([key])
+                            self._replicate(sock, message, request, replicas, {"method": "remove_replication", "repli_key": key, "version": message["version"]})
+                        else:
+                            self._reply(sock, message)
+                    elif method == "remove_replication":    # leaves a tombstone, unless a newer write of the key is known
+                        self.spreadsheet.remove(request["repli_key"], request.get("version", 0))
+                        self._ack(sock, request)
+
+                    # batch operations: split by owner, answer own share, forward the rest per next hop
+                    elif method in ("multi_insert", "multi_lookup", "multi_remove"):
+                        self._handle_batch(request, sock)
+                    elif method == "multi_insert_replication":
+                        for key, value, version in request["items"]:
+                            self.spreadsheet.insert(key, value, version)
+                    elif method == "multi_remove_replication":
+                        if "versions" in request:
+                            for key, version in zip(request["keys"], request["versions"]):
+                                self.spreadsheet.remove(key, version)
+                        else:   # copies we no longer hold
+                            for key in request["keys"]:
+                                self.spreadsheet.discard(key)
+
+                    # keys written at their owner: drop our cached answers, tell the nodes and clients we leased them to
+                    elif method == "invalidate":
+                        self._invalidate(request["keys"])
+
+                    # range scan: stream our part of [start, end) back, then pass the rest on to the successor
+                    elif method == "range_lookup":
+                        self._handle_range(request, sock)
 
                     # new node ask to join chord, the node happens to be its successor
                     elif method == "join":
@@ -291,42 +507,38 @@ class SpreadSheetServer:
                         port = request.get("port")
                         old_id = request.get("old_id")
                         new_id = request.get("new_id")
-                        new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        new_sock.connect((host, port))
+                        new_sock = self._peer(host, port)
                         # update finger table
                         for i in range(FINGER_NUM):
                             if self.finger_table[i][1] == old_id:
-                                self.finger_table[i][1:] = new_id, host, port, new_sock
+                                self.finger_table.set(i, new_id, host, port, new_sock)
                                 self.send_message(new_sock, {"method": "imPointingAtYou", "node_id": self.node_id, "host": self.host, "port": self.port})
                         # update successor if needed
                         if self.successor.node_id == old_id:
                             self.successor = Node(host, port, new_id, new_sock)
-                            # send its data to its successor => update its replication in successor
-                            for key, val in self.spreadsheet.data.items():
-                                if self._isResponsible(key):
-                                    self.send_message(self.successor.socket, {"method": "insert_replication", "repli_key": key, "value": val})
+                            # sync its data with its successor => repair its replication in successor
+                            self._anti_entropy()
 
                         self.send_message(new_sock, {"method": "flag"})     # inform takeover node it has completed finger table change
                         # send updated FT and PT info to successor
-                        self.send_message(self.successor.socket, {"method": "imYourUpdatedPred", "node_id": self.node_id, "host": self.host, "port": self.port, "PPT": {node_id: row[:-1] for node_id, row in self.pointed_table.items()}, "PFT": [row[:-1] for row in self.finger_table]})
+                        self.send_message(self.successor.socket, {"method": "imYourUpdatedPred", "node_id": self.node_id, "host": self.host, "port": self.port, "PPT": {node_id: row[:-1] for node_id, row in self.pointed_table.items()}, "PFT": self.finger_table.serialize()})
                     
                     elif method == "flag":  # an affected node finished updating finger table
                         self.flag -= 1 
                         if self.flag == 0:  # all nodes finished => stable
                             # send updated FT and PT info to successor
-                            self.send_message(self.successor.socket, {"method": "imYourUpdatedPred", "node_id": self.node_id, "host": self.host, "port": self.port, "PPT": {node_id: row[:-1] for node_id, row in self.pointed_table.items()}, "PFT": [row[:-1] for row in self.finger_table]})
+                            self.send_message(self.successor.socket, {"method": "imYourUpdatedPred", "node_id": self.node_id, "host": self.host, "port": self.port, "PPT": {node_id: row[:-1] for node_id, row in self.pointed_table.items()}, "PFT": self.finger_table.serialize()})
 
                     elif method == "imYourUpdatedPred":
                         self.predecessor = Node(request.get("host"), request.get("port"), request.get("node_id"), sock)
                         self.pred_finger_table = request.get("PFT")
                         self.pred_pointed_table = request.get("PPT")
-                        # send its data to its successor => update its replication in successor
-                        for key, val in self.spreadsheet.data.items():
-                            if self._isResponsible(key):
-                                self.send_message(self.successor.socket, {"method": "insert_replication", "repli_key": key, "value": val})
+                        # sync its data with its successor => repair its replication in successor
+                        self._anti_entropy()
 
                     elif method == "imYourPred":
                         pred_host, pred_port = request.get("host"), request.get("port")
+                        self.pool.adopt(pred_host, pred_port, sock, self)     # reuse the predecessor's connection for our own messages to it
 
                         if not self.predecessor:    # new node or node1 receiving
                             if not self.successor:  # node1 receiving
@@ -355,23 +567,55 @@ class SpreadSheetServer:
                                 self.send_message(row[-1], {"method": "newNode", "node_id": self.predecessor.node_id, "host": self.predecessor.host, "port": self.predecessor.port})
 
                     elif method == "readyForDataTransfer":
-                        # transfer original predecessor's replication data to new predecessor, and delete them
-                        to_delete = set()
-                        for key, val in self.spreadsheet.data.items():
-                            if int(key) <= int(self.last_pred_id):
-                                self.send_message(self.predecessor.socket, {"method": "insert_replication", "repli_key": key, "value": val})
-                                to_delete.add(key)
-                        for key in to_delete:
-                            self.spreadsheet.remove(key)
-                        # transfer new node's responsible data to it
-                        for key, val in self.spreadsheet.data.items():
-                            if not self._isResponsible(key):
-                                self.send_message(self.predecessor.socket, {"method": "insert_replication", "repli_key": key, "value": val})
-                                self.send_message(self.successor.socket, {"method": "remove_replication", "repli_key": key})
+                        pred_host, pred_port = self.predecessor.host, self.predecessor.port
+                        last_pred_id = int(self.last_pred_id)
+                        # transfer original predecessor's replication data (everything outside our old arc) to new predecessor,
+                        # and delete them once acked (with more than 2 copies we keep holding most of them); a node that was alone holds no replicas
+                        if last_pred_id != self.node_id:
+                            self._start_transfer(pred_host, pred_port, self._arc_segments(self.node_id + 1, last_pred_id + 1), move=self.replication <= 2)
+                        # transfer new node's responsible data to it: the arc [last_pred_id + 1, predecessor + 1) we no longer own;
+                        # once acked, our furthest replica drops its copies of them
+                        self._start_transfer(pred_host, pred_port, self._arc_segments(last_pred_id + 1, self.predecessor.node_id + 1), unreplicate=True)
+
+                    # bulk transfer: store a batch, ack it once durable
+                    elif method == "transferBatch":
+                        for key, value, version in request["items"]:
+                            self.spreadsheet.insert(key, value, version)
+                        self._reply(sock, {"method": "transferAck", "transfer_id": request["transfer_id"], "seq": request["seq"]})
+                    elif method == "transferAck":
+                        self._transfer_acked(request["transfer_id"], request["seq"])
+
+                    # anti-entropy: our predecessor's bucket hashes of its arc => the keys of buckets where our replicas differ
+                    # (skipped while we hand data off: keys still on their way to a new owner would look stale)
+                    elif method == "syncBuckets":
+                        buckets = [] if self.transfers else self.spreadsheet.differing_buckets(request["segments"], request["hashes"])
+                        if buckets:
+                            self.send_message(sock, {"method": "syncKeys", "host": self.host, "port": self.port, "segments": request["segments"], "keys": self.spreadsheet.key_hashes(request["segments"], buckets)})
+                    elif method == "syncKeys":
+                        self._repair_replicas(sock, request)
+                    elif method == "syncRepair":    # the owner's copy wins
+                        if not self.transfers:
+                            for key, value, version in request["items"]:
+                                self.spreadsheet.insert(key, value, version, force=True)
+                            for key in request["keys"]:
+                                self.spreadsheet.discard(key)
+
+                    # successor list: the nodes after our successor, where copies beyond the first go
+                    elif method == "getSuccessors":
+                        nodes = [[self.successor.node_id, self.successor.host, self.successor.port]] + self.next_successors if self.successor else []
+                        self.send_message(sock, {"method": "successors", "node_id": self.node_id, "nodes": nodes[:max(0, self.replication - 2)]})
+                    elif method == "successors":
+                        if self.successor and request.get("node_id") == self.successor.node_id:
+                            nodes = []
+                            for node in request["nodes"]:
+                                if node[0] in (self.node_id, self.successor.node_id):  # ring smaller than the list
+                                    break
+                                nodes.append(node)
+                            self.next_successors = nodes
 
                     elif method == "yourNewSucc":
                         succ_host, succ_port = request.get("host"), request.get("port")
-                        self.successor = Node(succ_host, succ_port, request.get("node_id"))
+                        self.successor = Node(succ_host, succ_port, request.get("node_id"), self._peer(succ_host, succ_port))
                         self.send_message(self.successor.socket, {"method": "updatePPT", "PPT": {node_id: row[:-1] for node_id, row in self.pointed_table.items()}})
                         # update finger table to include successor
                         self.update_finger_table(self.successor.node_id, self.successor.host, self.successor.port, True)
@@ -384,6 +628,7 @@ class SpreadSheetServer:
                         self.send_message(sock, message)
 
                     elif method == "imPointingAtYou":
+                        self.pool.adopt(request.get("host"), request.get("port"), sock, self)
                         if request.get("node_id") in self.pointed_table:
                             self.pointed_table[request.get("node_id")][0] += 1
                         else:
@@ -408,162 +653,1003 @@ class SpreadSheetServer:
                     elif method == "updatePPT":
                         self.pred_pointed_table = request.get("PPT")
 
+                    # membership known to this node: clients cache it to send keys straight to their owner
+                    elif method == "ringView":
+                        nodes = {self.node_id: [self.node_id, self.host, self.port]}
+                        for node in (self.predecessor, self.successor):
+                            if node:
+                                nodes[node.node_id] = [node.node_id, node.host, node.port]
+                        for _, node_id, host, port, _ in self.finger_table:
+                            if host is not None:
+                                nodes[node_id] = [node_id, host, port]
+                        message = {"status": "success", "node_id": self.node_id, "pred_id": self.predecessor.node_id if self.predecessor else None, "nodes": list(nodes.values()), "replication": self.replication, "key_bits": FINGER_NUM}
+                        if request.get("msg_id"):
+                            message["msg_id"] = request.get("msg_id")
+                        self.send_message(sock, message)
+
+                    # counters of this node, as json or Prometheus text; answered here, never routed
+                    elif method == "stats":
+                        stats = self.stats()
+                        message = {"status": "success", "text": prometheus([stats])} if request.get("format") == "prometheus" else {"status": "success", "stats": stats}
+                        if request.get("msg_id"):
+                            message["msg_id"] = request.get("msg_id")
+                        self.send_message(sock, message)
+
+                    # liveness: pooled peers heartbeat each other when idle
+                    elif method == "heartbeat":
+                        self.pool.seen(sock, heartbeat=True)
+                        self.send_message(sock, {"method": "heartbeatAck"})
+                    elif method == "heartbeatAck":
+                        self.pool.seen(sock, heartbeat=True)
+
+                    # a node or client that reads binary frames: answer (still in json), then send it binary frames
+                    elif method == "hello":
+                        binary = PROTOCOL == "binary" and "binary" in request.get("protocols", [])
+                        self.send_message(sock, {"status": "success", "protocol": "binary" if binary else "json", "msg_id": request.get("msg_id")})
+                        if binary:
+                            self.binary.add(sock)
+
                     elif method == "askForFT":
-                        return {"FT": [row[:-1] for row in self.finger_table]}
+                        return {"FT": self.finger_table.serialize()}
                     else:
                         pass
+                elif method == "lookup" and request.get("replica") and self.spreadsheet.version(request.get("key")):
+                    # consistency one read sent to a replica: a copy we hold answers it
+                    message = self.spreadsheet.lookup(request.get("key"), raw=True)
+                    if request.get("msg_id"):
+                        message["msg_id"] = request.get("msg_id")
+                    self._reply(sock, message)
+                elif self._cacheable(request) and (hit := self.cache.get(canonical_key(request.get("key")))):
+                    # hot key: a lookup we routed before, answered from our cache while its lease runs
+                    expiry, answer = hit
+                    message = dict(answer)
+                    if request.get("msg_id"):
+                        message["msg_id"] = request.get("msg_id")
+                    if request.get("lease"):
+                        message["lease"] = self.leases.grant(canonical_key(request.get("key")), sock, expiry - time.time())
+                    self._reply(sock, message)
                 else:   # not responsible, route to target "key"
                     if "msg_id" not in request: # client reach out to chord, add msg_id to the request
-                        request["msg_id"] = f"{self.node_id}_{self.msg_counter}"
-                        self.msg_counter += 1
-                    
-                    next_socket = self._route(request["key"], request)  # route to key
-                    self.message_dic[request["msg_id"]] = (sock, next_socket)
+                        request["msg_id"] = self._new_msg_id()
+                    source_id = None
+                    if request["msg_id"] in self.message_dic:   # routed back through us while the ring changes: keep both routes apart
+                        source_id, request["msg_id"] = request["msg_id"], self._new_msg_id()
+
+                    leased = None
+                    if self._cacheable(request) and (self.cache.capacity or request.get("lease")):
+                        # ask for a lease on the answer: to cache it, or to pass it on to a source that asked for one
+                        leased = (canonical_key(request.get("key")), bool(request.get("lease")))
+                        request["lease"] = True
+                    request["hops"] = request.get("hops", 0) + 1
+                    next_socket = self._route(target, request)  # route to key
+                    self._add_route(request["msg_id"], sock, next_socket, source_id, leased, request, request["hops"], target)
 
         except Exception as e:
-            print("error in handling request")
-            print(e)
+            self.log.exception("error in handling request %s", request)
             # return {"status": "error", "message": f"Invalid request {request}; method required"}
     
+    def stats(self, recount=True):
+        """ metrics snapshot plus the gauges read off live state: routing tables in flight, key counts from the sorted index
+            (recount False: the counts of the last call, for a thread other than the loop's, as counting catches the index up) """
+        if recount:
+            size = len(self.spreadsheet)
+            resp = sum(self.spreadsheet.arc_count(lo, hi) for lo, hi in self._own_segments())
+            self.key_counts = resp, size - resp
+        resp, replica = self.key_counts
+        stats = self.metrics.snapshot()
+        stats.update({"node_id": self.node_id,
+                      "pending": {"message_dic": len(self.message_dic), "batch_dic": len(self.batch_dic), "range_dic": len(self.range_dic),
+                                  "quorum_dic": len(self.quorum_dic), "transfers": len(self.transfers), "held": len(self.held)},
+                      "keys": {"responsible": resp, "replica": replica},
+                      "cache": {"keys": len(self.cache), "hits": self.cache.hits, "misses": self.cache.misses},
+                      "connections": len(self.client_sockets)})
+        return stats
+
     def _inInterval(self, start, end, val):
         """ test if val is in [start, end) in the chord """
         if start <= end:
             return start <= val < end
         return not (end <= val < start)
 
-    def _isResponsible(self, key):
-        """ test if is responsible for this key (lookup) """
+    def _own_arc(self):
+        """ ring arc [lo, hi) of the keys this node is responsible for (None: all keys) """
+        if not self.predecessor: return None
+        return self.predecessor.node_id + 1, self.node_id + 1
+
+    def _arc_segments(self, lo, hi):
+        """ ring arc [lo, hi) as non-wrapping stored key ranges (a key's ring position is the top FINGER_NUM bits of its stored hash) """
+        shift = HASH_BITS - FINGER_NUM
+        if lo <= hi:
+            return [(lo << shift, hi << shift)]
+        return [(lo << shift, MAX_KEY << shift), (0, hi << shift)]
+
+    def _own_segments(self):
+        """ stored key ranges this node is responsible for """
+        arc = self._own_arc()
+        return self._arc_segments(*arc) if arc else self._arc_segments(0, MAX_KEY)
+
+    def _start_transfer(self, host, port, segments, move=False, unreplicate=False):
+        """ stream the keys of segments to (host, port) in acked batches, without blocking the loop """
+        transfer = Transfer(self._new_msg_id(), host, port, segments, move, unreplicate)
+        self.transfers[transfer.transfer_id] = transfer
+        self.log.info("transfer %s of %s to %s:%s started", transfer.transfer_id, segments, host, port)
+        self._pump_transfer(transfer)
+
+    def _pump_transfer(self, transfer):
+        """ send batches until TRANSFER_WINDOW are unacked or every key is out """
+        while len(transfer.inflight) < TRANSFER_WINDOW and not transfer.exhausted():
+            try:
+                sock = self._peer(transfer.host, transfer.port)
+            except OSError:     # peer unreachable => retried from the last acked key on a later tick
+                return
+            seq, items = transfer.next_batch(self.spreadsheet)
+            self.send_message(sock, {"method": "transferBatch", "transfer_id": transfer.transfer_id, "seq": seq, "items": items})
+        if transfer.done():
+            self.log.info("transfer %s to %s:%s completed", transfer.transfer_id, transfer.host, transfer.port)
+            del self.transfers[transfer.transfer_id]
+
+    def _transfer_acked(self, transfer_id, seq):
+        """ a batch is stored at the peer: now drop what the transfer moves, then send more """
+        transfer = self.transfers.get(transfer_id)
+        if transfer is None:
+            return
+        keys = transfer.ack(seq)
+        if keys is None:
+            return
+        if transfer.move:
+            for key in keys:
+                self.spreadsheet.discard(key)
+        if transfer.unreplicate and keys:
+            replicas = self._replicas()
+            furthest = ([self.successor.node_id] + [node[0] for node in self.next_successors])[len(replicas) - 1] if replicas else None
+            # a full list: the furthest copy is one too many now (unless it is the new owner itself, in a ring of at most replication nodes)
+            if len(replicas) == self.replication - 1 and replicas[-1] and furthest != self.predecessor.node_id:
+                self.send_message(replicas[-1], {"method": "multi_remove_replication", "keys": keys})
+        self._pump_transfer(transfer)
+
+    def _anti_entropy(self):
+        """ send the bucket hashes of our arc to every replica, each answers with the keys of the buckets that differ """
+        self.next_sync = time.time() + ANTI_ENTROPY_INTERVAL
+        replicas = [replica for replica in self._replicas() if replica]
+        if not (self.predecessor and replicas):
+            return
+        segments = self._own_segments()
+        message = {"method": "syncBuckets", "segments": segments, "hashes": self.spreadsheet.bucket_hashes(segments)}
+        for replica in replicas:
+            self.send_message(replica, message)
+
+    def _repair_replicas(self, sock, request):
+        """ ship a replica only what differs: changed or missing keys, removals, and bulk transfers for empty ranges """
+        items, removed, empty = self.spreadsheet.diff(request["segments"], request["keys"])
+        if items or removed or empty:
+            self.log.info("anti-entropy: %d keys to repair, %d to remove, %d empty ranges", len(items), len(removed), len(empty))
+        for i in range(0, max(len(items), len(removed)), TRANSFER_BATCH):
+            self.send_message(sock, {"method": "syncRepair", "items": items[i:i + TRANSFER_BATCH], "keys": removed[i:i + TRANSFER_BATCH]})
+        ranges = []     # adjacent empty bucket ranges merged
+        for lo, hi in empty:
+            if ranges and ranges[-1][1] == lo:
+                ranges[-1] = (ranges[-1][0], hi)
+            else:
+                ranges.append((lo, hi))
+        if ranges:
+            self._start_transfer(request["host"], request["port"], ranges)
+
+    def _replicas(self):
+        """ connections to the nodes holding copies of our keys: the next replication - 1 nodes clockwise
+            (fewer in a smaller ring, None for one we cannot reach right now) """
+        if self.replication < 2 or not self.successor or self.successor.node_id == self.node_id:
+            return []
+        replicas = [self.successor.socket]
+        for node_id, host, port in self.next_successors:
+            if len(replicas) == self.replication - 1 or node_id == self.node_id:
+                break
+            try:
+                replicas.append(self._peer(host, port))
+            except OSError:
+                replicas.append(None)
+        return replicas
+
+    def _to_replicas(self, message):
+        """ send message to every replica we can reach (the others are repaired by anti-entropy) """
+        for replica in self._replicas():
+            if replica:
+                self.send_message(replica, message)
+
+    def _required(self, consistency, copies):
+        """ copies a request of this consistency level waits for """
+        if consistency == "all":
+            return copies
+        if consistency == "quorum":
+            return copies // 2 + 1
+        return 1
+
+    def _ack(self, sock, request):
+        """ acknowledge a replicated write the owner waits for, once it is durable here """
+        if request.get("msg_id"):
+            self._reply(sock, {"status": "success", "msg_id": request.get("msg_id")})
+
+    def _quorum_replicas(self, request):
+        """ (replicas we can reach, how many of them must answer) for a request of its consistency level; None if too few are reachable
+            (the unreachable ones still count among the copies, so a level is never weakened by a failure) """
+        replicas = self._replicas()
+        waiting = self._required(request.get("consistency"), 1 + len(replicas)) - 1
+        reachable = [replica for replica in replicas if replica]
+        return (reachable, waiting) if waiting <= len(reachable) else None
+
+    def _unavailable(self):
+        """ failure of a request whose consistency level needs more copies than we can reach right now, answered at once """
+        return {"status": "failure", "message": "Not enough replicas reachable"}
+
+    def _quorum_failure(self, message, failure):
+        """ failure in place of the answer message would have been (same msg_id and owner) """
+        failure = dict(failure)
+        for field in ("msg_id", "owner"):
+            if field in message:
+                failure[field] = message[field]
+        return failure
+
+    def _await_quorum(self, op, replica, message):
+        """ send message to a replica under a new msg_id, its answer counted towards op """
+        sub_id = self._new_msg_id()
+        self.quorum_dic[sub_id] = (op, replica)
+        heapq.heappush(self.deadlines, (op["deadline"], sub_id))
+        self.send_message(replica, dict(message, msg_id=sub_id))
+
+    def _replicate(self, sock, message, request, replicas, replication):
+        """ copy a write to the replicas we reach (the others are repaired by anti-entropy later), reply once as many copies as its
+            consistency level asks for (ours included) have it """
+        replicas, waiting = replicas
+        op = {"source": sock, "message": message, "waiting": waiting, "deadline": time.time() + self._wait(request.get("hops", 0))}
+        if op["waiting"] <= 0:
+            self._reply(sock, message)
+        for replica in replicas:
+            if op["waiting"] > 0:
+                self._await_quorum(op, replica, replication)
+            else:
+                self.send_message(replica, replication)
+
+    def _read_quorum(self, sock, message, request):
+        """ answer a lookup from our copy, or ask the replicas first when its consistency level wants more copies """
+        replicas = self._quorum_replicas(request)
+        if message.get("message") == "Invalid key value" or replicas and replicas[1] <= 0:
+            self._reply(sock, message)
+            return
+        if replicas is None:
+            self._reply(sock, self._quorum_failure(message, self._unavailable()))
+            return
+        replicas, waiting = replicas
+        op = {"source": sock, "message": message, "waiting": waiting, "deadline": time.time() + self._wait(request.get("hops", 0)), "key": request.get("key"), "answers": []}
+        for replica in replicas:
+            self._await_quorum(op, replica, {"method": "replicaLookup", "repli_key": op["key"]})
+
+    def _quorum_answer(self, msg_id, response):
+        """ a replica acked a write or answered a read: reply once enough copies did """
+        op, replica = self.quorum_dic.pop(msg_id)
+        if "answers" in op:
+            op["answers"].append((replica, response))
+        op["waiting"] -= 1
+        if op["waiting"] == 0:
+            if "answers" in op:
+                self._resolve_read(op)
+            self._reply(op["source"], op["message"])
+
+    def _resolve_read(self, op):
+        """ quorum read: the answer with the newest version wins, copies behind it are repaired """
+        answers = [(None, op["message"])] + op["answers"]
+        newest = max((answer for _, answer in answers), key=lambda answer: answer.get("version", 0))
+        version = newest.get("version", 0)
+        if newest["status"] == "success":
+            repair = {"method": "insert_replication", "repli_key": op["key"], "value": newest["value"], "version": version}
+        else:
+            repair = {"method": "remove_replication", "repli_key": op["key"], "version": version}
+        for replica, answer in answers:
+            if answer.get("version", 0) >= version:
+                continue
+            if replica is None:     # our own copy is behind
+                self._invalidate([op["key"]])
+                if newest["status"] == "success":
+                    self.spreadsheet.insert(op["key"], newest["value"], version)
+                else:
+                    self.spreadsheet.remove(op["key"], version)
+            else:
+                self.send_message(replica, repair)
+        message = {field: value for field, value in newest.items() if field != "msg_id"}
+        for field in ("msg_id", "owner"):
+            if field in op["message"]:
+                message[field] = op["message"][field]
+        op["message"] = message
+
+    def _cacheable(self, request):
+        """ a lookup a cached answer may serve: consistency one and not a replica read """
+        return request.get("method") == "lookup" and not request.get("consistency") and not request.get("replica")
+
+    def _lease_answer(self, source, leased, response):
+        """ a leased lookup answer passing back through us: cache it for the lease, lease it on to source if it asked """
+        key, wanted = leased
+        lease = response["lease"]
+        self.cache.put(key, {field: value for field, value in response.items() if field not in ("msg_id", "lease")}, lease)
+        response = dict(response)
+        if wanted:
+            response["lease"] = self.leases.grant(key, source, lease)
+        else:
+            del response["lease"]
+        return response
+
+    def _invalidate(self, keys):
+        """ keys changed: drop our cached answers of them and invalidate the copies we leased out (their holders pass it on) """
+        holders = {}    # {sock: [keys]}
+        for key in keys:
+            key = canonical_key(key)
+            self.cache.invalidate(key)
+            for sock in self.leases.revoke(key):
+                holders.setdefault(sock, []).append(key)
+        for sock, keys in holders.items():
+            self.send_message(sock, {"method": "invalidate", "keys": keys})
+
+    def tick_successors(self):
+        """ ask our successor for the nodes after it (only copies beyond the first need them) """
+        if self.replication <= 2 or time.time() < self.next_poll:
+            return
+        self.next_poll = time.time() + self.pool.heartbeat_interval
+        if self.successor and self.successor.socket and self.successor.node_id != self.node_id:
+            self.send_message(self.successor.socket, {"method": "getSuccessors"})
+
+    def tick_anti_entropy(self):
+        """ periodic anti-entropy round """
+        if time.time() >= self.next_sync:
+            self._anti_entropy()
+
+    def tick_transfers(self):
+        """ resume stalled transfers from their last acked key (e.g. after a dropped connection) """
+        for transfer in list(self.transfers.values()):
+            if transfer.stalled():
+                if transfer.retries >= TRANSFER_RETRIES:
+                    self.log.warning("transfer %s to %s:%s abandoned", transfer.transfer_id, transfer.host, transfer.port)
+                    del self.transfers[transfer.transfer_id]
+                    continue
+                self.log.info("transfer %s to %s:%s resumed", transfer.transfer_id, transfer.host, transfer.port)
+                transfer.rewind()
+            self._pump_transfer(transfer)
+
+    def tick_chord(self):
+        """ finish the finger table with the rows answered so far once the establishChord answers are overdue """
+        if self.chord_deadline and time.time() >= self.chord_deadline:
+            self.log.warning("%d finger table rows unanswered", len(self.chord_dic))
+            self.chord_dic.clear()
+            self._chord_done(self.chord_affected)
+
+    def tick_info(self):
+        """ log connection infos every INFO_INTERVAL sec (one info record), from the loop: the tables it reads change on it """
+        if time.time() < self.next_info:
+            return
+        self.next_info = time.time() + INFO_INTERVAL
+        stats = self.stats()
+        lines = [f"node_id: {self.node_id}"]
+        resp, repl = stats["keys"]["responsible"], stats["keys"]["replica"]
+        lines.append(f"data size: {resp + repl}\t resp: {resp}\t repl: {repl}")
+        lines.append(f"ops: {sum(stats['ops'].values())}\t in flight: {stats['pending']['message_dic']}\t bytes in/out: {stats['bytes']['in']}/{stats['bytes']['out']}")
+        if self.cache.capacity:
+            lines.append(f"cache: {stats['cache']['keys']} keys\t hits: {stats['cache']['hits']}\t misses: {stats['cache']['misses']}")
+        # lines.append(f"resp: {[key for key in self.spreadsheet.data.keys() if self._isResponsible(key)]}")
+        # lines.append(f"repl: {[key for key in self.spreadsheet.data.keys() if not self._isResponsible(key)]}")
+
+        if self.predecessor: lines.append(f"predecessor: {self.predecessor.host}:{self.predecessor.port}, {self.predecessor.node_id}")
+        if self.successor: lines.append(f"successor: {self.successor.host}:{self.successor.port}, {self.successor.node_id}")
+
+        lines.append(f'\tfinger_table ({self.node_id}): ')
+        for target_id, node_id, host, port, sock in self.finger_table:
+            lines.append(f'{target_id}\t{node_id}\t: {host}:{port}, {"con" if sock else "not"}')
+        # lines.append(f'\tpointed_table ({self.node_id}): ')
+        # for node_id, row in self.pointed_table.items():
+        #     lines.append(f'{node_id}\t{row[:-1]}')
+        # lines.append(f'\tpred_finger_table ({self.predecessor.node_id if self.predecessor else None}): ')
+        # for target_id, node_id, host, port in self.pred_finger_table:
+        #     lines.append(f'{target_id}\t{node_id}\t: {host}:{port}')
+        # lines.append(f'\tpred_pointed_table ({self.predecessor.node_id if self.predecessor else None}): ')
+        # for node_id, row in self.pred_pointed_table.items():
+        #     lines.append(f'{node_id}\t: {row}')
+        self.log.info("\n".join(lines))
+
+    def tick(self):
+        """ periodic work of both engines' loops """
+        self.tick_transfers()
+        self.tick_anti_entropy()
+        self.tick_successors()
+        self.tick_chord()
+        self.tick_info()
+        self.leases.prune()
+        self.expire_forwards()
+        if self.worker:
+            self.worker.publish(self)
+
+    def _target(self, request):
+        """ ring position a request is routed to: where its key is placed for data requests, the key itself for ring messages
+            (None: perform it here, no key or an invalid one the spreadsheet rejects) """
+        if "key" not in request:
+            return None
+        if request.get("method") in PLACED_METHODS:
+            return key_position(request.get("key"), FINGER_NUM)
+        return int(request.get("key")) % MAX_KEY
+
+    def _isResponsible(self, position):
+        """ test if is responsible for this ring position (lookup) """
         if not self.predecessor: return True
-        key = int(key)
-        return self._inInterval(self.predecessor.node_id+1, self.node_id+1, key)
+        return self._inInterval(self.predecessor.node_id+1, self.node_id+1, position)
+
+    def _next_hop(self, target_id):
+        """ pick the finger table socket to route target_id to (bisect over the rows' target ids); straight to another worker of our node that owns it """
+        if self.worker:
+            port = self.worker.sibling(self, target_id)
+            if port is not None:
+                try:
+                    return self._peer(self.host, port)
+                except OSError:     # backing off: route as usual
+                    pass
+        if traced(self.log, logging.DEBUG):
+            self.log.debug("routing %s to %s", target_id, self.finger_table[self.finger_table.row_of(target_id)][1])
+        # row without a connection => route to the successor
+        return self.finger_table.next_hop(target_id)
 
     def _route(self, target_id, message):
         """ route target_id based on finger table """
-        for i in range(FINGER_NUM):
-            last = self.finger_table[i-1][0]
-            curr = self.finger_table[i][0]
-            if self._inInterval(last, curr, target_id):
-                print(f"routing to {self.finger_table[i-1][1]}")
-                if self.finger_table[i-1][-1]:
-                    self.send_message(self.finger_table[i-1][-1], message)
-                    return self.finger_table[i-1][-1]
-        # no match => only two nodes, so route to the other node
-        self.send_message(self.finger_table[0][-1], message)
-        return self.finger_table[0][-1]
+        next_socket = self._next_hop(target_id)
+        self.send_message(next_socket, message)
+        return next_socket
+
+    def _add_route(self, msg_id, source, next_socket, source_id, leased, request, hops, target):
+        """ remember where the answer to a request we forwarded goes back to """
+        route = {"source": source, "next": next_socket, "source_id": source_id, "leased": leased, "request": request, "hops": hops, "target": target,
+                 "tries": 0 if hops == 1 else FORWARD_RETRIES,     # only the entry node retries, the others report timeouts to it
+                 "forwarded": time.perf_counter()}
+        self.message_dic[msg_id] = route
+        self._set_deadline(msg_id, route)
+
+    def relay(self, sock, frame):
+        """ zero-decode forwarding: pass on a binary frame we only route, read from its header alone, its body never decoded nor copied
+            (returns the header if it did, None: the frame needs handle_request) """
+        header = peek(frame)
+        if header is None or "msg_id" not in header:
+            return None
+        try:
+            return self._relay(sock, frame, header)
+        except Exception:
+            self.log.exception("error in relaying %s", header)
+            return None
+
+    def _relay(self, sock, frame, header):
+        msg_id = header["msg_id"]
+        if "status" in header:      # an answer on its way back: a plain success, to a source that reads binary frames
+            route = self.message_dic.get(msg_id)
+            if route is None or route["leased"] or header["status"] != "success" or route["source"] not in self.binary:
+                return None
+            self.send_frame(route["source"], reframe(frame, route["source_id"]) if route["source_id"] else [frame])
+            if header.get("more"):
+                self._set_deadline(msg_id, route)
+            else:
+                self.metrics.stages["forward"].observe(time.perf_counter() - route["forwarded"])
+                del self.message_dic[msg_id]
+            return header
+
+        method = header.get("method")
+        if method not in PLACED_METHODS or "key" not in header or header.get("hops", 0) >= 255:
+            return None
+        if method == "lookup" and (self.cache.capacity or header.get("lease") or header.get("replica")):
+            return None             # the cache, leases and replica reads need the whole request
+        target = key_position(header["key"], FINGER_NUM)
+        if target is None or self._isResponsible(target):
+            return None
+        next_socket = self._next_hop(target)
+        if next_socket not in self.binary:
+            return None
+        source_id = None
+        if msg_id in self.message_dic:  # routed back through us while the ring changes: keep both routes apart
+            source_id, msg_id = msg_id, self._new_msg_id()
+        hops = header.get("hops", 0) + 1
+        buffers = reframe(frame, msg_id if source_id else None, hops)
+        if traced(self.log):
+            self.log.log(TRACE, "relay %s", header)
+        self.send_frame(next_socket, buffers)
+        self._add_route(msg_id, sock, next_socket, source_id, None, buffers, hops, target)
+        return header
+
+    def _wait(self, hops):
+        """ sec to wait for an answer to a message sent on by a node hops away from the entry node: shorter the further along,
+            so a node always gives up before the one upstream of it does """
+        return max(FORWARD_MIN, FORWARD_TIMEOUT * FORWARD_DECAY ** hops)
+
+    def _set_deadline(self, msg_id, route):
+        """ (re)start the wait for the answer of a forwarded request """
+        route["deadline"] = time.time() + self._wait(route["hops"] - 1)
+        heapq.heappush(self.deadlines, (route["deadline"], msg_id))
+
+    def _deadline(self, msg_id):
+        """ current deadline of whatever waits for the answer to msg_id (None: answered) """
+        if msg_id in self.message_dic:
+            return self.message_dic[msg_id]["deadline"]
+        if msg_id in self.quorum_dic:
+            return self.quorum_dic[msg_id][0]["deadline"]
+        if msg_id in self.batch_dic:
+            return self.batch_dic[msg_id]["deadline"]
+        if msg_id in self.range_dic:
+            return self.range_dic[msg_id][2]
+        return None
+
+    def forward_timeout(self):
+        """ sec until the next forwarded request, replica op, sub-batch or range scan is overdue (None: nothing in flight) """
+        while self.deadlines:
+            deadline, msg_id = self.deadlines[0]
+            if self._deadline(msg_id) == deadline:
+                return max(0, deadline - time.time())
+            heapq.heappop(self.deadlines)   # answered, or its deadline moved
+        return None
+
+    def _retry(self, msg_id, route):
+        """ resend an overdue request along another finger, if the route has a retry left (returns whether it did) """
+        alternate = self.finger_table.alternate_hop(route["target"], route["next"]) if route["tries"] < FORWARD_RETRIES else None
+        if alternate is None:
+            return False
+        self.log.info("forward %s to %s overdue, retrying along another finger", msg_id, self.client_sockets.get(route["next"]))
+        self.metrics.forwards["retried"] += 1
+        route["tries"] += 1
+        route["next"] = alternate
+        if type(route["request"]) is list:     # a relayed frame
+            self.send_frame(alternate, route["request"])
+        else:
+            self.send_message(alternate, route["request"])
+        self._set_deadline(msg_id, route)
+        return True
+
+    def expire_forwards(self):
+        """ overdue forwarded requests: resend along another finger, or answer upstream with a timeout once out of retries;
+            overdue replica ops, sub-batches and range scans are answered with a failure (not "Request timed out": that is
+            no hop giving up, nothing to retry upstream) """
+        while self.forward_timeout() == 0:
+            _, msg_id = heapq.heappop(self.deadlines)
+            if msg_id not in self.message_dic:
+                self._expire_sub(msg_id)
+                continue
+            route = self.message_dic[msg_id]
+            if self._retry(msg_id, route):
+                continue
+            self.log.warning("forward %s to %s timed out", msg_id, self.client_sockets.get(route["next"]))
+            self.metrics.forwards["timed_out"] += 1
+            del self.message_dic[msg_id]
+            self.send_message(route["source"], {"status": "failure", "message": "Request timed out", "msg_id": route["source_id"] or msg_id})
+
+    def _expire_sub(self, msg_id):
+        """ give up on the answer to a message sent for a quorum op, a batch or a range scan """
+        if msg_id in self.quorum_dic:
+            op, replica = self.quorum_dic.pop(msg_id)
+            if op["waiting"] <= 0:      # answered already, this replica was not needed
+                return
+            op["waiting"] = 0
+            failure = self._quorum_failure(op["message"], {"status": "failure", "message": "Replicas timed out"})
+            self._reply(op["source"], failure)
+        elif msg_id in self.batch_dic:
+            batch = self.batch_dic.pop(msg_id)
+            failure = {"status": "failure", "message": "Next node timed out"}
+            self._merge_batch(batch, [[key, failure] for key in batch["keys"].pop(msg_id)])
+        else:
+            source, source_id, _, _ = self.range_dic.pop(msg_id)
+            failure = {"status": "failure", "message": "Next node timed out"}
+            if source_id:
+                failure["msg_id"] = source_id
+            self._reply(source, failure)
+        self.log.warning("answer to %s timed out", msg_id)
+        self.metrics.forwards["timed_out"] += 1
+
+    def _new_msg_id(self):
+        """ unique msg_id for a message this node puts into the chord """
+        msg_id = f"{self.node_id}_{self.msg_counter}"
+        self.msg_counter += 1
+        return msg_id
+
+    def _handle_batch(self, request, sock):
+        """ multi_insert / multi_lookup / multi_remove: one message per next hop, one merged response """
+        method = request.get("method")
+        field = "items" if method == "multi_insert" else "keys"
+        local, remote = [], {}      # remote: {next_socket: [entries]}
+        for entry in request[field]:
+            position = key_position(entry[0] if method == "multi_insert" else entry, FINGER_NUM)
+            if position is None or self._isResponsible(position):   # invalid key => let the spreadsheet reject it here
+                local.append(entry)
+            else:
+                remote.setdefault(self._next_hop(position), []).append(entry)
+
+        # own share, replicated to the successor as one message
+        results = []
+        if method == "multi_insert":
+            results = [[key, self.spreadsheet.insert(key, value)] for key, value in local]
+            replicated = [[key, value, result["version"]] for (key, value), (_, result) in zip(local, results) if result["status"] == "success"]
+            self._invalidate([key for key, _, _ in replicated])
+            if replicated:
+                self._to_replicas({"method": "multi_insert_replication", "items": replicated})
+        elif method == "multi_lookup":
+            results = [[key, self.spreadsheet.lookup(key)] for key in local]
+        else:
+            results = [[key, self.spreadsheet.remove(key)] for key in local]
+            replicated = [(key, result["version"]) for key, result in results if result["status"] == "success"]
+            self._invalidate([key for key, _ in replicated])
+            if replicated:
+                self._to_replicas({"method": "multi_remove_replication", "keys": [key for key, _ in replicated], "versions": [version for _, version in replicated]})
+
+        batch = {"source": sock, "msg_id": request.get("msg_id"), "results": results, "waiting": len(remote), "keys": {},
+                 "deadline": time.time() + self._wait(request.get("hops", 0))}
+        for next_socket, entries in remote.items():
+            sub_id = self._new_msg_id()
+            self.batch_dic[sub_id] = batch
+            batch["keys"][sub_id] = [entry[0] for entry in entries] if method == "multi_insert" else entries
+            heapq.heappush(self.deadlines, (batch["deadline"], sub_id))
+            self.send_message(next_socket, {"method": method, field: entries, "msg_id": sub_id})
+        if not remote:
+            self._merge_batch(batch, [])
+
+    def _merge_batch(self, batch, results):
+        """ add a sub-batch's results, respond once every sub-batch is in """
+        batch["results"].extend(results)
+        batch["waiting"] -= 1
+        if batch["waiting"] <= 0:
+            message = {"status": "success", "results": batch["results"]}
+            if batch["msg_id"]:
+                message["msg_id"] = batch["msg_id"]
+            self._reply(batch["source"], message)
+
+    def _handle_range(self, request, sock):
+        """ range_lookup: our keys placed in [start, end) of the ring in chunks of RANGE_CHUNK, "more" on all but the scan's last response """
+        try:
+            start, end = int(request["start"]), min(int(request["end"]), MAX_KEY)
+        except (KeyError, TypeError, ValueError):
+            start, end = -1, -1
+        if not 0 <= start < end:
+            message = {"status": "failure", "message": "Invalid key range"}
+            if request.get("msg_id"):
+                message["msg_id"] = request.get("msg_id")
+            self._reply(sock, message)
+            return
+        # we own start: our keys go up to our node_id, or to the top of the key space when our arc wraps past it
+        local_end = end
+        if self.predecessor and self.node_id >= start:
+            local_end = min(end, self.node_id + 1)
+        more = local_end < end
+
+        shift = HASH_BITS - FINGER_NUM
+        items = self.spreadsheet.range(start << shift, local_end << shift)
+        chunk = list(itertools.islice(items, RANGE_CHUNK))
+        while True:
+            next_chunk = list(itertools.islice(items, RANGE_CHUNK))
+            last = not next_chunk and not more
+            if chunk or last:
+                message = {"status": "success", "items": chunk, "more": not last}
+                if request.get("msg_id"):
+                    message["msg_id"] = request.get("msg_id")
+                self._reply(sock, message)
+            if not next_chunk:
+                break
+            chunk = next_chunk
+
+        if more:    # the successor owns local_end
+            sub_id = self._new_msg_id()
+            hops = request.get("hops", 0)
+            self.range_dic[sub_id] = (sock, request.get("msg_id"), time.time() + self._wait(hops), hops)
+            heapq.heappush(self.deadlines, (self.range_dic[sub_id][2], sub_id))
+            self.send_message(self.successor.socket, {"method": "range_lookup", "key": local_end, "start": local_end, "end": end, "msg_id": sub_id})
+
+    def _forward_range(self, response):
+        """ pass a later owner's range_lookup response on, in order behind our own """
+        source, msg_id, _, hops = self.range_dic.pop(response["msg_id"])
+        if response.get("more"):    # the scan goes on: wait for its next part afresh
+            deadline = time.time() + self._wait(hops)
+            self.range_dic[response["msg_id"]] = (source, msg_id, deadline, hops)
+            heapq.heappush(self.deadlines, (deadline, response["msg_id"]))
+        response = dict(response)
+        if msg_id:
+            response["msg_id"] = msg_id
+        else:
+            del response["msg_id"]
+        self._reply(source, response)
 
     def update_finger_table(self, joining_node_id, joining_host, joining_port, updateTargetPT):
         """ Update the finger table entries when a new node joins. """
         affected_sockets = set()
-        for i in range(FINGER_NUM):
-            if self._inInterval(self.finger_table[i][0], self.finger_table[i][1], joining_node_id) and joining_node_id != self.finger_table[i][1]:
-                if self.finger_table[i][-1]:
-                    self.send_message(self.finger_table[i][-1], {"method": "imNotPointingAtYou", "node_id": self.node_id})
-                    affected_sockets.add(self.finger_table[i][-1])
-                self.finger_table[i][1:] = joining_node_id, joining_host, joining_port, None
-                if self.predecessor and joining_node_id == self.predecessor.node_id:
-                    self.finger_table[i][-1] = self.predecessor.socket
-                if self.successor and joining_node_id == self.successor.node_id:
-                    self.finger_table[i][-1] = self.successor.socket
-                if self.finger_table[i][-1] is None:
-                    self.finger_table[i][-1] = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    self.finger_table[i][-1].connect((joining_host, joining_port))
-                if updateTargetPT:  # inform target to update pointed_table
-                    self.send_message(self.finger_table[i][-1], {"method": "imPointingAtYou", "node_id": self.node_id, "host": self.host, "port": self.port})
-                    affected_sockets.add(self.finger_table[i][-1])
+        for i in reversed(self.finger_table.affected_by(joining_node_id)):     # only rows the new node is closer for
+            if self.finger_table[i][-1]:
+                self.send_message(self.finger_table[i][-1], {"method": "imNotPointingAtYou", "node_id": self.node_id})
+                affected_sockets.add(self.finger_table[i][-1])
+            sock = None
+            if self.predecessor and joining_node_id == self.predecessor.node_id:
+                sock = self.predecessor.socket
+            if self.successor and joining_node_id == self.successor.node_id:
+                sock = self.successor.socket
+            if sock is None:
+                sock = self._peer(joining_host, joining_port)
+            self.finger_table.set(i, joining_node_id, joining_host, joining_port, sock)
+            if updateTargetPT:  # inform target to update pointed_table
+                self.send_message(sock, {"method": "imPointingAtYou", "node_id": self.node_id, "host": self.host, "port": self.port})
+                affected_sockets.add(sock)
         # inform successor to update pred_finger_table
         if self.successor and self.successor.socket:
-            self.send_message(self.successor.socket, {"method": "updatePFT", "PFT": [row[:-1] for row in self.finger_table]})
+            self.send_message(self.successor.socket, {"method": "updatePFT", "PFT": self.finger_table.serialize()})
         for sock in affected_sockets:
             self.send_message(sock, {"method": "chordEstablishmentCompleted"})
 
 
-def start_server(project_name, node_id):
-    
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as master_socket:
+def set_key_bits(key_bits):
+    """ size the identifier space (and the finger tables) of every server of this process: 2**key_bits ring positions """
+    global FINGER_NUM, MAX_KEY
+    FINGER_NUM = key_bits
+    MAX_KEY = 2 ** key_bits
+
+def set_name_server(host, port):
+    """ name server every server of this process registers with and finds its entry node through """
+    global NAME_SERVER
+    NAME_SERVER = (host, int(port))
+
+def set_protocol(protocol):
+    """ frames every server of this process offers and accepts: binary, or json only """
+    global PROTOCOL
+    PROTOCOL = protocol
+
+def vnode_ids(node_id, vnodes):
+    """ ring ids of a process's virtual nodes: node_id itself for one, else hashes of it, placed like keys """
+    if vnodes <= 1:
+        return [int(node_id) % MAX_KEY]
+    ids = []
+    i = 0
+    while len(ids) < vnodes:
+        vnode_id = key_position(f"{node_id}#{i}", FINGER_NUM)
+        if vnode_id not in ids:
+            ids.append(vnode_id)
+        i += 1
+    return ids
+
+def vnode_sheets(node_id, vnodes, **sheet_options):
+    """ storage of a process's virtual nodes: its own spreadsheet for one, else views of one shared spreadsheet """
+    if vnodes <= 1:
+        return [SpreadSheet(node_id=int(node_id) % MAX_KEY, **sheet_options)]
+    sheet = SpreadSheet(node_id=int(node_id) % MAX_KEY, namespaces=vnodes, **sheet_options)
+    return [SheetView(sheet, i) for i in range(vnodes)]
+
+def vnode_settled(server):
+    """ the next virtual node may join: this one is in the ring and had time to take over its data """
+    return server.joined_at is not None and time.time() - server.joined_at >= VNODE_JOIN_GAP
+
+def check_sockets(server):
+    """ read the connections of the ring around server, repair it where they closed """
+    # check successor
+    if server.successor and server.successor.socket and server.successor.socket not in server.client_sockets:
+        if server.successor.socket.fileno() == -1:
+            server.log.warning("successor socket is invalid or closed")
+            server.successor.socket = None
+        else:
+            server.client_sockets[server.successor.socket] = (server.successor.host, server.successor.port)
+    # check predecessor
+    if server.predecessor and server.predecessor.socket and server.predecessor.socket not in server.client_sockets:
+        if server.predecessor.socket.fileno() == -1:
+            server.log.warning("predecessor socket is invalid or closed")
+            server.predecessor.socket = None
+            server.handle_pred_failure()
+        else:
+            server.client_sockets[server.predecessor.socket] = (server.predecessor.host, server.predecessor.port)
+    # check finger table
+    for i in range(FINGER_NUM):
+        target_id, node_id, host, port, sock = server.finger_table[i]
+        if node_id == server.node_id:   # pointing to itself => ignore
+            continue
+        if sock is None:    # row removed => ignore
+            continue
+        if sock.fileno() == -1: # socket invalid => reset row in finger table
+            server.log.warning("finger table socket (%s) is invalid or closed", node_id)
+            server.finger_table.reset(i)
+            continue
+        if sock not in server.client_sockets:   # new socket => add to client_sockets
+            server.client_sockets[sock] = (host, port)
+    # check pooled peer connections (their replies and heartbeats must be read too)
+    server.pool.watch(server.predecessor.socket if server.predecessor else None)
+    for sock in server.pool.sockets(server):
+        if sock not in server.client_sockets:
+            server.client_sockets[sock] = server.pool.by_sock[sock].addr
+
+def flush_queues(queues, owner, first, sockets=None):
+    """ write the queued frames of sockets (default: all of them) as far as they go without blocking, drop the ones that broke """
+    for sock in list(queues if sockets is None else sockets):
+        queue = queues.get(sock)
+        if queue is None:
+            continue
+        if sock.fileno() == -1:     # closed without drop_socket (a replaced connection)
+            queues.pop(sock)
+            continue
+        try:
+            queue.flush()
+        except OSError as e:
+            server = owner.get(sock, first)
+            server.log.info("%s disconnected unexpectedly: %s", server.client_sockets.get(sock), e)
+            server.drop_socket(sock)
+
+def start_server(project_name, node_id, replication=REPLICATION, vnodes=VNODES, cache_size=CACHE_SIZE, metrics_port=None, worker=None, **sheet_options):
+    host = socket.getfqdn()
+    ids = vnode_ids(node_id, vnodes)
+    sheets = vnode_sheets(node_id, vnodes, **sheet_options)
+    pool = PeerPool(lambda local, host, port: local._connect(host, port))   # shared by the virtual nodes
+    queues = {}         # {sock: SendQueue}, shared by the virtual nodes too
+    masters = {}        # {master_socket: server}, one listening socket per virtual node
+
+    def add_vnode(entry):
+        i = len(masters)
+        master_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         master_socket.bind(('', 0))
         master_socket.listen(5)
-        server = SpreadSheetServer(project_name, node_id, socket.getfqdn(), master_socket.getsockname()[1])
-        print(f"Listening on port {server.port}")
-        if server.successor:
-            print(server.successor.node_id)
+        server = SpreadSheetServer(project_name, ids[i], host, master_socket.getsockname()[1], replication, sheets[i], pool, entry, cache_size, queues)
+        masters[master_socket] = server
+        server.log.info("listening on port %s", server.port)
         # Background threads
-        threading.Thread(target=register_name_server, args=(server.port, f'{project_name}_{node_id}'), daemon=True).start()
-        threading.Thread(target=print_info, args=(server,), daemon=True).start()
+        threading.Thread(target=register_name_server, args=(server.port, server.project_name), daemon=True).start()
+        return server
 
-        server.client_sockets = {}
-        while True:
-            # check successor
-            if server.successor and server.successor.socket and server.successor.socket not in server.client_sockets:
-                if server.successor.socket.fileno() == -1:
-                    print("Successor socket is invalid or closed")
-                    server.successor.socket = None
-                else:
-                    server.client_sockets[server.successor.socket] = (server.successor.host, server.successor.port)
-            # check predecessor
-            if server.predecessor and server.predecessor.socket and server.predecessor.socket not in server.client_sockets:
-                if server.predecessor.socket.fileno() == -1:
-                    print("Predecessor socket is invalid or closed")
-                    server.predecessor.socket = None
-                    server.handle_pred_failure()
-                else:
-                    server.client_sockets[server.predecessor.socket] = (server.predecessor.host, server.predecessor.port)
-            # check finger table
-            for i in range(FINGER_NUM):
-                target_id, node_id, host, port, sock = server.finger_table[i]
-                if node_id == server.node_id:   # pointing to itself => ignore
-                    continue
-                if sock is None:    # row removed => ignore
-                    continue
-                if sock.fileno() == -1: # socket invalid => reset row in finger table
-                    print(f"Fingertable socket ({node_id}) is invalid or closed")
-                    server.finger_table[i][2:] = None, None, None
-                    continue
-                if sock not in server.client_sockets:   # new socket => add to client_sockets
-                    server.client_sockets[sock] = (host, port)
+    first = last = add_vnode(worker.entry() if worker else None)
+    servers = [first]
+    if worker:          # one of a node's worker processes: the node's client port is ours too
+        first.worker = worker
+        masters[worker.listener()] = first
+    if metrics_port:    # one endpoint for every virtual node of the process
+        serve_metrics(metrics_port, servers)
+    while True:
+        # virtual nodes join one at a time, through the first one
+        if len(servers) < len(ids) and vnode_settled(last):
+            last = add_vnode((host, first.port))
+            servers.append(last)
 
-            sockets_to_read = [master_socket] + list(server.client_sockets.keys())
+        owner = {}      # {sock: server it belongs to}
+        for server in servers:
+            check_sockets(server)
+            owner.update(dict.fromkeys(server.client_sockets, server))
+        # backpressure: a connection that doesn't read what we send gets no more requests read until it catches up
+        # (ring connections we opened are always read: their answers and acks drain other queues)
+        throttled = {sock for sock, queue in queues.items() if queue.full() and sock not in pool.by_sock}
+        sockets_to_read = list(masters) + [sock for sock in owner if sock not in throttled]
 
-            readable_sockets, _, _ = select.select(sockets_to_read, [], [])
+        # frames already buffered by an earlier bulk recv must not wait for select
+        pending = [sock for server in servers for sock, reader in server.readers.items() if reader.has_frame() and sock not in throttled]
 
-            for sock in readable_sockets:
-                if not sock:
-                    print("skipping connection")
-                    continue
-                if sock is master_socket:  # new connection
-                    client_socket, addr = master_socket.accept()
-                    print(f"New connection from {addr}")
-                    server.client_sockets[client_socket] = addr
-                else:
-                    try:
-                        data = b''
-                        while not data.endswith(b'\n'):
-                            more = sock.recv(1)
-                            if not more:
-                                raise EOFError("Client has closed the connection.")
-                            data += more
-                        data = data.decode('utf-8').strip()
-
-                        print(server.client_sockets[sock], data)
-
-                        request = json.loads(data)
-                        response = server.handle_request(request, sock)
-                        if response:
-                            response_data = f'{json.dumps(response)}\n'.encode('utf-8')
-                            sock.sendall(response_data)  # send response
-
-                    except EOFError:
-                        if sock:
-                            # print(f"{sock.getpeername()} disconnected")
-                            sock.close()
-                            del server.client_sockets[sock]
-                    except (ConnectionResetError, BrokenPipeError) as e:
-                        del server.client_sockets[sock]
-                        # print(f"{server.client_sockets[sock]} disconnected unexpectedly: {e}")
-                    except json.JSONDecodeError:
-                        print(f"Received malformed JSON from {server.client_sockets[sock]}")
+        # write what the last pass queued, one sendmsg per socket; what the kernel doesn't take waits for select to say writable
+        flush_queues(queues, owner, first)
+        sockets_to_write = [sock for sock, queue in queues.items() if queue.pending()]
+        timeout = pool.heartbeat_interval
+        sync_timeout = first.spreadsheet.sync_timeout()
+        if sync_timeout is not None:    # wake up for the next group commit
+            timeout = min(timeout, sync_timeout)
+        for server in servers:          # and for the next overdue forward
+            forward_timeout = server.forward_timeout()
+            if forward_timeout is not None:
+                timeout = min(timeout, forward_timeout)
+        readable_sockets, writable_sockets, _ = select.select(sockets_to_read, sockets_to_write, [], 0 if pending else timeout)
+        flush_queues(queues, owner, first, writable_sockets)
+
+        for sock in readable_sockets:
+            if not sock:
+                log.debug("skipping connection")
+                continue
+            if sock in masters:  # new connection
+                client_socket, addr = sock.accept()
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                masters[sock].log.info("new connection from %s", addr)
+                masters[sock].client_sockets[client_socket] = addr
+            else:
+                server = owner[sock]
+                try:
+                    server.metrics.bytes_in += server._reader(sock).fill()     # one bulk recv, may hold several frames
+                    pool.seen(sock)
+                    if sock not in pending:
+                        pending.append(sock)
+                except EOFError:
+                    if sock:
+                        # print(f"{sock.getpeername()} disconnected")
+                        server.drop_socket(sock)
+                except (ConnectionResetError, BrokenPipeError) as e:
+                    server.drop_socket(sock)
+                    # print(f"{server.client_sockets[sock]} disconnected unexpectedly: {e}")
+
+        for sock in pending:
+            server = owner.get(sock)
+            reader = server.readers.get(sock) if server else None
+            while reader and sock.fileno() != -1:
+                data = reader.next_frame()
+                if data is None:    # only a partial frame left => keep it for the next wakeup
+                    break
+                try:
+                    start = time.perf_counter()
+                    header = server.relay(sock, data)
+                    if header is not None:      # only routed through us: passed on from its header
+                        server.metrics.handled(header, time.perf_counter() - start)
+                        continue
+                    request = loads(data, raw=True)
+                    if traced(server.log):
+                        server.log.log(TRACE, "%s %s", server.client_sockets.get(sock), request)
+                    start = time.perf_counter()
+                    response = server.handle_request(request, sock)
+                    server.metrics.handled(request, time.perf_counter() - start)
+                    if response:
+                        server.send_message(sock, response)
+
+                except (ConnectionResetError, BrokenPipeError) as e:
+                    server.drop_socket(sock)
+                    break
+                except ValueError:     # bad utf-8, JSON or binary frame
+                    server.log.warning("received a malformed frame from %s", server.client_sockets.get(sock))
+
+        # group commit: one sync for every write handled since the last one, then their replies
+        for server in servers:
+            server.commit()
+
+        # heartbeat idle peers, drop the ones that went silent (the checks above then repair the ring)
+        for sock in pool.tick(first.send_heartbeat):
+            server = owner.get(sock, first)
+            server.log.warning("%s stopped answering heartbeats", server.client_sockets.get(sock))
+            server.drop_socket(sock)
+        for server in servers:
+            server.tick()
+
+def main():
+    parser = argparse.ArgumentParser(usage="python3 SpreadSheetServer.py <project_name> <node_id> [options]")
+    parser.add_argument("project_name")
+    parser.add_argument("node_id")
+    parser.add_argument("--engine", choices=["select", "asyncio"], default="select",
+                        help="select: single-threaded select loop (default); asyncio: one reader task per connection")
+    parser.add_argument("--durability", choices=["none", "async", "group", "always"], default=DURABILITY,
+                        help="none: memory only (default); async: log without fsync; group: fsync batches, reply once durable; always: fsync every write")
+    parser.add_argument("--sync-interval", type=float, default=SYNC_INTERVAL, help=f"group/async: longest a write waits for its sync (default {SYNC_INTERVAL} sec)")
+    parser.add_argument("--sync-ops", type=int, default=SYNC_OPS, help=f"group/async: sync as soon as this many writes are pending (default {SYNC_OPS})")
+    parser.add_argument("--checkpoint-format", choices=["binary", "json"], default=CKPT_FORMAT, help=f"format of the background checkpoints (default {CKPT_FORMAT})")
+    parser.add_argument("--storage", choices=list(STORAGE), default=STORAGE_DEFAULT,
+                        help="dict: one dict of int keys (default); sorted: keys in sorted array chunks, smaller per key")
+    parser.add_argument("--replication", type=int, default=REPLICATION, help=f"copies of every key, on its owner and the next nodes clockwise (default {REPLICATION})")
+    parser.add_argument("--vnodes", type=int, default=VNODES, help=f"ring members hosted by this process, at ids hashed from node_id (default {VNODES}: node_id itself)")
+    parser.add_argument("--workers", type=int, default=WORKERS, help=f"processes running this node, one ring member each on an equal share of its arc, sharing its client port (default {WORKERS})")
+    parser.add_argument("--key-bits", type=int, default=FINGER_NUM, help=f"identifier space of 2**key_bits ring positions, at most {HASH_BITS}; the same on every node (default {FINGER_NUM})")
+    parser.add_argument("--cache", type=int, default=CACHE_SIZE, help=f"lookup answers cached for the lookups this node routes, served while the owner's lease runs (default {CACHE_SIZE}: no cache)")
+    parser.add_argument("--protocol", choices=["binary", "json"], default=PROTOCOL,
+                        help=f"binary: switch connections to length-prefixed binary frames when the other end can (default {PROTOCOL}); json: newline-delimited json only, for debugging")
+    parser.add_argument("--name-server", default=f"{NAME_SERVER[0]}:{NAME_SERVER[1]}", help=f"host:port of the name server (default {NAME_SERVER[0]}:{NAME_SERVER[1]})")
+    parser.add_argument("--metrics-port", type=int, default=None, help="serve Prometheus text on http://host:port/metrics and json on /stats (default: off)")
+    parser.add_argument("--log-level", choices=list(LEVELS), default=LOG_LEVEL,
+                        help=f"trace: every frame and message; debug: routing hops too; info: ring events (default {LOG_LEVEL}); warning; error")
+    parser.add_argument("--log-sample", type=float, default=LOG_SAMPLE, help=f"share of the trace and debug records kept, e.g. 0.01 for one in a hundred (default {LOG_SAMPLE})")
+    parser.add_argument("--log-format", choices=["text", "json"], default=LOG_FORMAT, help=f"text lines or one json object per record (default {LOG_FORMAT})")
+    args = parser.parse_args()
+    if not 0 < args.log_sample <= 1:
+        parser.error("--log-sample must be within (0, 1]")
+    configure(args.log_level, args.log_sample, args.log_format, lean=True)
+    if not 1 <= args.key_bits <= HASH_BITS:
+        parser.error(f"--key-bits must be within 1..{HASH_BITS}")
+    set_key_bits(args.key_bits)
+    set_protocol(args.protocol)
+    host, _, port = args.name_server.rpartition(":")
+    if not host or not port.isdigit():
+        parser.error("--name-server must be host:port")
+    set_name_server(host, port)
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and args.vnodes > 1:
+        parser.error("--workers and --vnodes can't be combined")
+    sheet_options = {"durability": args.durability, "sync_interval": args.sync_interval, "sync_ops": args.sync_ops,
+                     "ckpt_format": args.checkpoint_format, "storage": args.storage}
+
+    def run(node_id, worker=None):
+        metrics_port = args.metrics_port
+        if worker:          # a forked worker: the log listener thread stayed behind in the parent
+            configure(args.log_level, args.log_sample, args.log_format, lean=True)
+            metrics_port = metrics_port and metrics_port + worker.index
+        if args.engine == "asyncio":
+            from AsyncEngine import start_async_server
+            asyncio.run(start_async_server(args.project_name, node_id, args.replication, args.vnodes, args.cache, metrics_port, worker, **sheet_options))
+        else:
+            start_server(args.project_name, node_id, args.replication, args.vnodes, args.cache, metrics_port, worker, **sheet_options)
+
+    if args.workers > 1:
+        from Workers import start_workers
+        start_workers(run, args.project_name, args.node_id, args.workers)
+    else:
+        run(args.node_id)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python3 SpreadSheetServer.py <project_name> <node_id>")
-        sys.exit(1)
-    start_server(sys.argv[1], sys.argv[2])
\ No newline at end of file
+    sys.modules.setdefault("SpreadSheetServer", sys.modules[__name__])   # engines import this module by name
+    main()
\ No newline at end of file
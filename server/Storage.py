@@ -0,0 +1,243 @@
+# Storage
+
+from array import array
+from bisect import bisect_left
+
+CHUNK_SIZE  = 512       # keys per SortedStorage chunk (split at twice this)
+KEY_LIMIT   = 2 ** 64   # keys are unsigned 64-bit
+INDEX_REBUILD = 8       # DictStorage rebuilds its key index instead of catching it up once over 1/INDEX_REBUILD of its keys changed
+
+class DictStorage:
+    """ DictStorage: {int key: bytes value} in one dict, plus a sorted key index for ranges, caught up with the dict only when a range
+        or a count needs it (writes cost a dict store, a new key a set add on top); a DictStorage is used from one thread at a time """
+    def __init__(self, items=()):
+        self.table = {}
+        self.index = None       # SortedStorage of the keys as of the last range or count (None: built from the dict when next needed)
+        self.changed = set()    # keys added or deleted since
+        self.update(items)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, key):
+        return key in self.table
+
+    def get(self, key):
+        """ value bytes of key, None if missing """
+        return self.table.get(key)
+
+    def put(self, key, value):
+        if self.index is not None and key not in self.table:
+            self._changed(key)
+        self.table[key] = value
+
+    def update(self, items):
+        for key, value in items:
+            self.put(key, value)
+
+    def delete(self, key):
+        """ remove key (returns False if it was missing) """
+        if self.table.pop(key, None) is None:
+            return False
+        if self.index is not None:
+            self._changed(key)
+        return True
+
+    def _changed(self, key):
+        self.changed.add(key)
+        if len(self.changed) * INDEX_REBUILD > len(self.table):    # cheaper to sort the keys again than to catch up
+            self.index = None
+            self.changed = set()
+
+    def _index(self):
+        """ the key index, caught up with the dict """
+        if self.index is None:
+            self.index = sorted_index(sorted(self.table))
+        elif self.changed:
+            for key in self.changed:
+                if key in self.table:
+                    self.index.put(key)
+                else:
+                    self.index.delete(key)
+            self.changed = set()
+        return self.index
+
+    def keys(self):
+        return self.table.keys()
+
+    def items(self):
+        return self.table.items()
+
+    def ordered_items(self):
+        """ (key, value) pairs in key order """
+        return self.range(0, KEY_LIMIT)
+
+    def range(self, lo, hi):
+        """ (key, value) pairs with lo <= key < hi, in key order """
+        table = self.table
+        for key in self._index().range_keys(lo, hi):
+            yield key, table[key]
+
+    def count(self, lo, hi):
+        """ number of keys with lo <= key < hi """
+        return self._index().count(lo, hi)
+
+    def copy(self):
+        """ snapshot (values are immutable bytes, so a shallow copy is enough) """
+        other = DictStorage()
+        other.table = self.table.copy()     # its index is built when the snapshot is read in order
+        return other
+
+
+class SortedStorage:
+    """ SortedStorage: keys in sorted chunks of unsigned 64-bit array columns, values in parallel lists of bytes """
+    def __init__(self, items=(), keys_only=False):
+        self.key_chunks = []    # [array('Q')], each sorted, chunk i's keys all below chunk i+1's
+        self.value_chunks = []  # [[bytes]], parallel to key_chunks (lists of None when keys_only: a bare key index)
+        self.maxes = []         # last key of each chunk, bisected to find a key's chunk
+        self.size = 0
+        self.keys_only = keys_only
+        self.update(items)
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def _find(self, key):
+        """ (chunk, position) where key is or would be inserted """
+        c = bisect_left(self.maxes, key)
+        if c == len(self.maxes):    # past the largest key => end of the last chunk
+            c -= 1
+            return c, len(self.key_chunks[c])
+        return c, bisect_left(self.key_chunks[c], key)
+
+    def get(self, key):
+        """ value bytes of key, None if missing """
+        if not self.maxes:
+            return None
+        c, i = self._find(key)
+        keys = self.key_chunks[c]
+        if i < len(keys) and keys[i] == key:
+            return self.value_chunks[c][i]
+        return None
+
+    def put(self, key, value=None):
+        if not self.maxes:
+            self.key_chunks.append(array('Q', [key]))
+            self.value_chunks.append(None if self.keys_only else [value])
+            self.maxes.append(key)
+            self.size = 1
+            return
+        c, i = self._find(key)
+        keys, values = self.key_chunks[c], self.value_chunks[c]
+        if i < len(keys) and keys[i] == key:
+            if values is not None:
+                values[i] = value
+            return
+        keys.insert(i, key)
+        if values is not None:
+            values.insert(i, value)
+        self.maxes[c] = keys[-1]
+        self.size += 1
+        if len(keys) > 2 * CHUNK_SIZE:      # split the chunk in halves
+            self.key_chunks[c:c+1] = keys[:CHUNK_SIZE], keys[CHUNK_SIZE:]
+            self.value_chunks[c:c+1] = (None, None) if values is None else (values[:CHUNK_SIZE], values[CHUNK_SIZE:])
+            self.maxes[c:c+1] = keys[CHUNK_SIZE-1], keys[-1]
+
+    def update(self, items):
+        for key, value in items:
+            self.put(key, value)
+
+    def delete(self, key):
+        """ remove key (returns False if it was missing) """
+        if not self.maxes:
+            return False
+        c, i = self._find(key)
+        keys, values = self.key_chunks[c], self.value_chunks[c]
+        if i == len(keys) or keys[i] != key:
+            return False
+        del keys[i]
+        if values is not None:
+            del values[i]
+        self.size -= 1
+        if keys:
+            self.maxes[c] = keys[-1]
+        else:
+            del self.key_chunks[c], self.value_chunks[c], self.maxes[c]
+        return True
+
+    def keys(self):
+        for keys in self.key_chunks:
+            yield from keys
+
+    def items(self):
+        for keys, values in zip(self.key_chunks, self.value_chunks):
+            yield from zip(keys, values)
+
+    def ordered_items(self):
+        """ (key, value) pairs in key order """
+        return self.items()
+
+    def _bounds(self, lo, hi):
+        """ first (chunk, position) at or above lo, and the chunk holding hi's position """
+        first = bisect_left(self.maxes, lo)
+        last = min(bisect_left(self.maxes, hi), len(self.maxes) - 1)
+        return first, last
+
+    def range_keys(self, lo, hi):
+        """ keys with lo <= key < hi, in order: O(log n) to find the first, then O(1) each """
+        if lo >= hi or not self.maxes:
+            return
+        first, last = self._bounds(lo, hi)
+        for c in range(first, last + 1):
+            keys = self.key_chunks[c]
+            i = bisect_left(keys, lo) if c == first else 0
+            j = bisect_left(keys, hi) if c == last else len(keys)
+            yield from keys[i:j]
+
+    def range(self, lo, hi):
+        """ (key, value) pairs with lo <= key < hi, in key order """
+        if lo >= hi or not self.maxes:
+            return
+        first, last = self._bounds(lo, hi)
+        for c in range(first, last + 1):
+            keys, values = self.key_chunks[c], self.value_chunks[c]
+            i = bisect_left(keys, lo) if c == first else 0
+            j = bisect_left(keys, hi) if c == last else len(keys)
+            yield from zip(keys[i:j], values[i:j])
+
+    def count(self, lo, hi):
+        """ number of keys with lo <= key < hi """
+        if lo >= hi or not self.maxes:
+            return 0
+        first, last = self._bounds(lo, hi)
+        if first > last:
+            return 0
+        total = sum(len(keys) for keys in self.key_chunks[first:last])
+        return total + bisect_left(self.key_chunks[last], hi) - bisect_left(self.key_chunks[first], lo)
+
+    def copy(self):
+        """ snapshot: every chunk copied (a memcpy per array), value bytes shared """
+        other = SortedStorage(keys_only=self.keys_only)
+        other.key_chunks = [keys[:] for keys in self.key_chunks]
+        other.value_chunks = [values and values[:] for values in self.value_chunks]
+        other.maxes = self.maxes[:]
+        other.size = self.size
+        return other
+
+
+def sorted_index(keys):
+    """ SortedStorage key index of keys given in ascending order, cut in chunks in one pass (half full: room for inserts) """
+    index = SortedStorage(keys_only=True)
+    keys = array('Q', keys)
+    index.key_chunks = [keys[i:i + CHUNK_SIZE] for i in range(0, len(keys), CHUNK_SIZE)]
+    index.value_chunks = [None] * len(index.key_chunks)
+    index.maxes = [keys[-1] for keys in index.key_chunks]
+    index.size = len(keys)
+    return index
+
+
+STORAGE = {"dict": DictStorage, "sorted": SortedStorage}
+STORAGE_DEFAULT = "dict"
@@ -0,0 +1,66 @@
+# TestCheckpoint
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+from SpreadSheet import SpreadSheet
+
+KEYS        = 200000
+
+def filled(keys, ckpt_format):
+    """ spreadsheet holding keys entries (stored as inserts store them), checkpointing only when told to """
+    sheet = SpreadSheet(node_id=0, durability="async", log_max_size=float("inf"), ckpt_format=ckpt_format)
+    for i in range(keys):
+        sheet.insert(i, {"value": i})
+    sheet.sync()
+    return sheet
+
+def inserts_while(sheet, busy):
+    """ insert rate while busy() holds """
+    n = 0
+    start = time.perf_counter()
+    while busy():
+        sheet.insert(n, {"value": n})
+        n += 1
+    elapsed = time.perf_counter() - start
+    return n / elapsed if elapsed else 0, elapsed
+
+if __name__ == "__main__":
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)       # ckpt/ and log/ are relative to the working directory
+    try:
+        for ckpt_format in ("json", "binary"):
+            sheet = filled(keys, ckpt_format)
+
+            # old: the whole dict dumped inside the request path
+            legacy = {f'{i}': {"value": i} for i in range(keys)}
+            start = time.perf_counter()
+            with open(sheet.ckpt_path + '_old', "w") as f:
+                json.dump(legacy, f)
+            blocking = time.perf_counter() - start
+
+            # new: snapshot + log rotation inline, chunked write in the background
+            sheet.insert(0, {"value": 0})
+            start = time.perf_counter()
+            sheet._compact_log()
+            pause = time.perf_counter() - start
+            rate, background = inserts_while(sheet, sheet.checkpoint.is_alive)
+            sheet.sync()
+            sheet.log.close()
+            size = os.path.getsize(sheet.ckpt_path)
+
+            start = time.perf_counter()
+            loaded = sheet._load_checkpoint()
+            load = time.perf_counter() - start
+
+            print(f"{ckpt_format:6}\tstop-the-world dump: {blocking:.3f} sec\tcheckpoint pause: {pause:.3f} sec\tbackground write: {background:.3f} sec ({rate:.0f} inserts/sec meanwhile)")
+            print(f"{ckpt_format:6}\tcheckpoint: {size / 2**20:.1f} MB\tload: {load:.3f} sec for {len(loaded)} keys")
+            shutil.rmtree("ckpt", ignore_errors=True)
+            shutil.rmtree("log", ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
@@ -0,0 +1,64 @@
+# TestCoalescing
+
+import sys
+import time
+import socket
+import select
+import multiprocessing
+from Codec import dumps
+from SendQueue import SendQueue
+
+ITERATIONS  = 20000
+FANOUTS     = [1, 4, 16, 64, 256]   # frames one event sends to the same peer (an insert and its replication, a takeover's keys)
+VALUE_SIZE  = 64
+
+def drain(sock, other):
+    """ the peer, in a process of its own like a real one: read and drop everything """
+    other.close()               # our copy of the sending end: EOF comes once the sender closes its own
+    buffer = bytearray(1 << 20)
+    while sock.recv_into(buffer):
+        pass
+
+def send_each(sock, frames):
+    """ the old send_message: one sendall per frame """
+    for frame in frames:
+        sock.sendall(frame)
+    return len(frames)
+
+def send_queued(queue, frames):
+    """ the loop: queue every frame of the pass, then one flush """
+    for frame in frames:
+        queue.push([frame])
+    calls = queue.send_calls
+    queue.flush()
+    while queue.pending():      # the peer is behind: wait for it like the loop does
+        select.select([], [queue.sock], [])
+        queue.flush()
+    return queue.send_calls - calls
+
+def measure(fanout, queued, iterations):
+    """ (usec per frame, syscalls per frame) """
+    frames = [dumps({"method": "insert_replication", "repli_key": key, "value": {"data": "x" * VALUE_SIZE}, "version": 1718000000123, "msg_id": f"20000_{key}"}, True)
+              for key in range(fanout)]
+    a, b = socket.socketpair()
+    reader = multiprocessing.Process(target=drain, args=(b, a), daemon=True)
+    reader.start()
+    b.close()
+    queue = SendQueue(a)
+    calls = 0
+    start = time.perf_counter()
+    for _ in range(max(1, iterations // fanout)):
+        calls += send_queued(queue, frames) if queued else send_each(a, frames)
+    duration = time.perf_counter() - start
+    a.close()
+    reader.join()
+    count = max(1, iterations // fanout) * fanout
+    return duration / count * 1e6, calls / count
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    for fanout in FANOUTS:
+        each, each_calls = measure(fanout, False, iterations)
+        queued, queued_calls = measure(fanout, True, iterations)
+        print(f"fanout: {fanout:4d}\tsendall each: {each:6.2f} usec/frame {each_calls:5.2f} calls/frame\t"
+              f"queued: {queued:6.2f} usec/frame {queued_calls:5.3f} calls/frame\tspeedup: {each / queued:5.2f}x")
@@ -0,0 +1,50 @@
+# TestCodec
+
+import sys
+import time
+from Codec import RawValue, dumps, encode_value, loads
+
+ITERATIONS  = 20000
+VALUE_SIZES = [16, 256, 4096, 65536]
+REPEATS     = 5         # best of: timings on a busy machine only ever err on the slow side
+
+def messages(value_size):
+    """ frames a node sends most: a routed request, the owner's answer, a replicated write, a finger table update, each with
+        whether a node sends its value from storage and whether a node receives it (binary frames: the value stays raw on a node) """
+    value = {"data": "x" * value_size}
+    return [("lookup", {"method": "lookup", "key": "user:12345", "msg_id": "c0123456789ab_42", "hops": 2, "lease": True}, False, True),
+            ("insert", {"method": "insert", "key": 12345, "value": value, "msg_id": "c0123456789ab_43", "hops": 1, "consistency": "quorum"}, False, True),
+            ("answer", {"status": "success", "value": value, "version": 1718000000123, "msg_id": "c0123456789ab_42", "lease": 2.0}, True, False),
+            ("replica", {"method": "insert_replication", "repli_key": 12345, "value": value, "version": 1718000000123, "msg_id": "20000_7"}, True, True),
+            ("updatePFT", {"method": "updatePFT", "FT": [[i, 40000, "localhost", 40000 + i] for i in range(16)]}, False, True)]
+
+def best(function, argument, iterations):
+    """ usec per call of function(argument), best of REPEATS runs """
+    runs = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        for _ in range(iterations // REPEATS):
+            function(argument)
+        runs.append(time.perf_counter() - start)
+    return min(runs) / (iterations // REPEATS) * 1e6
+
+def measure(message, binary, stored, raw, iterations):
+    """ (encode usec, decode usec, frame bytes) of message, its value sent from storage (stored) and/or received by a node (raw) """
+    if binary and stored:
+        message = dict(message, value=RawValue(encode_value(message["value"]).encode("utf-8")))    # as SpreadSheet.lookup(raw=True) has it
+    frame = dumps(message, binary)
+    encode = best(lambda message: dumps(message, binary), message, iterations)
+    decode = best(lambda frame: loads(frame, raw), frame if binary else frame[:-1], iterations)     # the reader hands frames over without their newline
+    return encode, decode, len(frame)
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    for value_size in VALUE_SIZES:
+        for name, message, stored, raw in messages(value_size):
+            if name in ("lookup", "updatePFT") and value_size != VALUE_SIZES[0]:   # no value in them
+                continue
+            json_encode, json_decode, json_size = measure(message, False, stored, raw, iterations)
+            binary_encode, binary_decode, binary_size = measure(message, True, stored, raw, iterations)
+            print(f"{name:10}\tvalue: {value_size:6d} B\tjson: {json_encode:7.2f} + {json_decode:7.2f} usec {json_size:6d} B\t"
+                  f"binary: {binary_encode:7.2f} + {binary_decode:7.2f} usec {binary_size:6d} B\t"
+                  f"speedup: {(json_encode + json_decode) / (binary_encode + binary_decode):4.2f}x")
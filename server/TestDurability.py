@@ -0,0 +1,53 @@
+# TestDurability
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+from SpreadSheet import SpreadSheet
+
+ITERATIONS  = 20000
+MODES       = ["none", "async", "group", "always"]
+
+def run(mode, iterations):
+    """ insert iterations keys the way the server loop does: commit whenever a sync is due """
+    sheet = SpreadSheet(node_id=0, durability=mode)
+    start = time.perf_counter()
+    for i in range(iterations):
+        sheet.insert(i, {"value": i})
+        if sheet.sync_timeout() == 0:
+            sheet.sync()
+    sheet.sync()
+    elapsed = time.perf_counter() - start
+    if sheet.log:
+        sheet.log.close()
+    return elapsed, sheet.sync_count
+
+def recover():
+    """ time to rebuild the spreadsheet from checkpoint + log """
+    start = time.perf_counter()
+    sheet = SpreadSheet(node_id=0, durability="group")
+    elapsed = time.perf_counter() - start
+    sheet.log.close()
+    return elapsed, len(sheet.data)
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    # fewer fsync-per-write iterations, they take a few ms each on most disks
+    always_iterations = min(iterations, 2000)
+
+    workdir = tempfile.mkdtemp()
+    os.chdir(workdir)       # ckpt/ and log/ are relative to the working directory
+    try:
+        for mode in MODES:
+            n = always_iterations if mode == "always" else iterations
+            elapsed, syncs = run(mode, n)
+            print(f"{mode:6}\tthroughput: {n / elapsed:12.2f}\tops/sec\tsyncs: {syncs}")
+            if mode != "none":
+                elapsed, keys = recover()
+                print(f"{mode:6}\trecovery: {elapsed:.4f} sec for {keys} keys")
+            shutil.rmtree("ckpt", ignore_errors=True)
+            shutil.rmtree("log", ignore_errors=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
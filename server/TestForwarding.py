@@ -0,0 +1,60 @@
+# TestForwarding
+
+import sys
+import time
+import socket
+import threading
+from Codec import dumps, loads, peek, reframe
+
+ITERATIONS  = 2000
+VALUE_SIZES = [16, 1024, 16384, 262144, 1048576]
+
+def drain(sock):
+    """ the next hop: read and drop everything """
+    buffer = bytearray(1 << 20)
+    while sock.recv_into(buffer):
+        pass
+
+def forward_json(sock, frame):
+    """ the old hop: decode the whole request, count the hop, encode it again """
+    request = loads(frame)
+    request["hops"] = request.get("hops", 0) + 1
+    sock.sendall(dumps(request))
+
+def forward_decoded(sock, frame):
+    """ a binary frame through handle_request: the same, in binary """
+    request = loads(frame)
+    request["hops"] = request.get("hops", 0) + 1
+    sock.sendall(dumps(request, True))
+
+def forward_relayed(sock, frame):
+    """ a binary frame through relay: header read, new head, body passed on uncopied """
+    header = peek(frame)
+    sock.sendmsg(reframe(frame, hops=header.get("hops", 0) + 1))
+
+def measure(forward, binary, value_size, iterations):
+    """ usec per forwarded frame """
+    frame = dumps({"method": "insert", "key": "user:12345", "value": {"data": "x" * value_size}, "msg_id": "c0123456789ab_42", "hops": 1}, binary)
+    if not binary:
+        frame = frame[:-1]      # the reader hands frames over without their newline
+    a, b = socket.socketpair()
+    reader = threading.Thread(target=drain, args=(b,), daemon=True)
+    reader.start()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        forward(a, frame)
+    duration = time.perf_counter() - start
+    a.close()
+    reader.join()
+    b.close()
+    return duration / iterations * 1e6
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    for value_size in VALUE_SIZES:
+        runs = max(10, iterations * 1024 // max(1024, value_size))     # fewer of the large frames
+        json_hop = measure(forward_json, False, value_size, runs)
+        decoded_hop = measure(forward_decoded, True, value_size, runs)
+        relayed_hop = measure(forward_relayed, True, value_size, runs)
+        print(f"value: {value_size:8d} B\tjson: {json_hop:9.2f} usec/hop\tbinary decoded: {decoded_hop:9.2f} usec/hop\t"
+              f"binary relayed: {relayed_hop:9.2f} usec/hop\tspeedup: {json_hop / relayed_hop:6.2f}x")
@@ -0,0 +1,70 @@
+# TestFraming
+
+import sys
+import time
+import json
+import socket
+import threading
+from FrameReader import FrameReader
+
+ITERATIONS  = 2000
+
+class CountingSocket:
+    """ wraps a socket and counts recv syscalls """
+    def __init__(self, sock):
+        self.sock = sock
+        self.recv_calls = 0
+
+    def recv(self, n):
+        self.recv_calls += 1
+        return self.sock.recv(n)
+
+    def recv_into(self, buf):
+        self.recv_calls += 1
+        return self.sock.recv_into(buf)
+
+def read_byte_at_a_time(sock, frames):
+    """ the old framing: recv(1) until newline, bytes concatenation """
+    for _ in range(frames):
+        data = b''
+        while not data.endswith(b'\n'):
+            more = sock.recv(1)
+            if not more:
+                raise EOFError("Socket connection broken")
+            data += more
+        json.loads(data.decode('utf-8').strip())
+
+def read_buffered(sock, frames):
+    """ the new framing: bulk recv into a FrameReader """
+    reader = FrameReader(sock)
+    for _ in range(frames):
+        json.loads(reader.read_frame())
+
+def writer(sock, payload, frames, burst):
+    """ send frames, `burst` of them per sendall (pipelined messages in one write) """
+    for i in range(0, frames, burst):
+        sock.sendall(payload * min(burst, frames - i))
+
+def measure(name, reader, value_size, burst):
+    a, b = socket.socketpair()
+    payload = f'{json.dumps({"method": "insert", "key": 12345, "value": "x" * value_size, "msg_id": "1_1"})}\n'.encode('utf-8')
+    counting = CountingSocket(b)
+    t = threading.Thread(target=writer, args=(a, payload, ITERATIONS, burst), daemon=True)
+    start = time.time()
+    t.start()
+    reader(counting, ITERATIONS)
+    duration = time.time() - start
+    t.join()
+    a.close()
+    b.close()
+    calls = counting.recv_calls
+    print(f"{name}\tvalue: {value_size:6d} B\tburst: {burst:3d}\tthroughput: {ITERATIONS / duration:12.2f} frames/sec\t"
+          f"{ITERATIONS * len(payload) / duration / 2**20:8.2f} MB/s\trecv calls: {calls:9d} ({calls / ITERATIONS:.3f}/frame)")
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        ITERATIONS = int(sys.argv[1])
+    for value_size in (16, 256, 4096):
+        for burst in (1, 32):
+            measure("recv(1) ", read_byte_at_a_time, value_size, burst)
+            measure("buffered", read_buffered, value_size, burst)
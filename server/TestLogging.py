@@ -0,0 +1,73 @@
+# TestLogging
+
+import sys
+import json
+import time
+import logging
+import tempfile
+import contextlib
+from SpreadSheet import SpreadSheet
+from Log import TRACE, configure, shutdown, get_logger, traced
+
+ITERATIONS  = 50000
+KEYS        = 1000
+LEVELS      = [("error", 1.0), ("info", 1.0), ("debug", 1.0), ("trace", 1.0), ("trace", 0.01)]
+
+log = get_logger("server.0")
+
+def frames(n):
+    """ lookup requests as they arrive on the wire """
+    return [json.dumps({"method": "lookup", "key": i % KEYS, "msg_id": f"client-{i}"}).encode("utf-8") for i in range(n)]
+
+def handle_print(sheet, data):
+    """ the old hot path: every frame, hop and message printed """
+    print(("localhost", 40000), data.decode("utf-8"))
+    request = json.loads(data)
+    print(f"routing to {request['key']}")
+    message = sheet.lookup(request["key"])
+    message["msg_id"] = request["msg_id"]
+    print(f'sending message: {message}')
+    return f'{json.dumps(message)}\n'.encode('utf-8')
+
+def handle_log(sheet, data):
+    """ the hot path now: the same records, formatted only at the level they are enabled at """
+    if traced(log):
+        log.log(TRACE, "%s %s", ("localhost", 40000), data.decode("utf-8"))
+    request = json.loads(data)
+    if traced(log, logging.DEBUG):
+        log.debug("routing %s to %s", request["key"], request["key"])
+    message = sheet.lookup(request["key"])
+    message["msg_id"] = request["msg_id"]
+    if traced(log):
+        log.log(TRACE, "send %s", message)
+    return f'{json.dumps(message)}\n'.encode('utf-8')
+
+def run(handle, sheet, data):
+    """ ops/sec of handle over every frame """
+    start = time.perf_counter()
+    for frame in data:
+        handle(sheet, frame)
+    return len(data) / (time.perf_counter() - start)
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else ITERATIONS
+    sheet = SpreadSheet(node_id=0)
+    for i in range(KEYS):
+        sheet.insert(i, {"value": i})
+    data = frames(iterations)
+
+    # output goes to a temp file, as it would to a redirected server log
+    with tempfile.TemporaryFile("w") as out:
+        with contextlib.redirect_stdout(out):
+            rate = run(handle_print, sheet, data)
+        print(f"print (old)      \t{rate:10.0f} ops/sec\t{out.tell() / iterations:6.0f} bytes/op")
+
+    for level, sample in LEVELS:
+        with tempfile.TemporaryFile("w") as out:
+            configure(level, sample, stream=out, lean=True)     # set up as the server does
+            start = time.perf_counter()
+            run(handle_log, sheet, data)
+            shutdown()      # drained: the listener thread's formatting and writing count too
+            rate = iterations / (time.perf_counter() - start)
+            name = f"{level} (1/{round(1 / sample)})" if sample < 1 else level
+            print(f"log {name:13}\t{rate:10.0f} ops/sec\t{out.tell() / iterations:6.0f} bytes/op")
@@ -0,0 +1,46 @@
+# TestPlacement
+
+import sys
+import time
+import random
+import bisect
+from Placement import key_position
+
+KEYS        = 100000
+RING_SIZES  = [8, 100]
+KEY_BITS    = [16, 32]
+
+def workloads(n, max_key):
+    """ application key sets: sequential ids, one cluster of ids, string ids """
+    base = random.randrange(max_key // 2)
+    return [("sequential", list(range(n))),
+            ("clustered", [base + i for i in range(n)]),
+            ("strings", [f"user:{i}" for i in range(n)])]
+
+def loads(nodes, positions):
+    """ keys per node: owner of a position is the first node_id >= it, wrapping around """
+    counts = [0] * len(nodes)
+    for position in positions:
+        counts[bisect.bisect_left(nodes, position) % len(nodes)] += 1
+    return counts
+
+def imbalance(counts):
+    """ keys on the busiest node over the mean """
+    return max(counts) / (sum(counts) / len(counts))
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+
+    for key_bits in KEY_BITS:
+        max_key = 2 ** key_bits
+        for size in RING_SIZES:
+            nodes = sorted(random.sample(range(max_key), size))
+            for name, keys in workloads(n, max_key):
+                # the old placement: key k at ring position k (ints only, wrapped)
+                identity = f"{imbalance(loads(nodes, [key % max_key for key in keys])):8.2f}" if type(keys[0]) is int else "     n/a"
+
+                start = time.perf_counter()
+                positions = [key_position(key, key_bits) for key in keys]
+                hash_ns = (time.perf_counter() - start) / n * 1e9
+
+                print(f"bits {key_bits:2}\tnodes {size:4}\t{name:10}\tidentity max/mean: {identity}\thashed max/mean: {imbalance(loads(nodes, positions)):6.2f}\thash: {hash_ns:6.1f} ns/key")
@@ -0,0 +1,61 @@
+# TestRecovery
+
+import os
+import sys
+import shutil
+import tempfile
+from SpreadSheet import SpreadSheet
+
+KEYS        = 1000
+# what a crash mid-append leaves at the end of the log: half a json line, and a whole entry whose newline never made it
+TORN_TAILS  = {"partial line": b'{"method": "insert", "key": 1, "val', "no newline": b'{"method": "remove", "key": 1, "value": 1, "version": 1}'}
+
+def check(tail, keys):
+    """ failures of recovering keys inserts (every 10th key removed) from a log ending in tail """
+    sheet = SpreadSheet(node_id=0, durability="always", log_max_size=10 * keys)
+    for key in range(keys):
+        sheet.insert(key, {"value": key})
+    for key in range(0, keys, 10):
+        sheet.remove(key)
+    sheet.log.close()
+    good = os.path.getsize(sheet.log_path)
+    with open(sheet.log_path, "ab") as log:
+        log.write(tail)
+
+    failures = []
+    try:
+        sheet = SpreadSheet(node_id=0, durability="always", log_max_size=10 * keys)
+    except Exception as e:
+        return [f"recovery raised {e!r}"]
+    if os.path.getsize(sheet.log_path) != good:
+        failures.append(f"log is {os.path.getsize(sheet.log_path)} bytes after recovery, {good} expected")
+    for key in range(keys):
+        answer = sheet.lookup(key)
+        expected = "failure" if key % 10 == 0 else "success"
+        if answer["status"] != expected or expected == "success" and answer["value"] != {"value": key}:
+            failures.append(f"lookup {key}: {answer}")
+    # a write after recovery lands on a line of its own and survives the next restart
+    sheet.insert(keys, {"value": keys})
+    sheet.log.close()
+    sheet = SpreadSheet(node_id=0, durability="always", log_max_size=10 * keys)
+    if sheet.lookup(keys).get("value") != {"value": keys}:
+        failures.append(f"lookup {keys} after a second restart: {sheet.lookup(keys)}")
+    sheet.log.close()
+    return failures
+
+if __name__ == "__main__":
+    keys = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+    failures = []
+    for name, tail in TORN_TAILS.items():
+        workdir = tempfile.mkdtemp()
+        os.chdir(workdir)       # ckpt/ and log/ are relative to the working directory
+        try:
+            found = check(tail, keys)
+        finally:
+            os.chdir(os.path.dirname(workdir))
+            shutil.rmtree(workdir, ignore_errors=True)
+        print(f"torn tail ({name}): {len(found)} failures")
+        failures += found
+    for failure in failures[:10]:
+        print(failure)
+    sys.exit(1 if failures else 0)
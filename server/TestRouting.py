@@ -0,0 +1,79 @@
+# TestRouting
+
+import sys
+import time
+import random
+import bisect
+from FingerTable import FingerTable
+
+LOOKUPS     = 20000
+RING_SIZES  = [8, 100, 1000, 10000]
+FINGER_NUMS = [16, 32, 64, 160]
+
+def in_interval(start, end, val):
+    """ test if val is in [start, end) in the chord """
+    if start <= end:
+        return start <= val < end
+    return not (end <= val < start)
+
+def linear_next_hop(rows, target_id):
+    """ the old _next_hop: scan every row for the interval holding target_id """
+    for i in range(len(rows)):
+        last = rows[i-1][0]
+        curr = rows[i][0]
+        if in_interval(last, curr, target_id):
+            if rows[i-1][-1] is not None:
+                return rows[i-1][-1]
+    return rows[0][-1]
+
+def build_ring(nodes, finger_num, max_key):
+    """ finger table of every node, sockets replaced by the node id they point at """
+    tables = {}
+    for node_id in nodes:
+        table = FingerTable(node_id, "localhost", 0, finger_num, max_key)
+        for i, row in enumerate(table):
+            j = bisect.bisect_left(nodes, row[0]) % len(nodes)
+            table.set(i, nodes[j], "localhost", 0, nodes[j])
+        tables[node_id] = table
+    return tables
+
+def owner(nodes, key):
+    return nodes[bisect.bisect_left(nodes, key) % len(nodes)]
+
+def count_hops(tables, nodes, start, key):
+    """ hops taken routing key from start to its owner """
+    target = owner(nodes, key)
+    node, hops = start, 0
+    while node != target and hops < len(nodes):
+        node = tables[node].next_hop(key)
+        hops += 1
+    return hops
+
+if __name__ == "__main__":
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else LOOKUPS
+
+    for finger_num in FINGER_NUMS:
+        max_key = 2 ** finger_num
+        for size in RING_SIZES:
+            nodes = sorted({random.getrandbits(finger_num) for _ in range(size)})
+            tables = build_ring(nodes, finger_num, max_key)
+            table = tables[nodes[0]]
+            keys = [random.getrandbits(finger_num) for _ in range(lookups)]
+
+            # both pick the same row
+            assert all(linear_next_hop(table.rows, k) == table.next_hop(k) for k in keys[:1000])
+
+            start = time.perf_counter()
+            for k in keys:
+                linear_next_hop(table.rows, k)
+            linear_ns = (time.perf_counter() - start) / lookups * 1e9
+
+            start = time.perf_counter()
+            for k in keys:
+                table.next_hop(k)
+            bisect_ns = (time.perf_counter() - start) / lookups * 1e9
+
+            sample = keys[:1000]
+            hops = sum(count_hops(tables, nodes, random.choice(nodes), k) for k in sample) / len(sample)
+
+            print(f"bits {finger_num:3}\tnodes {len(nodes):5}\tlinear: {linear_ns:8.1f} ns/op\tbisect: {bisect_ns:6.1f} ns/op\tavg hops: {hops:.2f}")
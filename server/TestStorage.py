@@ -0,0 +1,136 @@
+# TestStorage
+
+import sys
+import time
+import random
+import tracemalloc
+from SpreadSheet import SpreadSheet, encode_json, decode_json
+from Codec import RawValue
+from Storage import STORAGE
+from Placement import HASH_BITS
+
+KEYS        = 1000000     # tracing the memory of this many inserts per backend takes minutes: pass fewer (e.g. 200000) for a quick run
+MAX_KEY     = 2 ** 32
+SCANS       = 20        # arcs scanned per sheet, each ~1/1000 of the key space
+SHIFT       = HASH_BITS - 32    # arcs of the 2**32 ring as stored key (hash) ranges
+
+class LegacySheet:
+    """ the old SpreadSheet data path: f-string keys, decoded values, key re-parsed and re-checked on every call """
+    def __init__(self):
+        self.data = {}
+
+    def _are_positive_int(self, lst):
+        for val in lst:
+            if type(val) != int or val < 0:
+                return False
+        return True
+
+    def insert(self, key, value):
+        try:
+            key = int(key)
+        except:
+            return {"status": "failure", "message": "Invalid key value"}
+        if not self._are_positive_int([key]):
+            return {"status": "failure", "message": "Invalid key value"}
+        self.data[f'{key}'] = value
+        return {"status": "success"}
+
+    def lookup(self, key):
+        try:
+            key = int(key)
+        except:
+            return {"status": "failure", "message": "Invalid key value"}
+        if not self._are_positive_int([key]):
+            return {"status": "failure", "message": "Invalid key value"}
+        if f'{key}' in self.data:
+            return {"status": "success", "value": self.data[f'{key}']}
+        return {"status": "failure", "message": "Key not found"}
+
+    def remove(self, key):
+        try:
+            key = int(key)
+        except:
+            return {"status": "failure", "message": "Invalid key value"}
+        if not self._are_positive_int([key]):
+            return {"status": "failure", "message": "Invalid key value"}
+        if f'{key}' in self.data:
+            del self.data[f'{key}']
+            return {"status": "success"}
+        return {"status": "failure", "message": "Key not found"}
+
+def legacy_arc(sheet, lo, hi):
+    """ the old way to find the keys of an arc: test every key """
+    return [key for key in sheet.data if lo <= int(key) < hi]
+
+def scan_time(sheet, arcs):
+    """ average sec per arc scan """
+    start = time.perf_counter()
+    for lo, hi in arcs:
+        if isinstance(sheet, LegacySheet):
+            legacy_arc(sheet, lo, hi)
+        else:
+            list(sheet.range(lo << SHIFT, hi << SHIFT))
+    return (time.perf_counter() - start) / len(arcs)
+
+def rate(operation, keys):
+    start = time.perf_counter()
+    for key in keys:
+        operation(key)
+    return len(keys) / (time.perf_counter() - start)
+
+def wire_rates(sheet, keys):
+    """ insert and lookup ops/sec with values as a node gets and sends them: the legacy sheet decodes the json of an inserted value and
+        encodes the one it answers with, the others store the json text off a binary frame (parsed once to check it) and send it back """
+    items = [(key, encode_json({"value": key}).encode("utf-8")) for key in keys]
+    if isinstance(sheet, LegacySheet):
+        insert = rate(lambda item: sheet.insert(item[0], decode_json(item[1].decode("utf-8"))), items)
+        lookup = rate(lambda key: encode_json(sheet.lookup(key)["value"]), keys)
+    else:
+        insert = rate(lambda item: sheet.insert(item[0], RawValue(item[1])), items)
+        lookup = rate(lambda key: sheet.lookup(key, raw=True), keys)
+    return insert, lookup
+
+def breakdown(name, keys, insert_rate, lookup_rate):
+    """ usec per insert and lookup spent placing the key, (de)serializing the value, in the backend, and on the rest (versions, bucket hashes) """
+    sheet = SpreadSheet(node_id=0, storage=name)
+    place = 1e6 / rate(sheet._locate, keys)
+    records = [(sheet._locate(key)[0], f"{sheet._prefix(key)}{encode_json({'value': key})}]".encode("utf-8")) for key in keys]
+    serialize = 1e6 / rate(lambda key: f"{sheet._prefix(key)}{encode_json({'value': key})}]".encode("utf-8"), keys)
+    deserialize = 1e6 / rate(decode_json, [record.decode("utf-8") for _, record in records])
+    data = STORAGE[name]()
+    store = 1e6 / rate(lambda record: data.put(*record), records)
+    load = 1e6 / rate(data.get, [stored for stored, _ in records])
+    insert, lookup = 1e6 / insert_rate, 1e6 / lookup_rate
+    print(f"{'':12}\tinsert: {insert:5.2f} usec = key {place:5.2f} + serialize {serialize:5.2f} + backend {store:5.2f} + rest {insert - place - serialize - store:5.2f}"
+          f"\tlookup: {lookup:5.2f} usec = key {place:5.2f} + backend {load:5.2f} + deserialize {deserialize:5.2f} + rest {lookup - place - load - deserialize:5.2f}")
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else KEYS
+    keys = random.sample(range(MAX_KEY), n)
+
+    sheets = [("legacy dict", LegacySheet)] + [(name, lambda name=name: SpreadSheet(node_id=0, storage=name)) for name in STORAGE]
+    for name, make in sheets:
+        # memory: a value as it arrives in a request is a freshly decoded json object
+        tracemalloc.start()
+        sheet = make()
+        base = tracemalloc.get_traced_memory()[0]
+        for key in keys:
+            sheet.insert(key, {"value": key})
+        used = tracemalloc.get_traced_memory()[0] - base
+        tracemalloc.stop()
+        del sheet
+
+        # speed, untraced
+        sheet = make()
+        insert_rate = rate(lambda key: sheet.insert(key, {"value": key}), keys)
+        arcs = [(lo, lo + MAX_KEY // 1000) for lo in random.sample(range(MAX_KEY - MAX_KEY // 1000), SCANS + 1)]
+        first_scan = scan_time(sheet, arcs[:1])     # the dict backend sorts its key index for it
+        scan = scan_time(sheet, arcs[1:])
+        lookup_rate = rate(sheet.lookup, keys)
+        remove_rate = rate(sheet.remove, keys)
+        wire_insert, wire_lookup = wire_rates(sheet, keys)
+        print(f"{name:12}\t{used / n:7.1f} bytes/key\tinsert: {insert_rate:10.0f} ops/sec\tlookup: {lookup_rate:10.0f} ops/sec\tremove: {remove_rate:10.0f} ops/sec\t"
+              f"arc scan: {scan * 1000:8.3f} ms (first: {first_scan * 1000:8.3f} ms)")
+        print(f"{'':12}\tvalues as json text on the wire:\tinsert: {wire_insert:10.0f} ops/sec\tlookup: {wire_lookup:10.0f} ops/sec")
+        if name != "legacy dict":   # where an insert's and a lookup's time goes: serialized values cost an encode per insert and a decode per lookup
+            breakdown(name, keys, insert_rate, lookup_rate)
@@ -0,0 +1,76 @@
+# Transfer
+
+import time
+import itertools
+
+TRANSFER_BATCH      = 500   # keys per transferBatch message
+TRANSFER_WINDOW     = 4     # unacked batches in flight per transfer
+TRANSFER_TIMEOUT    = 2     # resend from the last acked key after this long without an ack (sec)
+TRANSFER_RETRIES    = 10    # give up after this many resends without progress
+
+class Transfer:
+    """ Transfer: key ranges streamed to one peer in acked batches, resumable from the last acked key """
+    def __init__(self, transfer_id, host, port, segments, move=False, unreplicate=False):
+        self.transfer_id = transfer_id
+        self.host = host
+        self.port = port
+        self.segments = segments        # [(lo, hi)] stored key ranges, sent in this order
+        self.move = move                # delete each key once the peer acked it
+        self.unreplicate = unreplicate  # once acked, drop the keys from our successor's replicas too
+        self.sent = (0, segments[0][0] if segments else None)   # position (segment, next stored key) of the next batch
+        self.acked = self.sent          # position after the last acked batch
+        self.inflight = {}              # {seq: (position after the batch, [keys])}
+        self.seq = 0
+        self.retries = 0
+        self.last_progress = time.time()
+
+    def exhausted(self):
+        """ every key up to the end of the last segment was sent """
+        return self.sent[0] >= len(self.segments)
+
+    def done(self):
+        return self.exhausted() and not self.inflight
+
+    def next_batch(self, spreadsheet, size=TRANSFER_BATCH):
+        """ (seq, up to size [key, value, version] items from the send position on), read now so it reflects recent writes """
+        items = []
+        i, key = self.sent
+        while i < len(self.segments) and len(items) < size:
+            entries = spreadsheet.versioned_range(key, self.segments[i][1])
+            wanted = size - len(items)
+            batch = list(itertools.islice(entries, wanted))
+            if len(batch) < wanted:     # segment exhausted
+                i += 1
+                key = self.segments[i][0] if i < len(self.segments) else None
+            else:
+                # the other keys chained under the last stored key (their hashes collide) go along: the next batch starts past it
+                last = batch[-1][0]
+                batch.extend(itertools.takewhile(lambda entry: entry[0] == last, entries))
+                key = last + 1              # next stored key
+            items.extend(entry[1:] for entry in batch)
+        self.sent = (i, key)
+        seq = self.seq
+        self.seq += 1
+        self.inflight[seq] = (self.sent, [item[0] for item in items])
+        return seq, items
+
+    def ack(self, seq):
+        """ the peer stored batch seq (returns its keys, None for a stale or duplicate ack) """
+        entry = self.inflight.pop(seq, None)
+        if entry is None:
+            return None
+        self.acked, keys = entry
+        self.retries = 0
+        self.last_progress = time.time()
+        return keys
+
+    def stalled(self):
+        """ batches are out and nothing was acked for TRANSFER_TIMEOUT sec """
+        return self.inflight and time.time() - self.last_progress > TRANSFER_TIMEOUT
+
+    def rewind(self):
+        """ forget the unacked batches and resend from the last acked key (acks of forgotten batches are ignored) """
+        self.inflight.clear()
+        self.sent = self.acked
+        self.retries += 1
+        self.last_progress = time.time()
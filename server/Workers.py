@@ -0,0 +1,158 @@
+# Workers
+
+import os
+import sys
+import mmap
+import time
+import signal
+import socket
+import struct
+import threading
+from bisect import bisect_left
+import SpreadSheetServer as sss
+
+ROW         = struct.Struct("=qqqd")    # one worker's ring member: node_id, port, predecessor id (-1: none), joined_at (0: not yet)
+ARC_WAIT    = 5         # sec worker 0 may take to learn its predecessor once it joined; none by then: the node is alone, its arc is the whole ring
+WAIT_POLL   = 0.1       # sec between looks at the table while waiting for a turn to join
+
+log = sss.log.getChild("workers")
+
+class WorkerTable:
+    """ WorkerTable: the ring members of one node's worker processes, in shared memory (an anonymous mmap made before fork);
+        each worker writes its own row, the last row holds the node's arc once it is known """
+    def __init__(self, workers):
+        self.workers = workers
+        self.memory = mmap.mmap(-1, ROW.size * (workers + 1))
+        self.raw = None         # table bytes the arcs below were read from
+        self.ids = []           # sorted ids of the joined workers that know their predecessor
+        self.arcs = []          # [(node_id, predecessor id, port)] in the same order
+
+    def publish(self, index, node_id, port, predecessor_id, joined_at):
+        ROW.pack_into(self.memory, index * ROW.size, node_id, port, predecessor_id, joined_at)
+
+    def row(self, index):
+        """ (node_id, port, predecessor id, joined_at) of a worker, zeros until it started """
+        return ROW.unpack_from(self.memory, index * ROW.size)
+
+    def settled(self, index):
+        """ the worker is in the ring and had time to take over its data: the next one may join """
+        joined_at = self.row(index)[3]
+        return joined_at > 0 and time.time() - joined_at >= sss.VNODE_JOIN_GAP
+
+    def set_arc(self, node_id, predecessor_id):
+        self.publish(self.workers, node_id, 0, predecessor_id, time.time())
+
+    def arc(self):
+        """ (node_id, predecessor id) the node's arc was split from, None until worker 0 learnt it """
+        node_id, _, predecessor_id, known = self.row(self.workers)
+        return (node_id, predecessor_id) if known else None
+
+    def owner(self, position, max_key):
+        """ (node_id, port) of the worker whose arc holds position, as they last published them (None: no worker's) """
+        raw = self.memory[:ROW.size * self.workers]
+        if raw != self.raw:     # a worker published a change: reread (one compare of a few hundred bytes per lookup otherwise)
+            self.raw = raw
+            self.arcs = sorted((node_id, predecessor_id, port) for node_id, port, predecessor_id, joined_at in ROW.iter_unpack(raw)
+                               if joined_at and predecessor_id >= 0)
+            self.ids = [arc[0] for arc in self.arcs]
+        if not self.ids:
+            return None
+        node_id, predecessor_id, port = self.arcs[bisect_left(self.ids, position) % len(self.ids)]     # the only arc that may end at or after position
+        if predecessor_id == node_id or 0 < (position - predecessor_id) % max_key <= (node_id - predecessor_id) % max_key:
+            return node_id, port
+        return None
+
+
+class Worker:
+    """ Worker: one of the processes a ring node runs, with its own ring member and spreadsheet (see start_workers) """
+    def __init__(self, table, index, host, port):
+        self.table = table
+        self.index = index
+        self.host = host
+        self.port = port            # the node's client port, shared by every worker
+        self.published = None
+
+    def ring_id(self):
+        """ ring id of this worker: the node's arc (predecessor, node_id] cut in equal parts, worker 0 at node_id, the others below it """
+        node_id, predecessor_id = self.table.arc()
+        span = (node_id - predecessor_id) % sss.MAX_KEY or sss.MAX_KEY
+        return (node_id - self.index * max(1, span // self.table.workers)) % sss.MAX_KEY
+
+    def entry(self):
+        """ where this worker joins the ring: worker 0 like any node, the others through worker 0 """
+        return None if self.index == 0 else (self.host, self.table.row(0)[1])
+
+    def listener(self):
+        """ a listening socket of this worker on the node's client port: the kernel spreads the connections over the workers """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        sock.bind(('', self.port))
+        sock.listen(5)
+        return sock
+
+    def publish(self, server):
+        """ write our ring member's row when it changed """
+        row = (server.node_id, server.port, server.predecessor.node_id if server.predecessor else -1, server.joined_at or 0)
+        if row != self.published:
+            self.table.publish(self.index, *row)
+            self.published = row
+
+    def sibling(self, server, position):
+        """ port of the other worker that owns position (None: not one of ours) """
+        owner = self.table.owner(position, sss.MAX_KEY)
+        if owner is None or owner[0] == server.node_id:
+            return None
+        return owner[1]
+
+
+def start_workers(run, project_name, node_id, workers):
+    """ run a ring node as workers processes: each one a ring member at an equal share of the node's arc with its own spreadsheet,
+        calling run(ring_id, worker) in turn once the worker before it settled; the node's client port is shared (SO_REUSEPORT) """
+    host = socket.getfqdn()
+    node_id = int(node_id) % sss.MAX_KEY
+    table = WorkerTable(workers)
+    reserved = socket.socket(socket.AF_INET, socket.SOCK_STREAM)    # holds the client port for the workers, never listens
+    reserved.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    reserved.bind(('', 0))
+    port = reserved.getsockname()[1]
+
+    pids = {}
+    for index in range(workers):
+        pid = os.fork()
+        if pid == 0:    # the worker: wait for its turn, then serve until killed
+            reserved.close()
+            worker = Worker(table, index, host, port)
+            while index and not (table.arc() and table.settled(index - 1)):
+                time.sleep(WAIT_POLL)
+            try:
+                run(node_id if index == 0 else worker.ring_id(), worker)
+            except BaseException:
+                log.exception("worker %d failed", index)
+            finally:
+                os._exit(1)
+        pids[pid] = index
+
+    def stop(signum, frame):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # the arc is split as worker 0 first found it: the workers joining below it shrink its own
+    while not table.settled(0):
+        time.sleep(WAIT_POLL)
+    deadline = time.time() + ARC_WAIT
+    while table.row(0)[2] < 0 and time.time() < deadline:
+        time.sleep(WAIT_POLL)
+    table.set_arc(node_id, table.row(0)[2] if table.row(0)[2] >= 0 else node_id)
+    log.info("node %s: %d workers on client port %s, arc (%s, %s]", node_id, workers, port, table.arc()[1], node_id)
+    threading.Thread(target=sss.register_name_server, args=(port, f"{project_name}_{node_id}"), daemon=True).start()
+
+    while pids:
+        pid, status = os.wait()
+        if pid in pids:
+            log.warning("worker %d exited with status %s", pids.pop(pid), status)